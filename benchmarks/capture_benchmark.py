@@ -0,0 +1,141 @@
+"""Measure the time the proxy spends capturing a flow in its request and response hooks.
+
+Flows are passed directly through InterceptRequestHandler, without any network
+traffic, so that only the work of converting, intercepting and saving the
+request and response is measured. Requests are saved to in-memory storage.
+
+Usage:
+    python benchmarks/capture_benchmark.py [flows]
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from wireproxy import storage  # noqa: E402
+from wireproxy.capture import CapturePolicy  # noqa: E402
+from wireproxy.handler import InterceptRequestHandler  # noqa: E402
+from wireproxy.interceptor import InterceptorRunner  # noqa: E402
+from wireproxy.modifier import RequestModifier  # noqa: E402
+from wireproxy.scope import ScopeMatcher  # noqa: E402
+from wireproxy.subscription import Publisher  # noqa: E402
+from wireproxy.thirdparty.mitmproxy import connections  # noqa: E402
+from wireproxy.thirdparty.mitmproxy.http import (  # noqa: E402
+    HTTPFlow,
+    HTTPRequest,
+    HTTPResponse,
+)
+
+REQUEST_HEADERS = [
+    (b"Host", b"api.example.com"),
+    (b"User-Agent", b"Mozilla/5.0 (X11; Linux x86_64; rv:91.0) Gecko/20100101 Firefox/91.0"),
+    (b"Accept", b"application/json, text/plain, */*"),
+    (b"Accept-Language", b"en-GB,en;q=0.5"),
+    (b"Accept-Encoding", b"gzip, deflate, br"),
+    (b"Content-Type", b"application/json"),
+    (b"Origin", b"https://www.example.com"),
+    (b"Referer", b"https://www.example.com/app"),
+    (b"Cookie", b"session=0123456789abcdef; theme=dark"),
+    (b"Connection", b"keep-alive"),
+]
+
+RESPONSE_HEADERS = [
+    (b"Content-Type", b"application/json; charset=utf-8"),
+    (b"Cache-Control", b"no-cache, no-store"),
+    (b"Date", b"Mon, 18 Oct 2021 10:00:00 GMT"),
+    (b"Server", b"nginx"),
+    (b"Set-Cookie", b"a=1; Path=/"),
+    (b"Set-Cookie", b"b=2; Path=/"),
+    (b"Strict-Transport-Security", b"max-age=31536000"),
+    (b"Vary", b"Accept-Encoding"),
+]
+
+REQUEST_BODY = b'{"query": "items", "page": 1}'
+RESPONSE_BODY = b'{"items": [' + b'{"id": 1, "name": "item"}, ' * 400 + b"]}"
+
+
+def noop_request_interceptor(request):
+    pass
+
+
+def noop_response_interceptor(request, response):
+    pass
+
+
+CASES = {
+    "capture": {},
+    "request interceptor": dict(request_interceptor=noop_request_interceptor),
+    "response interceptor": dict(response_interceptor=noop_response_interceptor),
+    "subscriber": dict(subscribe=True),
+}
+
+
+def make_flow(i: int) -> HTTPFlow:
+    flow = HTTPFlow(
+        connections.ClientConnection.make_dummy(("127.0.0.1", 50000)),
+        connections.ServerConnection.make_dummy(("api.example.com", 443)),
+    )
+    flow.request = HTTPRequest.make(
+        "POST",
+        "https://api.example.com/v1/items/{}?sort=name".format(i),
+        REQUEST_BODY,
+        list(REQUEST_HEADERS),
+    )
+    return flow
+
+
+def make_response() -> HTTPResponse:
+    return HTTPResponse.make(200, RESPONSE_BODY, list(RESPONSE_HEADERS))
+
+
+def run(case: dict, flows: int) -> float:
+    proxy = SimpleNamespace(
+        storage=storage.create(memory_only=True, maxsize=1000),
+        modifier=RequestModifier(),
+        scope_matcher=ScopeMatcher(),
+        capture_policy=CapturePolicy(),
+        subscriptions=Publisher(),
+        options={},
+        request_interceptor=case.get("request_interceptor"),
+        response_interceptor=case.get("response_interceptor"),
+        interceptors=InterceptorRunner(),
+    )
+    handler = InterceptRequestHandler(proxy)
+    subscription = proxy.subscriptions.subscribe(maxsize=1) if case.get("subscribe") else None
+
+    elapsed = 0.0
+
+    for i in range(flows):
+        flow = make_flow(i)
+        response = make_response()
+
+        start = time.perf_counter()
+        handler.requestheaders(flow)
+        handler.request(flow)
+        flow.response = response
+        handler.responseheaders(flow)
+        handler.response(flow)
+        elapsed += time.perf_counter() - start
+
+    if subscription is not None:
+        subscription.close()
+
+    proxy.storage.cleanup()
+
+    return elapsed / flows * 1e6
+
+
+def main() -> None:
+    flows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print("{} flows".format(flows))
+    print("  {:<22} {:>12}".format("case", "us per flow"))
+
+    for name, case in CASES.items():
+        print("  {:<22} {:>12.1f}".format(name, run(case, flows)))
+
+
+if __name__ == "__main__":
+    main()
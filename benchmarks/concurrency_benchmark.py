@@ -0,0 +1,167 @@
+"""Measure storage throughput with many threads saving flows while others poll.
+
+Each writer thread saves requests, responses and websocket messages, as the proxy
+does for concurrent connections, while reader threads repeatedly load and search
+the stored requests, as tests polling driver.requests do. The storage is preloaded
+so that reads have a realistic amount of data to go through.
+
+Contention shows up as latency rather than throughput, as threads are serialized
+by the GIL regardless, so the 99th percentile time to save a flow and to poll are
+reported alongside the rates.
+
+Usage:
+    python benchmarks/concurrency_benchmark.py [flows per writer] [preloaded requests]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from wireproxy import storage  # noqa: E402
+from wireproxy.request import Request, Response, WebSocketMessage  # noqa: E402
+
+WRITER_COUNTS = (1, 4, 16, 64)
+READERS = 4
+# How long readers wait between polls, in seconds.
+POLL_INTERVAL = 0.001
+WS_MESSAGES_PER_FLOW = 4
+
+BACKENDS = {
+    "memory": dict(memory_only=True),
+    "memory dedup": dict(memory_only=True, dedup=True),
+    "directory": dict(),
+    "segment": dict(segmented=True),
+}
+
+BODY = b'{"items": [' + b'{"id": 1, "name": "item"}, ' * 100 + b"]}"
+
+
+def save_flow(s, writer: int, i: int) -> None:
+    request = Request(
+        method="GET",
+        url="https://host{}.example.com/api/items/{}".format(writer % 8, i),
+        headers=[("Accept", "application/json"), ("User-Agent", "benchmark")],
+    )
+    s.save_request(request)
+    s.save_response(
+        request.id,
+        Response(
+            status_code=200,
+            reason="OK",
+            headers=[("Content-Type", "application/json")],
+            body=BODY,
+        ),
+    )
+
+    for j in range(WS_MESSAGES_PER_FLOW):
+        s.save_ws_message(
+            request.id,
+            WebSocketMessage(from_client=j % 2 == 0, content="message", date=datetime.now()),
+        )
+
+
+def percentile(times: list, p: float) -> float:
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p))] if times else 0.0
+
+
+def run(options: dict, writers: int, flows: int, preload: int) -> tuple:
+    base_dir = tempfile.mkdtemp()
+    s = storage.create(base_dir=base_dir, **options)
+
+    for i in range(preload):
+        save_flow(s, 0, i)
+
+    done = threading.Event()
+    flow_times = []
+    poll_times = []
+
+    def write(writer: int) -> None:
+        times = []
+
+        for i in range(flows):
+            start = time.perf_counter()
+            save_flow(s, writer, i)
+            times.append(time.perf_counter() - start)
+
+        flow_times.extend(times)
+
+    def read(reader: int) -> None:
+        times = []
+
+        while not done.wait(POLL_INTERVAL):
+            start = time.perf_counter()
+
+            if reader % 2:
+                s.find(r"/api/items/\d+$", host="host3.example.com")
+            else:
+                # Lazily, so that the disk backends don't read every body
+                s.load_requests(lazy=True)
+
+            times.append(time.perf_counter() - start)
+
+        poll_times.extend(times)
+
+    readers = [threading.Thread(target=read, args=(i,)) for i in range(READERS)]
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+
+    for t in readers:
+        t.start()
+
+    start = time.perf_counter()
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    elapsed = time.perf_counter() - start
+    done.set()
+
+    for t in readers:
+        t.join()
+
+    s.cleanup()
+    shutil.rmtree(base_dir, ignore_errors=True)
+
+    return (
+        writers * flows / elapsed,
+        percentile(flow_times, 0.99) * 1000,
+        len(poll_times) / elapsed,
+        percentile(poll_times, 0.99) * 1000,
+    )
+
+
+def main() -> None:
+    flows = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    preload = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    print(
+        "{} flows per writer, {} readers, {} preloaded requests".format(
+            flows, READERS, preload
+        )
+    )
+
+    for name, options in BACKENDS.items():
+        print(name)
+        print(
+            "  {:>7} {:>10} {:>14} {:>10} {:>14}".format(
+                "writers", "flows/s", "p99 flow ms", "polls/s", "p99 poll ms"
+            )
+        )
+
+        for writers in WRITER_COUNTS:
+            print(
+                "  {:>7} {:>10.0f} {:>14.2f} {:>10.0f} {:>14.2f}".format(
+                    writers, *run(options, writers, flows, preload)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Compare the encode/decode throughput of the storage record format with pickle.
+
+Records are decoded both as the storage reads the records it wrote itself, without
+checking their checksums, and as it first reads those written by an earlier
+process ("record verify").
+
+Usage:
+    python benchmarks/records_benchmark.py [iterations]
+"""
+import os
+import pickle
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from wireproxy import records  # noqa: E402
+from wireproxy.request import Request, Response  # noqa: E402
+
+
+def make_request(body_size: int) -> Request:
+    headers = [("Header-{}".format(i), "value-{}".format(i) * 4) for i in range(30)]
+    request = Request(
+        method="POST",
+        url="https://www.example.com/api/v1/items?page=2&sort=desc",
+        headers=headers,
+        body=os.urandom(body_size),
+    )
+    request.id = "8b2a1c4e-6f0d-4a83-9d55-0e1f2a3b4c5d"
+    return request
+
+
+def make_response(body_size: int) -> Response:
+    headers = [("Header-{}".format(i), "value-{}".format(i) * 4) for i in range(30)]
+    return Response(
+        status_code=200, reason="OK", headers=headers, body=os.urandom(body_size)
+    )
+
+
+def bench(name: str, obj, iterations: int) -> None:
+    encoded_pickle = pickle.dumps(obj)
+    encoded_record = records.encode(obj)
+
+    results = [
+        ("pickle encode", lambda: pickle.dumps(obj)),
+        ("record encode", lambda: records.encode(obj)),
+        ("pickle decode", lambda: pickle.loads(encoded_pickle)),
+        ("record decode", lambda: records.decode(encoded_record, verify=False)),
+        ("record verify", lambda: records.decode(encoded_record)),
+    ]
+
+    print(
+        "{} (pickle {} bytes, record {} bytes)".format(
+            name, len(encoded_pickle), len(encoded_record)
+        )
+    )
+
+    for label, fn in results:
+        elapsed = timeit.timeit(fn, number=iterations)
+        print("  {:<14} {:>10.0f} ops/s".format(label, iterations / elapsed))
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for size in (0, 1024, 256 * 1024):
+        bench("Request, {} byte body".format(size), make_request(size), iterations)
+        bench("Response, {} byte body".format(size), make_response(size), iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,72 @@
 import argparse
+import json
 import logging
 import signal
+import threading
+import time
 from argparse import RawDescriptionHelpFormatter
 
 from wireproxy import backend, utils
 
 logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+log = logging.getLogger(__name__)
 
 
-def standalone_proxy(port=0, addr="127.0.0.1"):
+def standalone_proxy(
+    port=0,
+    addr="127.0.0.1",
+    stats_interval=None,
+    request_storage_max_size=None,
+    request_storage_max_bytes=None,
+    request_storage_max_age=None,
+):
+    """Run the proxy on its own.
+
+    Storage statistics are logged when the process receives SIGUSR1 (where
+    supported), and every stats_interval seconds if specified.
+
+    The requests retained by the storage can be limited to a number of requests,
+    a number of bytes and an age in seconds, with request_storage_max_size,
+    request_storage_max_bytes and request_storage_max_age respectively.
+    """
+    options = {
+        "standalone": True,
+        "verify_ssl": False,
+    }
+
+    if request_storage_max_size is not None:
+        options["request_storage_max_size"] = int(request_storage_max_size)
+    if request_storage_max_bytes is not None:
+        options["request_storage_max_bytes"] = int(request_storage_max_bytes)
+    if request_storage_max_age is not None:
+        options["request_storage_max_age"] = float(request_storage_max_age)
+
     b = backend.create(
         port=int(port),
         addr=addr,
-        options={
-            "standalone": True,
-            "verify_ssl": False,
-        },
+        options=options,
     )
 
     # Configure shutdown handlers
     signal.signal(signal.SIGTERM, lambda *_: b.shutdown())
     signal.signal(signal.SIGINT, lambda *_: b.shutdown())
 
+    def log_stats(*_):
+        log.info("Storage stats: %s", json.dumps(b.stats()))
+
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, log_stats)
+
+    if stats_interval is not None:
+        interval = float(stats_interval)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                log_stats()
+
+        threading.Thread(name="Wire Proxy Stats", target=run, daemon=True).start()
+
 
 if __name__ == "__main__":
     commands = {"extractcert": utils.extract_cert, "standaloneproxy": standalone_proxy}
@@ -0,0 +1,208 @@
+"""Limits on the bodies of captured requests and responses.
+
+Captured bodies are normally stored in full, which for sites heavy with media can
+amount to gigabytes. A CapturePolicy bounds the body of the copy of a request or
+response that is captured, leaving the request or response itself, and the body
+passed through the proxy, untouched. A body may be truncated to
+a maximum size, or above a threshold replaced entirely by its SHA-256 hash. In
+either case the size of the full body is recorded on the captured request or
+response as original_body_size, and the hash, when kept, as body_hash.
+
+Bodies can also not be captured at all, in the 'metadata' capture mode. Only the
+method, URL, status, headers and dates of requests and responses are captured,
+and responses are streamed to the client rather than being read in full first.
+
+Limits and the mode are set for all bodies and may be overridden by rules, which
+apply to the bodies of requests matching a scope and/or of a content type. For
+example:
+
+    CapturePolicy(
+        max_body_size=1024 * 1024,
+        rules=[
+            {'content_type': ['image/', 'video/'], 'mode': 'metadata'},
+            {'content_type': 'font/', 'hash_body_size': 0},
+            {'scope': r'api\\.example\\.com', 'max_body_size': None},
+        ],
+    )
+"""
+import copy
+import hashlib
+from typing import Iterable, List, Optional, Union
+
+from wireproxy.request import Request, Response
+from wireproxy.scope import ScopeMatcher
+from wireproxy.utils import is_list_alike
+
+# What is captured: everything, or everything but the bodies.
+FULL = "full"
+METADATA = "metadata"
+
+CAPTURE_MODES = (FULL, METADATA)
+
+# The keys of a rule.
+RULE_KEYS = ("scope", "content_type", "max_body_size", "hash_body_size", "mode")
+
+
+class _Rule:
+    def __init__(self, rule: dict):
+        unknown = set(rule) - set(RULE_KEYS)
+
+        if unknown:
+            raise ValueError(
+                "Unknown capture rule keys: {} (expected {})".format(
+                    ", ".join(sorted(unknown)), ", ".join(RULE_KEYS)
+                )
+            )
+
+        scope = rule.get("scope")
+        content_type = rule.get("content_type")
+
+        self.scope = ScopeMatcher(scope) if scope else None
+        self.content_types = None
+
+        if content_type:
+            content_types = content_type if is_list_alike(content_type) else [content_type]
+            self.content_types = tuple(t.lower() for t in content_types)
+
+        self.settings = {k: rule[k] for k in RULE_KEYS[2:] if k in rule}
+        _check_mode(self.settings.get("mode", FULL))
+
+    def matches(self, url: str, content_type: str) -> bool:
+        if self.scope is not None and not self.scope.matches(url):
+            return False
+
+        if self.content_types is not None and not content_type.startswith(self.content_types):
+            return False
+
+        return True
+
+
+class CapturePolicy:
+    """Decides how much of each body is captured.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(
+        self,
+        max_body_size: Optional[int] = None,
+        hash_body_size: Optional[int] = None,
+        rules: Optional[Iterable[dict]] = None,
+        mode: str = FULL,
+    ):
+        """Initialise a new CapturePolicy.
+
+        Args:
+            max_body_size: The number of bytes of a body captured, beyond which
+                the body is truncated. Default no limit.
+            hash_body_size: The size above which only the hash of a body is
+                captured rather than the body itself. Default no limit.
+            rules: Dictionaries that override the limits and mode for some bodies. A rule
+                may have a 'scope', a regular expression or list of them matched
+                against the request URL, and a 'content_type', a prefix or list
+                of prefixes of the body's content type. The limits and mode of
+                the first rule matching a body replace those of the same name set
+                for all bodies.
+            mode: What is captured: 'full' captures bodies subject to the limits,
+                'metadata' captures everything but the bodies. Default 'full'.
+        Raises:
+            ValueError: If a rule has an unknown key, or a mode is unknown.
+        """
+        _check_mode(mode)
+
+        self.max_body_size = max_body_size
+        self.hash_body_size = hash_body_size
+        self.mode = mode
+        self.rules: List[_Rule] = [_Rule(rule) for rule in rules or ()]
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any limits are set, or bodies are not captured."""
+        return (
+            self.max_body_size is not None
+            or self.hash_body_size is not None
+            or self.mode != FULL
+            or any(rule.settings for rule in self.rules)
+        )
+
+    def captures_body(self, url: str, content_type: str) -> bool:
+        """Check whether any of a body is captured.
+
+        Args:
+            url: The URL of the request.
+            content_type: The value of the body's Content-Type header.
+        Returns: False if the body is not captured in the 'metadata' mode,
+            True otherwise.
+        """
+        if not self.enabled:
+            return True
+
+        return self._settings(url, content_type)["mode"] == FULL
+
+    def apply(
+        self, obj: Union[Request, Response], url: str, content_type: str
+    ) -> Union[Request, Response]:
+        """Get the request or response to capture, with its body bounded if it exceeds
+        a limit, or removed in the 'metadata' mode.
+
+        Args:
+            obj: The request or response, which is left unchanged.
+            url: The URL of the request.
+            content_type: The value of the Content-Type header of the request or
+                response, given separately so that its headers needn't be loaded.
+        Returns: The request or response itself if its body is within the limits,
+            otherwise a copy of it with the body bounded.
+        """
+        if not self.enabled:
+            return obj
+
+        settings = self._settings(url, content_type)
+
+        if settings["mode"] == METADATA:
+            # The body isn't read, as it may be yet to be loaded
+            bounded = copy.copy(obj)
+            bounded.body = b""
+
+            return bounded
+
+        body = obj.body
+        hash_body_size = settings["hash_body_size"]
+        max_body_size = settings["max_body_size"]
+
+        if hash_body_size is not None and len(body) > hash_body_size:
+            bounded = copy.copy(obj)
+            bounded.body_hash = hashlib.sha256(body).hexdigest()
+            bounded.original_body_size = len(body)
+            bounded.body = b""
+        elif max_body_size is not None and len(body) > max_body_size:
+            bounded = copy.copy(obj)
+            bounded.original_body_size = len(body)
+            bounded.body = body[:max_body_size]
+        else:
+            return obj
+
+        return bounded
+
+    def _settings(self, url: str, content_type: str) -> dict:
+        settings = {
+            "max_body_size": self.max_body_size,
+            "hash_body_size": self.hash_body_size,
+            "mode": self.mode,
+        }
+        content_type = content_type.partition(";")[0].strip().lower()
+
+        for rule in self.rules:
+            if rule.matches(url, content_type):
+                settings.update(rule.settings)
+                break
+
+        return settings
+
+
+def _check_mode(mode: str) -> None:
+    if mode not in CAPTURE_MODES:
+        raise ValueError(
+            "Unknown capture mode: {} (expected one of {})".format(
+                mode, ", ".join(CAPTURE_MODES)
+            )
+        )
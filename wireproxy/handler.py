@@ -1,16 +1,22 @@
+import asyncio
+import copy
 import logging
-import re
 from datetime import datetime
 
-from wireproxy import har
+from wireproxy import har, interceptor, subscription
 from wireproxy.request import Request, Response, WebSocketMessage
+from wireproxy.tee import ResponseTee
 from wireproxy.thirdparty.mitmproxy.http import HTTPResponse
 from wireproxy.thirdparty.mitmproxy.net import websockets
 from wireproxy.thirdparty.mitmproxy.net.http.headers import Headers
-from wireproxy.utils import is_list_alike
 
 log = logging.getLogger(__name__)
 
+# The keys under which whether a flow is in scope, and the request captured for
+# the flow, are held in the flow's metadata.
+SCOPE_METADATA_KEY = "wireproxy.in_scope"
+REQUEST_METADATA_KEY = "wireproxy.request"
+
 
 class InterceptRequestHandler:
     """Mitmproxy add-on which is responsible for request modification
@@ -21,8 +27,15 @@ class InterceptRequestHandler:
         self.proxy = proxy
 
     def requestheaders(self, flow):
-        # Requests that are being captured are not streamed.
-        if self.in_scope(flow.request):
+        # Requests that are being captured are not streamed, unless neither the
+        # capture nor the request interceptor needs their body, in which case
+        # they're left to be streamed as mitmproxy sees fit.
+        if self.in_scope(flow.request, flow) and (
+            self.proxy.request_interceptor is not None
+            or self.proxy.capture_policy.captures_body(
+                flow.request.url, flow.request.headers.get("Content-Type", "")
+            )
+        ):
             flow.request.stream = False
 
     def request(self, flow):
@@ -44,41 +57,92 @@ class InterceptRequestHandler:
         # Convert to one of our requests for handling
         request = self._create_request(flow)
 
-        if not self.in_scope(request):
+        if not self.in_scope(request, flow):
             log.debug("Not capturing %s request: %s", request.method, request.url)
             return
 
         # Call the request interceptor if set
         if self.proxy.request_interceptor is not None:
-            self.proxy.request_interceptor(request)
-
-            if request.response:
-                # The interceptor has created a response for us to send back immediately
-                flow.response = HTTPResponse.make(
-                    status_code=int(request.response.status_code),
-                    content=request.response.body,
-                    headers=[
-                        (k.encode("utf-8"), v.encode("utf-8"))
-                        for k, v in request.response.headers.items()
-                    ],
+            if self.proxy.interceptors.awaited(self.proxy.request_interceptor):
+                # Hold the flow until the interceptor has been awaited, leaving
+                # the event loop free to handle other flows.
+                flow.reply.take()
+                asyncio.ensure_future(self._intercept_request(flow, request))
+                return
+
+            self.proxy.interceptors.call(
+                interceptor.REQUEST, self.proxy.request_interceptor, request
+            )
+            self._apply_request(flow, request)
+
+        self._capture_request(flow, request)
+
+    async def _intercept_request(self, flow, request):
+        try:
+            try:
+                await self.proxy.interceptors.run(
+                    interceptor.REQUEST, self.proxy.request_interceptor, request
                 )
-            else:
-                flow.request.method = request.method
-                flow.request.url = request.url.replace("wss://", "https://", 1)
-                flow.request.headers = self._to_headers_obj(request.headers)
-                flow.request.raw_content = request.body
+                self._apply_request(flow, request)
+            except interceptor.InterceptorFailed as e:
+                log.warning("%s: %s", e, request.url)
+                # Capture the request as it was before the interceptor was called,
+                # as the interceptor may still be changing it.
+                request = self._create_request(flow)
+
+                if not self.proxy.interceptors.fail_open:
+                    flow.response = self._failure_response(e)
+                    request.response = self._create_response(flow)
+
+            self._capture_request(flow, request)
+        except Exception:
+            log.exception("Error handling request: %s", request.url)
+        finally:
+            _resume(flow)
+
+    def _apply_request(self, flow, request):
+        """Apply the changes made to a request by the request interceptor to the flow."""
+        if request.response:
+            # The interceptor has created a response for us to send back immediately
+            flow.response = HTTPResponse.make(
+                status_code=int(request.response.status_code),
+                content=request.response.body,
+                headers=[
+                    (k.encode("utf-8"), v.encode("utf-8"))
+                    for k, v in request.response.headers.items()
+                ],
+            )
+        else:
+            self._update_request(flow, request)
 
+    def _capture_request(self, flow, request):
         log.info("Capturing request: %s", request.url)
 
+        # Bound the bodies of the copy that's captured, now that any changes
+        # have been applied to the flow
+        request = self._bounded_request(flow, request)
+
         self.proxy.storage.save_request(request)
 
         if request.id is not None:  # Will not be None when captured
             flow.request.id = request.id
+            # Shared with the response hook rather than converted again
+            flow.metadata[REQUEST_METADATA_KEY] = request
+
+        if self.proxy.subscriptions:
+            self.proxy.subscriptions.publish(
+                subscription.CaptureEvent(subscription.REQUEST, request.id, request)
+            )
 
         if request.response:
             # This response will be a mocked response. Capture it for completeness.
             self.proxy.storage.save_response(request.id, request.response)
 
+            if self.proxy.subscriptions:
+                self.proxy.subscriptions.publish(
+                    subscription.CaptureEvent(subscription.RESPONSE, request.id, request)
+                )
+
         # Could possibly use mitmproxy's 'anticomp' option instead of this
         if self.proxy.options.get("disable_encoding") is True:
             flow.request.headers["Accept-Encoding"] = "identity"
@@ -87,28 +151,118 @@ class InterceptRequestHandler:
         if "Proxy-Connection" in flow.request.headers:
             del flow.request.headers["Proxy-Connection"]
 
-    def in_scope(self, request):
+    def _bounded_request(self, flow, request):
+        """Get the request to capture, with its body and that of any response set by
+        the request interceptor bounded by the capture policy.
+        """
+        policy = self.proxy.capture_policy
+        bounded = policy.apply(
+            request, request.url, flow.request.headers.get("Content-Type", "")
+        )
+
+        if request.response:
+            response = policy.apply(
+                request.response, request.url, flow.response.headers.get("Content-Type", "")
+            )
+
+            if response is not request.response:
+                if bounded is request:
+                    bounded = copy.copy(request)
+                bounded.response = response
+
+        return bounded
+
+    def in_scope(self, request, flow=None):
+        """Check whether a request is within the proxy's scopes.
+
+        Args:
+            request: The request, either ours or mitmproxy's.
+            flow: The flow of the request, if available. The result is cached on
+                the flow so that later hooks for the same URL needn't check again.
+        Returns: True if the request should be captured, False otherwise.
+        """
         if request.method in self.proxy.options.get("ignore_http_methods", ["OPTIONS"]):
             return False
 
-        scopes = self.proxy.scopes
+        matcher = self.proxy.scope_matcher
+        url = request.url
+
+        if flow is not None:
+            cached = flow.metadata.get(SCOPE_METADATA_KEY)
+            # Also picks up scopes changed in place
+            version = matcher.refresh()
+
+            # The URL may have been rewritten, or the scopes changed, since
+            if cached is not None and cached[0] == version and cached[1] == url:
+                return cached[2]
 
-        if not scopes:
-            return True
-        elif not is_list_alike(scopes):
-            scopes = [scopes]
+        verdict = matcher.matches(url)
 
-        for scope in scopes:
-            match = re.search(scope, request.url)
-            if match:
-                return True
+        if flow is not None:
+            flow.metadata[SCOPE_METADATA_KEY] = (matcher.version, url, verdict)
 
-        return False
+        return verdict
 
     def responseheaders(self, flow):
-        # Responses that are being captured are not streamed.
-        if self.in_scope(flow.request):
-            flow.response.stream = False
+        # Responses that are being captured are not streamed, unless their body
+        # isn't captured, or can be captured as it is streamed.
+        if not self.in_scope(flow.request, flow):
+            return
+
+        if self._can_stream(flow):
+            if not self.proxy.capture_policy.captures_body(
+                flow.request.url, flow.response.headers.get("Content-Type", "")
+            ):
+                flow.response.stream = True
+                return
+
+            if self.proxy.options.get("stream_captured_responses", False):
+                loop = asyncio.get_event_loop()
+                flow.response.stream = ResponseTee(
+                    lambda body: self._on_streamed(loop, flow, body)
+                )
+                return
+
+        flow.response.stream = False
+
+    def _can_stream(self, flow):
+        """Check whether a captured response can be streamed to the client."""
+        return (
+            hasattr(flow.request, "id")
+            # The response interceptor and HAR entry need the whole body up front
+            and self.proxy.response_interceptor is None
+            and not self.proxy.options.get("enable_har", False)
+            # The body is yet to be read from the server, rather than having been
+            # set by the request interceptor
+            and flow.response.raw_content is None
+            and flow.response.status_code != 101
+        )
+
+    def _on_streamed(self, loop, flow, body):
+        # Called on the connection's thread, so the response is captured on the
+        # event loop along with everything else
+        try:
+            loop.call_soon_threadsafe(self._capture_streamed_response, flow, body)
+        except RuntimeError:
+            # The proxy has been shut down
+            log.debug("Not capturing streamed response: %s", flow.request.url)
+            body.close()
+
+    def _capture_streamed_response(self, flow, body):
+        try:
+            response = self._create_response(flow)
+            # Read from the copy of the body when it's first accessed
+            response.body = body
+
+            self._capture_response(flow, response)
+        except Exception:
+            log.exception("Error capturing streamed response: %s", flow.request.url)
+            body.close()
+        else:
+            if not self.proxy.subscriptions:
+                # The body has been read if it was stored, so the copy can go. When
+                # there are subscribers it is left for them to read.
+                body.close()
 
     def response(self, flow):
         # Make any modifications to the response
@@ -119,20 +273,57 @@ class InterceptRequestHandler:
             # Request was not stored
             return
 
+        if isinstance(flow.response.stream, ResponseTee):
+            # Captured once the body has been streamed
+            return
+
         # Convert the mitmproxy specific response to one of our responses
         # for handling.
         response = self._create_response(flow)
 
         # Call the response interceptor if set
         if self.proxy.response_interceptor is not None:
-            self.proxy.response_interceptor(
-                self._create_request(flow, response), response
+            # The interceptor is given a request of its own rather than the captured
+            # one, so that any changes it makes to the request aren't captured
+            request = self._create_request(flow, response)
+            request.id = flow.request.id
+
+            if self.proxy.interceptors.awaited(self.proxy.response_interceptor):
+                flow.reply.take()
+                asyncio.ensure_future(self._intercept_response(flow, request, response))
+                return
+
+            self.proxy.interceptors.call(
+                interceptor.RESPONSE, self.proxy.response_interceptor, request, response
             )
-            flow.response.status_code = response.status_code
-            flow.response.reason = response.reason
-            flow.response.headers = self._to_headers_obj(response.headers)
-            flow.response.raw_content = response.body
+            self._update_response(flow, response)
+
+        self._capture_response(flow, response)
+
+    async def _intercept_response(self, flow, request, response):
+        try:
+            try:
+                await self.proxy.interceptors.run(
+                    interceptor.RESPONSE, self.proxy.response_interceptor, request, response
+                )
+                self._update_response(flow, response)
+            except interceptor.InterceptorFailed as e:
+                log.warning("%s: %s", e, request.url)
+
+                if not self.proxy.interceptors.fail_open:
+                    flow.response = self._failure_response(e)
 
+                # Capture the response the client receives rather than one the
+                # interceptor may still be changing.
+                response = self._create_response(flow)
+
+            self._capture_response(flow, response)
+        except Exception:
+            log.exception("Error handling response: %s", request.url)
+        finally:
+            _resume(flow)
+
+    def _capture_response(self, flow, response):
         log.info(
             "Capturing response: %s %s %s",
             flow.request.url,
@@ -140,37 +331,76 @@ class InterceptRequestHandler:
             response.reason,
         )
 
+        request = self._captured_request(flow)
+        response = self.proxy.capture_policy.apply(
+            response, request.url, flow.response.headers.get("Content-Type", "")
+        )
+
         self.proxy.storage.save_response(flow.request.id, response)
 
+        # Attached once saved, so that subscribers see the captured response
+        request.response = response
+
+        if self.proxy.subscriptions:
+            self.proxy.subscriptions.publish(
+                subscription.CaptureEvent(subscription.RESPONSE, request.id, request)
+            )
+
         if self.proxy.options.get("enable_har", False):
             self.proxy.storage.save_har_entry(
                 flow.request.id, har.create_har_entry(flow)
             )
 
+    def _captured_request(self, flow):
+        """Get the request captured for a flow by the request hook."""
+        request = flow.metadata.get(REQUEST_METADATA_KEY)
+
+        if request is None:
+            request = self._create_request(flow)
+            request.id = flow.request.id
+
+        return request
+
     def _create_request(self, flow, response=None):
         request = Request(
             method=flow.request.method,
             url=flow.request.url,
-            headers=[(k, v) for k, v in flow.request.headers.items()],
+            headers=_header_items(flow.request.headers),
             body=flow.request.raw_content,
         )
 
         # For websocket requests, the scheme of the request is overwritten with https
         # in the initial CONNECT request so we set the scheme back to wss for capture.
         if websockets.check_handshake(
-            request.headers
-        ) and websockets.check_client_version(request.headers):
+            flow.request.headers
+        ) and websockets.check_client_version(flow.request.headers):
             request.url = request.url.replace("https://", "wss://", 1)
 
         request.response = response
 
         return request
 
+    def _update_request(self, flow, request):
+        """Apply any changes made to a request by the request interceptor to the flow."""
+        if request.method != flow.request.method:
+            flow.request.method = request.method
+
+        url = request.url.replace("wss://", "https://", 1)
+
+        if url != flow.request.url:
+            flow.request.url = url
+
+        if request.headers_loaded:
+            flow.request.headers = self._to_headers_obj(request.headers)
+
+        if request.body is not flow.request.raw_content:
+            flow.request.raw_content = request.body
+
     def _create_response(self, flow):
         response = Response(
             status_code=flow.response.status_code,
             reason=flow.response.reason,
-            headers=[(k, v) for k, v in flow.response.headers.items(multi=True)],
+            headers=_header_items(flow.response.headers, multi=True),
             body=flow.response.raw_content,
         )
 
@@ -192,6 +422,27 @@ class InterceptRequestHandler:
 
         return response
 
+    def _update_response(self, flow, response):
+        """Apply any changes made to a response by the response interceptor to the flow."""
+        flow.response.status_code = response.status_code
+        flow.response.reason = response.reason
+
+        if response.headers_loaded:
+            flow.response.headers = self._to_headers_obj(response.headers)
+
+        if response.body is not flow.response.raw_content:
+            flow.response.raw_content = response.body
+
+    def _failure_response(self, error):
+        """Create the response sent in place of a flow's own when its interceptor
+        has failed and the failure policy is 'closed'.
+        """
+        return HTTPResponse.make(
+            504 if error.timed_out else 502,
+            str(error),
+            {"Content-Type": "text/plain; charset=utf-8"},
+        )
+
     def _to_headers_obj(self, headers):
         return Headers(
             [(k.encode("utf-8"), str(v).encode("utf-8")) for k, v in headers.items()]
@@ -210,9 +461,47 @@ class InterceptRequestHandler:
                 flow.handshake_flow.request.id, ws_message
             )
 
+            if self.proxy.subscriptions:
+                self.proxy.subscriptions.publish(
+                    subscription.CaptureEvent(
+                        subscription.WS_MESSAGE,
+                        flow.handshake_flow.request.id,
+                        message=ws_message,
+                    )
+                )
+
             if message.from_client:
                 direction = "(client -> server)"
             else:
                 direction = "(server -> client)"
 
             log.debug("Capturing websocket message %s: %s", direction, ws_message)
+
+
+def _resume(flow):
+    """Let a flow taken by the handler carry on."""
+    if not flow.reply.has_message:
+        flow.reply.ack()
+    flow.reply.commit()
+
+
+def _header_items(headers, multi=False):
+    """Get a callable that converts mitmproxy headers to name/value pairs of strings,
+    so that the conversion only happens if the headers are accessed.
+
+    Args:
+        headers: The mitmproxy headers.
+        multi: When True, repeated headers are kept separate rather than folded.
+    Returns: A callable returning a list of name/value pairs.
+    """
+    # Changing mitmproxy headers replaces their fields rather than modifying
+    # them, so these are the headers as they are now.
+    fields = headers.fields
+
+    if multi:
+        return lambda: [
+            (k.decode("utf-8", "surrogateescape"), v.decode("utf-8", "surrogateescape"))
+            for k, v in fields
+        ]
+
+    return lambda: list(Headers(fields).items())
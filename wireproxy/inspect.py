@@ -1,9 +1,13 @@
 import inspect
+import re
+import threading
 import time
-from typing import Iterator, List, Optional, Union
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
 
 from wireproxy import har
 from wireproxy.request import Request
+from wireproxy.storage import RESPONSE_SAVED
+from wireproxy.subscription import DEFAULT_BUFFER_SIZE, CaptureEvent, Subscription
 
 
 class InspectRequestsMixin:
@@ -17,6 +21,9 @@ class InspectRequestsMixin:
 
             del firefox.requests
 
+        When the request_storage_lazy option is set, request and response
+        bodies are only read from disk when they are accessed.
+
         Returns:
             A list of Request instances representing the requests made
             between the browser and server.
@@ -27,12 +34,44 @@ class InspectRequestsMixin:
     def requests(self):
         self.backend.storage.clear_requests()
 
-    def iter_requests(self) -> Iterator[Request]:
+    def iter_requests(
+        self, lazy: Optional[bool] = None, since: Optional[int] = None
+    ) -> Iterator[Request]:
         """Return an iterator of requests.
 
+        Args:
+            lazy: Whether to return lazily loaded requests whose bodies are only read
+                from disk when accessed. Defaults to the request_storage_lazy option.
+            since: When specified, only the requests captured or updated since this
+                cursor are returned. See requests_since().
         Returns: An iterator.
         """
-        yield from self.backend.storage.iter_requests()
+        yield from self.backend.storage.iter_requests(lazy=lazy, since=since)
+
+    def requests_since(
+        self, cursor: int = 0, lazy: Optional[bool] = None
+    ) -> Tuple[List[Request], int]:
+        """Retrieve the requests captured or updated since the specified cursor.
+
+        This allows the captured requests to be polled without fetching the entire
+        history each time. A request is updated when its response is received, in
+        which case it is returned again with the response attached.
+
+        For example:
+
+            requests, cursor = driver.requests_since()
+            ...
+            new_requests, cursor = driver.requests_since(cursor)
+
+        Args:
+            cursor: The cursor returned by a previous call. Default 0, which
+                returns all requests.
+            lazy: Whether to return lazily loaded requests whose bodies are only read
+                from disk when accessed. Defaults to the request_storage_lazy option.
+        Returns: A tuple of the list of Request instances, in the order in which they
+            were captured or updated, and the cursor to pass to the next call.
+        """
+        return self.backend.storage.requests_since(cursor, lazy=lazy)
 
     @property
     def last_request(self) -> Optional[Request]:
@@ -68,20 +107,156 @@ class InspectRequestsMixin:
             TimeoutException if a request is not seen within the timeout
                 period.
         """
-        start = time.time()
+        return self.wait_for_requests([pat], timeout=timeout)[0]
+
+    def wait_for_requests(
+        self, patterns: Iterable[str], timeout: Union[int, float] = 10
+    ) -> List[Request]:
+        """Wait up to the timeout period for requests matching each of the
+        specified patterns to be seen.
+
+        The patterns are searched in the full request URL, as with wait_for_request().
+        Only requests with corresponding responses are considered. Rather than polling,
+        the wait is woken as soon as a response is saved and only the newly saved
+        requests are checked.
+
+        Args:
+            patterns: The patterns of the requests to look for. Regexes can be supplied.
+            timeout: The maximum time to wait in seconds for all the requests. Default 10s.
+
+        Returns:
+            A list containing a matching request for each pattern, in the same
+            order as the patterns.
+        Raises:
+            TimeoutException if a request matching each pattern is not seen within
+                the timeout period.
+        """
+        patterns = list(patterns)
+        storage = self.backend.storage
+        deadline = time.monotonic() + timeout
+        condition = threading.Condition()
+        saved = []
+
+        def on_saved(event, request_id, url):
+            if event == RESPONSE_SAVED:
+                with condition:
+                    saved.append((request_id, url))
+                    condition.notify()
+
+        # Listen before checking the requests already stored so that none are missed
+        storage.add_listener(on_saved)
+
+        try:
+            found = {}
+
+            for i, pat in enumerate(patterns):
+                request = storage.find(pat)
+
+                if request is not None:
+                    found[i] = request
+
+            while len(found) < len(patterns):
+                with condition:
+                    while not saved:
+                        remaining = deadline - time.monotonic()
+
+                        if remaining <= 0:
+                            missing = [p for i, p in enumerate(patterns) if i not in found]
+                            raise TimeoutError(
+                                "Timed out after {}s waiting for request matching {}".format(
+                                    timeout, ", ".join(missing)
+                                )
+                            )
+
+                        condition.wait(remaining)
+
+                    arrived = saved[:]
+                    saved.clear()
+
+                for request_id, url in arrived:
+                    for i, pat in enumerate(patterns):
+                        if i not in found and re.search(pat, url):
+                            request = storage.load_request(request_id)
+
+                            if request is not None:
+                                found[i] = request
+
+            return [found[i] for i in range(len(patterns))]
+        finally:
+            storage.remove_listener(on_saved)
+
+    def subscribe(
+        self,
+        callback: Optional[Callable[[CaptureEvent], None]] = None,
+        *,
+        maxsize: int = DEFAULT_BUFFER_SIZE,
+        overflow: str = "drop",
+        kinds: Optional[Iterable[str]] = None,
+    ) -> Subscription:
+        """Subscribe to requests, responses and websocket messages as they are captured.
+
+        Each event is pushed to the subscriber as soon as it is captured, rather
+        than having to be loaded from storage. This works even when request storage
+        is disabled with the request_storage='none' option.
+
+        For example:
 
-        while time.time() - start < timeout:
-            request = self.backend.storage.find(pat)
+            with driver.subscribe(kinds=['response']) as subscription:
+                for event in subscription:
+                    print(event.request.url, event.request.response.status_code)
 
-            if request is None:
-                time.sleep(1 / 5)
-            else:
-                return request
+        Captured requests and responses are shared with the storage, so they
+        should not be modified.
 
-        raise TimeoutError(
-            "Timed out after {}s waiting for request matching {}".format(timeout, pat)
+        Args:
+            callback: An optional callable that is passed each CaptureEvent on a
+                dedicated thread. When not supplied, events are consumed from the
+                returned subscription with get() or by iterating over it.
+            maxsize: The maximum number of events buffered for the subscriber.
+            overflow: What happens when the buffer is full: 'drop' discards new events
+                and counts them in Subscription.dropped, 'block' holds up capture until
+                there is space. Default 'drop'.
+            kinds: The kinds of event to receive: 'request', 'response' and/or
+                'ws_message'. Default all kinds.
+        Returns: The subscription, which should be closed when no longer needed.
+        """
+        return self.backend.subscribe(
+            callback, maxsize=maxsize, overflow=overflow, kinds=kinds
         )
 
+    def storage_stats(self) -> dict:
+        """Get statistics about what the request storage is holding.
+
+        This can be used to size the memory and disk available to the proxy, and
+        to spot captured data building up in long running sessions. For example:
+
+            stats = driver.storage_stats()
+            print(stats['requests'], stats['bytes_in_memory'], stats['bytes_on_disk'])
+
+        Returns: A dictionary of flow counts, bytes held in memory and on disk,
+            bytes per host, websocket message totals, evictions, write queue depth
+            and average save latency. See the stats() method of the storage for
+            the full list of keys.
+        """
+        return self.backend.stats()
+
+    def interceptor_stats(self) -> dict:
+        """Get statistics about the calls made to the request and response interceptors.
+
+        Slow interceptors hold up the requests they intercept, and unless the
+        interceptor_workers option is set, every other request passing through the
+        proxy as well. For example:
+
+            stats = driver.interceptor_stats()
+            print(stats['request']['p99_ms'], stats['response']['timeouts'])
+
+        Returns: A dictionary keyed by 'request' and 'response' of the number of
+            calls made to that interceptor, their mean, maximum and percentile
+            latencies in milliseconds, a histogram of their latencies, and the
+            number of calls made on a worker that timed out or raised.
+        """
+        return self.backend.interceptor_stats()
+
     @property
     def har(self) -> str:
         """Get a HAR archive of HTTP transactions that have taken place.
@@ -286,7 +461,9 @@ class InspectRequestsMixin:
         """A callable that will be used to intercept/modify requests.
 
         The callable must accept a single argument for the request
-        being intercepted.
+        being intercepted. It may be a coroutine function (async def), in
+        which case it is awaited on the proxy's event loop without holding
+        up other requests.
         """
         return self.backend.request_interceptor
 
@@ -303,7 +480,9 @@ class InspectRequestsMixin:
         """A callable that will be used to intercept/modify responses.
 
         The callable must accept two arguments: the response being
-        intercepted and the originating request.
+        intercepted and the originating request. It may be a coroutine
+        function (async def), in which case it is awaited on the proxy's
+        event loop without holding up other responses.
         """
         return self.backend.response_interceptor
 
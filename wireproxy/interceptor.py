@@ -0,0 +1,274 @@
+"""Calling of the request and response interceptors.
+
+By default the interceptors are called on the proxy's event loop thread, which
+runs the hooks of every flow, so a slow interceptor holds up all other flows
+passing through the proxy. When a number of workers is configured, the
+interceptors are instead called on a pool of worker threads. The flow being
+intercepted waits for its interceptor, up to an optional timeout, while the
+hooks of other flows carry on.
+
+Interceptors may also be coroutine functions, which are awaited on the event
+loop itself. A flow waiting for a coroutine interceptor doesn't hold up the
+hooks of other flows either, and neither does it hold a worker thread, so many
+flows can be intercepted at once by interceptors that call asynchronous clients.
+
+What happens to a flow when its interceptor times out or raises is decided by
+the failure policy: 'open' lets the flow through as if it hadn't been
+intercepted, 'closed' answers it with an error response instead.
+
+The time taken by each call is recorded in a latency histogram per kind of
+interceptor.
+"""
+import asyncio
+import bisect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+# The kinds of interceptor.
+REQUEST = "request"
+RESPONSE = "response"
+
+# What happens to a flow when its interceptor times out or raises.
+FAILURE_POLICIES = ("open", "closed")
+
+# The upper bounds, in milliseconds, of the latency histogram buckets. A final
+# bucket holds the calls that took longer.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class InterceptorFailed(Exception):
+    """Raised when an interceptor that is awaited times out or raises."""
+
+    def __init__(self, message: str, timed_out: bool = False):
+        super().__init__(message)
+        self.timed_out = timed_out
+
+
+class LatencyHistogram:
+    """Counts durations in buckets of increasing size.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self):
+        self._counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self._total_ms = 0.0
+        self._max_ms = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, duration: float) -> None:
+        """Record a duration.
+
+        Args:
+            duration: The duration in seconds.
+        """
+        ms = duration * 1000
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, ms)
+
+        with self._lock:
+            self._counts[bucket] += 1
+            self._total_ms += ms
+            self._max_ms = max(self._max_ms, ms)
+
+    def report(self) -> dict:
+        """Get a summary of the durations recorded.
+
+        Returns: A dictionary of the number of durations, their mean and maximum,
+            estimates of the 50th, 90th and 99th percentiles, and the count of each
+            bucket keyed by its upper bound. Percentiles are the upper bound of the
+            bucket they fall in. All times are in milliseconds.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total_ms, max_ms = self._total_ms, self._max_ms
+
+        count = sum(counts)
+        bounds = [str(bound) for bound in LATENCY_BUCKETS_MS] + ["+Inf"]
+
+        return {
+            "count": count,
+            "mean_ms": round(total_ms / count, 3) if count else 0.0,
+            "max_ms": round(max_ms, 3),
+            "p50_ms": _percentile(counts, 0.5, max_ms),
+            "p90_ms": _percentile(counts, 0.9, max_ms),
+            "p99_ms": _percentile(counts, 0.99, max_ms),
+            "buckets": dict(zip(bounds, counts)),
+        }
+
+
+class InterceptorRunner:
+    """Calls the interceptors, either directly or on a pool of worker threads,
+    and records how long they take.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        timeout: Optional[float] = None,
+        failure: str = "open",
+    ):
+        """Initialise a new InterceptorRunner.
+
+        Args:
+            workers: The number of worker threads to call the interceptors on.
+                Default None, which means call them directly on the event loop.
+            timeout: The number of seconds a flow waits for an interceptor called
+                on a worker, or for a coroutine interceptor. Default no limit.
+                Calls made directly can't time out.
+            failure: What happens to a flow when its interceptor, called on a
+                worker or a coroutine, times out or raises: 'open' lets the flow
+                through without the interceptor's changes, 'closed' answers it
+                with an error response. Default 'open'.
+        """
+        if failure not in FAILURE_POLICIES:
+            raise ValueError(
+                "Unknown interceptor failure policy: {} (expected one of {})".format(
+                    failure, ", ".join(FAILURE_POLICIES)
+                )
+            )
+
+        if workers is not None and workers < 1:
+            raise ValueError("The number of interceptor workers must be at least 1")
+
+        self.timeout = timeout
+        self.fail_open = failure == "open"
+
+        self._executor = None
+
+        if workers is not None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="Wire Proxy Interceptor"
+            )
+
+        self._latency = {REQUEST: LatencyHistogram(), RESPONSE: LatencyHistogram()}
+        self._timeouts = {REQUEST: 0, RESPONSE: 0}
+        self._errors = {REQUEST: 0, RESPONSE: 0}
+        self._lock = threading.Lock()
+
+    @property
+    def pooled(self) -> bool:
+        """Whether the interceptors are called on worker threads."""
+        return self._executor is not None
+
+    def awaited(self, interceptor: Callable) -> bool:
+        """Check whether calls to an interceptor are awaited with run() rather than
+        made directly with call().
+
+        Args:
+            interceptor: The interceptor.
+        Returns: True if the interceptor is a coroutine function or is called on
+            a worker, False otherwise.
+        """
+        return self.pooled or _is_coroutine_function(interceptor)
+
+    def call(self, kind: str, interceptor: Callable, *args) -> None:
+        """Call an interceptor directly, recording how long it takes.
+
+        Args:
+            kind: The kind of interceptor, REQUEST or RESPONSE.
+            interceptor: The interceptor.
+            args: The arguments passed to the interceptor.
+        """
+        start = time.perf_counter()
+
+        try:
+            interceptor(*args)
+        finally:
+            self._latency[kind].record(time.perf_counter() - start)
+
+    async def run(self, kind: str, interceptor: Callable, *args) -> None:
+        """Await a coroutine interceptor, or call an interceptor on a worker and
+        wait for it, up to the timeout.
+
+        This must be awaited on the proxy's event loop.
+
+        Args:
+            kind: The kind of interceptor, REQUEST or RESPONSE.
+            interceptor: The interceptor.
+            args: The arguments passed to the interceptor.
+        Raises:
+            InterceptorFailed: If the interceptor timed out or raised. A coroutine
+                interceptor that times out is cancelled, whereas one called on a
+                worker carries on running.
+        """
+        if _is_coroutine_function(interceptor):
+            future = self._call_coroutine(kind, interceptor, *args)
+        else:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self._executor, self.call, kind, interceptor, *args)
+
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timeouts[kind] += 1
+            raise InterceptorFailed(
+                "The {} interceptor timed out after {}s".format(kind, self.timeout),
+                timed_out=True,
+            ) from None
+        except Exception as e:
+            with self._lock:
+                self._errors[kind] += 1
+            raise InterceptorFailed("The {} interceptor raised: {!r}".format(kind, e)) from e
+
+    async def _call_coroutine(self, kind: str, interceptor: Callable, *args) -> None:
+        start = time.perf_counter()
+
+        try:
+            await interceptor(*args)
+        finally:
+            self._latency[kind].record(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        """Get statistics about the interceptor calls.
+
+        Returns: A dictionary keyed by the kind of interceptor, 'request' and
+            'response', of the latency histogram report for that kind, along with
+            the number of awaited calls that timed out or raised.
+        """
+        stats = {}
+
+        with self._lock:
+            for kind, histogram in self._latency.items():
+                stats[kind] = dict(
+                    histogram.report(),
+                    timeouts=self._timeouts[kind],
+                    errors=self._errors[kind],
+                )
+
+        return stats
+
+    def shutdown(self) -> None:
+        """Stop the worker threads, without waiting for calls in progress."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+def _is_coroutine_function(interceptor: Callable) -> bool:
+    # Also recognise instances of classes with an async __call__ method
+    return asyncio.iscoroutinefunction(interceptor) or asyncio.iscoroutinefunction(
+        getattr(interceptor, "__call__", None)
+    )
+
+
+def _percentile(counts: List[int], fraction: float, max_ms: float) -> float:
+    """Estimate a percentile as the upper bound of the bucket it falls in, or the
+    maximum when it falls in the final, unbounded bucket.
+    """
+    rank = fraction * sum(counts)
+
+    if not rank:
+        return 0.0
+
+    seen = 0
+
+    for bound, count in zip(LATENCY_BUCKETS_MS, counts):
+        seen += count
+        if seen >= rank:
+            return float(bound)
+
+    return round(max_ms, 3)
@@ -0,0 +1,112 @@
+"""Append-only journal used to persist the index of a request storage.
+
+Each entry is a JSON object framed with its length and a CRC32 checksum, so that
+an entry which was only partially written when the process died is detected
+when the journal is read back. Reading stops at the first such entry, and the
+journal is truncated there before any further entries are appended.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import BinaryIO, List
+
+log = logging.getLogger(__name__)
+
+# length, crc32
+_FRAME = struct.Struct(">II")
+
+
+class Journal:
+    """An append-only file of JSON entries.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self, path: str):
+        """Open a journal for appending, creating it if it doesn't exist.
+
+        Args:
+            path: The path to the journal file.
+        """
+        self.path = path
+        self._file: BinaryIO = open(path, "ab")
+        self._lock = threading.Lock()
+
+    def append(self, entry: dict) -> None:
+        """Append an entry to the journal.
+
+        Args:
+            entry: The entry, which must be serializable as JSON.
+        """
+        with self._lock:
+            self._write(entry)
+
+    def restart(self, entry: dict) -> None:
+        """Start a new journal file at the same path, once the previous file has
+        been moved aside.
+
+        Args:
+            entry: The first entry of the new journal.
+        """
+        with self._lock:
+            self._file.close()
+            self._file = open(self.path, "ab")
+            self._write(entry)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def _write(self, entry: dict) -> None:
+        data = json.dumps(entry, separators=(",", ":")).encode("utf-8")
+        self._file.write(_FRAME.pack(len(data), zlib.crc32(data)) + data)
+        # Flush so that the entry survives the process dying
+        self._file.flush()
+
+
+def read(path: str) -> List[dict]:
+    """Read the entries of a journal, truncating any partially written entry
+    at the end of the journal.
+
+    Args:
+        path: The path to the journal file.
+    Returns: The entries in the order they were appended.
+    Raises:
+        FileNotFoundError: If the journal doesn't exist.
+    """
+    entries = []
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    pos = 0
+
+    while pos < len(data):
+        if pos + _FRAME.size > len(data):
+            break
+
+        length, crc = _FRAME.unpack_from(data, pos)
+        payload = data[pos + _FRAME.size : pos + _FRAME.size + length]
+
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+
+        try:
+            entries.append(json.loads(payload.decode("utf-8")))
+        except ValueError:
+            break
+
+        pos += _FRAME.size + length
+
+    if pos < len(data):
+        log.warning(
+            "Discarding %s bytes of incomplete journal entries from %s",
+            len(data) - pos,
+            path,
+        )
+        os.truncate(path, pos)
+
+    return entries
@@ -0,0 +1,411 @@
+"""A compact, versioned binary format for captured requests, responses,
+websocket messages and HAR entries.
+
+Each record starts with a fixed header:
+
+    magic (2 bytes) | version (1 byte) | kind (1 byte) | crc32 (4 bytes) | length (4 bytes)
+
+followed by a payload of `length` bytes. The checksum covers the payload so that
+records which were only partially written are detected when they are decoded,
+or checked up front when they were written by an earlier process.
+
+The payload holds a table of field lengths, a fixed-size structure for the kind
+of record (status code, date etc.) and then the variable length fields
+themselves: strings, a block of header names and values, and bodies. Bodies
+are written as is, without being re-encoded.
+
+Version 2 separates ASCII header names and values with NUL characters rather
+than giving their lengths, and encodes certificate data as JSON.
+"""
+import base64
+import itertools
+import json
+import struct
+import zlib
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple, Union
+
+from wireproxy.request import HTTPHeaders, Request, Response, WebSocketMessage
+
+MAGIC = b"WP"
+VERSION = 2
+
+KIND_REQUEST = 1
+KIND_RESPONSE = 2
+KIND_WS_MESSAGE = 3
+KIND_HAR_ENTRY = 4
+
+_HEADER = struct.Struct(">2sBBII")
+HEADER_SIZE = _HEADER.size
+_FIELD_COUNT = struct.Struct(">I")
+# date, whether the headers are ASCII
+_REQUEST = struct.Struct(">d?")
+# status code, date, whether the headers are ASCII
+_RESPONSE = struct.Struct(">Hd?")
+# from client, is text, date
+_WS_MESSAGE = struct.Struct(">??d")
+# original body size, followed by the body hash if any. Only written when the
+# captured body was cut short, as an extra field after the body.
+_BODY_CUT = struct.Struct(">Q")
+
+Record = Union[Request, Response, WebSocketMessage, dict]
+
+
+class CorruptRecordError(ValueError):
+    """Raised when a record cannot be decoded, e.g. because it was only partially written."""
+
+
+def encode(obj: Record) -> bytes:
+    """Encode a request, response, websocket message or HAR entry as a record.
+
+    Args:
+        obj: The object to encode.
+    Returns: The encoded record.
+    """
+    if isinstance(obj, Request):
+        kind, (fixed, fields) = KIND_REQUEST, _encode_request(obj)
+    elif isinstance(obj, Response):
+        kind, (fixed, fields) = KIND_RESPONSE, _encode_response(obj)
+    elif isinstance(obj, WebSocketMessage):
+        kind, (fixed, fields) = KIND_WS_MESSAGE, _encode_ws_message(obj)
+    elif isinstance(obj, dict):
+        kind, fixed, fields = KIND_HAR_ENTRY, b"", [json.dumps(obj).encode("utf-8")]
+    else:
+        raise TypeError("Cannot encode object of type {}".format(type(obj).__name__))
+
+    parts = [
+        _FIELD_COUNT.pack(len(fields)),
+        struct.pack(">{}Q".format(len(fields)), *map(len, fields)),
+        fixed,
+        *fields,
+    ]
+
+    crc = 0
+    length = 0
+
+    # Checksum the parts individually rather than joining them first, so
+    # that the body is only copied once.
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+        length += len(part)
+
+    return b"".join([_HEADER.pack(MAGIC, VERSION, kind, crc, length), *parts])
+
+
+def decode(data: bytes, verify: bool = True) -> Record:
+    """Decode a record previously created by encode().
+
+    Args:
+        data: The encoded record, as bytes or a memoryview.
+        verify: Whether to check the record against its checksum. Checking is
+            most of the cost of decoding a record with a large body, and can be
+            skipped for records known to have been written in full, e.g. those
+            written by the same process or already checked with check().
+    Returns: The decoded request, response, websocket message or HAR entry.
+    Raises:
+        CorruptRecordError: If the record is incomplete, fails its checksum
+            or was written by an unsupported version.
+    """
+    kind, payload = _payload(data, verify)
+
+    try:
+        if kind == KIND_REQUEST:
+            return _decode_request(*_split(payload, _REQUEST))
+        elif kind == KIND_RESPONSE:
+            return _decode_response(*_split(payload, _RESPONSE))
+        elif kind == KIND_WS_MESSAGE:
+            return _decode_ws_message(*_split(payload, _WS_MESSAGE))
+        elif kind == KIND_HAR_ENTRY:
+            _, fields = _split(payload, None)
+            return json.loads(str(fields[0], "utf-8"))
+    except (
+        struct.error,
+        IndexError,
+        UnicodeDecodeError,
+        ValueError,
+        TypeError,
+    ) as e:
+        raise CorruptRecordError("Record could not be decoded: {}".format(e)) from e
+
+    raise CorruptRecordError("Unknown record kind {}".format(kind))
+
+
+def check(data: bytes) -> None:
+    """Check that a record is complete and matches its checksum, without decoding it.
+
+    Args:
+        data: The encoded record, as bytes or a memoryview.
+    Raises:
+        CorruptRecordError: If the record is incomplete, fails its checksum
+            or was written by an unsupported version.
+    """
+    _payload(data, True)
+
+
+def _payload(data: bytes, verify: bool) -> Tuple[int, memoryview]:
+    """Get the kind and the payload of a record, checking its header."""
+    if len(data) < _HEADER.size:
+        raise CorruptRecordError("Record is truncated")
+
+    magic, version, kind, crc, length = _HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise CorruptRecordError("Not a record")
+
+    if version != VERSION:
+        raise CorruptRecordError("Unsupported record version {}".format(version))
+
+    payload = memoryview(data)[_HEADER.size :]
+
+    if len(payload) != length:
+        raise CorruptRecordError(
+            "Record length is {} but expected {}".format(len(payload), length)
+        )
+
+    if verify and zlib.crc32(payload) != crc:
+        raise CorruptRecordError("Record checksum does not match")
+
+    return kind, payload
+
+
+def record_length(header: bytes) -> int:
+    """Get the total length of a record from its header, so that records written
+    one after another can be split apart again.
+
+    Args:
+        header: At least the first HEADER_SIZE bytes of the record.
+    Returns: The length of the record including its header.
+    Raises:
+        CorruptRecordError: If the header is incomplete or is not a record header.
+    """
+    if len(header) < _HEADER.size:
+        raise CorruptRecordError("Record header is truncated")
+
+    magic, _, _, _, length = _HEADER.unpack_from(header)
+
+    if magic != MAGIC:
+        raise CorruptRecordError("Not a record")
+
+    return _HEADER.size + length
+
+
+def _split(
+    payload: memoryview, fixed: Optional[struct.Struct]
+) -> Tuple[tuple, List[memoryview]]:
+    """Split a payload into its fixed values and its variable length fields."""
+    (count,) = _FIELD_COUNT.unpack_from(payload)
+    pos = _FIELD_COUNT.size
+    lengths = struct.unpack_from(">{}Q".format(count), payload, pos)
+    pos += 8 * count
+
+    if fixed is not None:
+        values = fixed.unpack_from(payload, pos)
+        pos += fixed.size
+    else:
+        values = ()
+
+    ends = list(itertools.accumulate(lengths))
+    fields = [payload[start + pos : end + pos] for start, end in zip([0] + ends, ends)]
+
+    if (ends[-1] if ends else 0) + pos != len(payload):
+        raise ValueError("Field lengths do not match the record length")
+
+    return values, fields
+
+
+def _encode_request(request: Request) -> Tuple[bytes, List[bytes]]:
+    is_ascii, header_lengths, headers = _encode_headers(request.headers.raw_items())
+
+    fixed = _REQUEST.pack(request.date.timestamp(), is_ascii)
+    fields = [
+        _str(request.id or ""),
+        _str(request.method),
+        _str(request.url),
+        _cert(request.cert),
+        header_lengths,
+        headers,
+        request.body,
+        *_body_cut(request),
+    ]
+
+    return fixed, fields
+
+
+def _decode_request(values: tuple, fields: List[memoryview]) -> Request:
+    date, is_ascii = values
+    request_id, method, url, cert, header_lengths, headers, body, *body_cut = fields
+
+    request = Request(method=_from_str(method), url=_from_str(url), headers=())
+    request.headers = HTTPHeaders.from_items(
+        _decode_headers(header_lengths, headers, is_ascii)
+    )
+    request.body = bytes(body)
+    request.id = _from_str(request_id) or None
+    request.date = datetime.fromtimestamp(date)
+    request.cert = _from_cert(cert)
+    _from_body_cut(request, body_cut)
+
+    return request
+
+
+def _encode_response(response: Response) -> Tuple[bytes, List[bytes]]:
+    is_ascii, header_lengths, headers = _encode_headers(response.headers.raw_items())
+
+    fixed = _RESPONSE.pack(int(response.status_code), response.date.timestamp(), is_ascii)
+    fields = [
+        _str(response.reason),
+        _cert(getattr(response, "cert", {})),
+        header_lengths,
+        headers,
+        response.body,
+        *_body_cut(response),
+    ]
+
+    return fixed, fields
+
+
+def _decode_response(values: tuple, fields: List[memoryview]) -> Response:
+    status_code, date, is_ascii = values
+    reason, cert, header_lengths, headers, body, *body_cut = fields
+
+    response = Response(status_code=status_code, reason=_from_str(reason), headers=())
+    response.headers = HTTPHeaders.from_items(
+        _decode_headers(header_lengths, headers, is_ascii)
+    )
+    response.body = bytes(body)
+    response.date = datetime.fromtimestamp(date)
+    response.cert = _from_cert(cert)
+    _from_body_cut(response, body_cut)
+
+    return response
+
+
+def _encode_ws_message(message: WebSocketMessage) -> Tuple[bytes, List[bytes]]:
+    is_text = isinstance(message.content, str)
+    content = message.content.encode("utf-8") if is_text else message.content
+
+    fixed = _WS_MESSAGE.pack(message.from_client, is_text, message.date.timestamp())
+
+    return fixed, [content]
+
+
+def _decode_ws_message(values: tuple, fields: List[memoryview]) -> WebSocketMessage:
+    from_client, is_text, date = values
+    content = fields[0]
+
+    return WebSocketMessage(
+        from_client=from_client,
+        content=str(content, "utf-8") if is_text else bytes(content),
+        date=datetime.fromtimestamp(date),
+    )
+
+
+def _encode_headers(headers: Sequence[Tuple[str, str]]) -> Tuple[bool, bytes, bytes]:
+    """Encode header names and values as a single block.
+
+    Headers are almost always ASCII, in which case the names and values are
+    separated by NUL characters, so that the whole block is encoded and decoded
+    with a single call rather than each name and value separately. Otherwise, or
+    should a name or value contain a NUL, the block is preceded by a table of the
+    lengths of the names and values.
+    """
+    strings = [str(s) for pair in headers for s in pair]
+    joined = "\0".join(strings)
+
+    if joined.isascii() and joined.count("\0") == max(len(strings) - 1, 0):
+        return True, b"", joined.encode("ascii")
+
+    encoded = [_str(s) for s in strings]
+    lengths = [len(b) for b in encoded]
+
+    return False, struct.pack(">{}I".format(len(lengths)), *lengths), b"".join(encoded)
+
+
+def _decode_headers(
+    lengths: memoryview, block: memoryview, is_ascii: bool
+) -> List[Tuple[str, str]]:
+    if is_ascii:
+        strings = str(block, "ascii").split("\0") if block else []
+    else:
+        lengths = struct.unpack(">{}I".format(len(lengths) // 4), lengths)
+        ends = list(itertools.accumulate(lengths))
+        strings = [_from_str(block[start:end]) for start, end in zip([0] + ends, ends)]
+
+        if (ends[-1] if ends else 0) != len(block):
+            raise ValueError("Header lengths do not match the header block")
+
+    if len(strings) % 2:
+        raise ValueError("Header name without a value")
+
+    return list(zip(strings[::2], strings[1::2]))
+
+
+def _body_cut(obj: Union[Request, Response]) -> List[bytes]:
+    if obj.original_body_size is None:
+        return []
+
+    return [_BODY_CUT.pack(obj.original_body_size) + _str(obj.body_hash or "")]
+
+
+def _from_body_cut(obj: Union[Request, Response], fields: List[memoryview]) -> None:
+    if fields:
+        (obj.original_body_size,) = _BODY_CUT.unpack_from(fields[0])
+        obj.body_hash = _from_str(fields[0][_BODY_CUT.size :]) or None
+
+
+def _str(s: str) -> bytes:
+    return s.encode("utf-8", "surrogateescape")
+
+
+def _from_str(b: memoryview) -> str:
+    return str(b, "utf-8", "surrogateescape")
+
+
+def _cert(cert: dict) -> bytes:
+    # Certificate data is a plain dictionary of builtin types (strings, bytes,
+    # numbers, datetimes and lists and tuples of them), encoded as JSON.
+    return json.dumps(_tag(cert), separators=(",", ":")).encode("utf-8") if cert else b""
+
+
+def _from_cert(b: memoryview) -> dict:
+    return _untag(json.loads(str(b, "utf-8"))) if b else {}
+
+
+def _tag(value):
+    """Make a value JSON serializable, wrapping the types that JSON lacks in an
+    object whose single key names the type.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    elif isinstance(value, list):
+        return [_tag(v) for v in value]
+    elif isinstance(value, tuple):
+        return {"tuple": [_tag(v) for v in value]}
+    elif isinstance(value, dict):
+        return {"dict": {str(k): _tag(v) for k, v in value.items()}}
+    elif isinstance(value, bytes):
+        return {"bytes": base64.b64encode(value).decode("ascii")}
+    elif isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+
+    raise TypeError("Cannot encode certificate value of type {}".format(type(value).__name__))
+
+
+def _untag(value):
+    if isinstance(value, list):
+        return [_untag(v) for v in value]
+    elif not isinstance(value, dict):
+        return value
+
+    (kind, v), = value.items()
+
+    if kind == "tuple":
+        return tuple(_untag(item) for item in v)
+    elif kind == "dict":
+        return {k: _untag(item) for k, item in v.items()}
+    elif kind == "bytes":
+        return base64.b64decode(v)
+    elif kind == "datetime":
+        return datetime.fromisoformat(v)
+
+    raise ValueError("Unknown certificate value type {}".format(kind))
@@ -2,7 +2,7 @@
 from datetime import datetime
 from http import HTTPStatus
 from http.client import HTTPMessage
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 
 
@@ -12,6 +12,20 @@ class HTTPHeaders(HTTPMessage):
     Note that duplicate key names are permitted.
     """
 
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[str, str]]) -> 'HTTPHeaders':
+        """Create headers from name/value pairs without any parsing applied.
+
+        This is equivalent to, but much faster than, calling add_header() for each pair.
+        """
+        headers = cls()
+        headers._headers = list(items)
+        return headers
+
+    def raw_items(self) -> List[Tuple[str, str]]:
+        """Get the headers as name/value pairs without any parsing applied."""
+        return list(self._headers)
+
     def __repr__(self):
         return repr(self.items())
 
@@ -19,40 +33,94 @@ class HTTPHeaders(HTTPMessage):
 class Request:
     """Represents an HTTP request."""
 
-    def __init__(self, *, method: str, url: str, headers: Iterable[Tuple[str, str]], body: bytes = b''):
+    # Callables that supply the headers and body the first time they are accessed
+    _headers_loader: Optional[Callable[[], Iterable[Tuple[str, str]]]] = None
+    _body_loader: Optional[Callable[[], bytes]] = None
+
+    # Set when the captured body was cut short by the capture policy: the size of the
+    # full body and, when only its hash was captured, its SHA-256 hex digest
+    original_body_size: Optional[int] = None
+    body_hash: Optional[str] = None
+
+    def __init__(
+        self,
+        *,
+        method: str,
+        url: str,
+        headers: Union[Iterable[Tuple[str, str]], Callable[[], Iterable[Tuple[str, str]]]],
+        body: Union[bytes, Callable[[], bytes]] = b'',
+    ):
         """Initialise a new Request object.
 
         Args:
             method: The request method - GET, POST etc.
             url: The request URL.
-            headers: The request headers as an iterable of 2-element tuples.
-            body: The request body as bytes.
+            headers: The request headers as an iterable of 2-element tuples, or a
+                callable returning them which will be invoked the first time the
+                headers are accessed.
+            body: The request body as bytes, or a callable returning the body which
+                will be invoked the first time the body is accessed.
         """
         self.id: Optional[str] = None  # The id is set for captured requests
         self.method = method
         self.url = url
-        self.headers = HTTPHeaders()
-
-        for k, v in headers:
-            self.headers.add_header(k, v)
-
+        self._set_headers(headers)
         self.body = body
         self.response: Optional[Response] = None
         self.date: datetime = datetime.now()
         self.ws_messages: List[WebSocketMessage] = []
         self.cert: dict = {}
 
+    @property
+    def headers(self) -> HTTPHeaders:
+        """Get the request headers.
+
+        Returns: The request headers.
+        """
+        if self._headers_loader is not None:
+            loader, self._headers_loader = self._headers_loader, None
+            self._headers = HTTPHeaders.from_items(loader())
+        return self._headers
+
+    @headers.setter
+    def headers(self, h: HTTPHeaders):
+        self._headers_loader = None
+        self._headers = h
+
+    @property
+    def headers_loaded(self) -> bool:
+        """Whether the headers have been accessed, when they are supplied by a callable."""
+        return self._headers_loader is None
+
+    def _set_headers(self, headers):
+        if callable(headers):
+            self._headers = HTTPHeaders()
+            self._headers_loader = headers
+        else:
+            self.headers = HTTPHeaders()
+
+            for k, v in headers:
+                self._headers.add_header(k, v)
+
     @property
     def body(self) -> bytes:
         """Get the request body.
 
         Returns: The request body as bytes.
         """
+        if self._body_loader is not None:
+            loader, self._body_loader = self._body_loader, None
+            self.body = loader()
         return self._body
 
     @body.setter
-    def body(self, b: bytes):
-        if b is None:
+    def body(self, b: Union[bytes, Callable[[], bytes]]):
+        self._body_loader = None
+
+        if callable(b):
+            self._body = b''
+            self._body_loader = b
+        elif b is None:
             self._body = b''
         elif isinstance(b, str):
             self._body = b.encode('utf-8')
@@ -145,8 +213,31 @@ class Request:
         """
         self.create_response(status_code=error_code)
 
+    def __getstate__(self):
+        # The loaders may be bound to the storage, which can't be copied or pickled,
+        # so the headers, body and websocket messages are copied as plain values.
+        state = dict(vars(self), _headers=self.headers, _body=self.body)
+        state.pop('_headers_loader', None)
+        state.pop('_body_loader', None)
+
+        if not isinstance(self.ws_messages, list):
+            state['ws_messages'] = list(self.ws_messages)
+
+        return state
+
+    def __copy__(self):
+        # A shallow copy shares any loaders rather than loading the values first
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(vars(self))
+        return copied
+
     def __repr__(self):
-        return 'Request(method={method!r}, url={url!r}, headers={headers!r}, body={_body!r})'.format_map(vars(self))
+        return 'Request(method={!r}, url={!r}, headers={}, body={})'.format(
+            self.method,
+            self.url,
+            _lazy_repr(self._headers, self._headers_loader),
+            _lazy_repr(self._body, self._body_loader),
+        )
 
     def __str__(self):
         return self.url
@@ -155,37 +246,91 @@ class Request:
 class Response:
     """Represents an HTTP response."""
 
-    def __init__(self, *, status_code: int, reason: str, headers: Iterable[Tuple[str, str]], body: bytes = b''):
+    # Callables that supply the headers and body the first time they are accessed
+    _headers_loader: Optional[Callable[[], Iterable[Tuple[str, str]]]] = None
+    _body_loader: Optional[Callable[[], bytes]] = None
+
+    # Set when the captured body was cut short by the capture policy: the size of the
+    # full body and, when only its hash was captured, its SHA-256 hex digest
+    original_body_size: Optional[int] = None
+    body_hash: Optional[str] = None
+
+    def __init__(
+        self,
+        *,
+        status_code: int,
+        reason: str,
+        headers: Union[Iterable[Tuple[str, str]], Callable[[], Iterable[Tuple[str, str]]]],
+        body: Union[bytes, Callable[[], bytes]] = b'',
+    ):
         """Initialise a new Response object.
 
         Args:
             status_code: The status code.
             reason: The reason message (e.g. "OK" or "Not Found").
-            headers: The response headers as an iterable of 2-element tuples.
-            body: The response body as bytes.
+            headers: The response headers as an iterable of 2-element tuples, or a
+                callable returning them which will be invoked the first time the
+                headers are accessed.
+            body: The response body as bytes, or a callable returning the body which
+                will be invoked the first time the body is accessed.
         """
         self.status_code = status_code
         self.reason = reason
-        self.headers = HTTPHeaders()
-
-        for k, v in headers:
-            self.headers.add_header(k, v)
-
+        self._set_headers(headers)
         self.body = body
         self.date: datetime = datetime.now()
         self.cert: dict = {}
 
+    @property
+    def headers(self) -> HTTPHeaders:
+        """Get the response headers.
+
+        Returns: The response headers.
+        """
+        if self._headers_loader is not None:
+            loader, self._headers_loader = self._headers_loader, None
+            self._headers = HTTPHeaders.from_items(loader())
+        return self._headers
+
+    @headers.setter
+    def headers(self, h: HTTPHeaders):
+        self._headers_loader = None
+        self._headers = h
+
+    @property
+    def headers_loaded(self) -> bool:
+        """Whether the headers have been accessed, when they are supplied by a callable."""
+        return self._headers_loader is None
+
+    def _set_headers(self, headers):
+        if callable(headers):
+            self._headers = HTTPHeaders()
+            self._headers_loader = headers
+        else:
+            self.headers = HTTPHeaders()
+
+            for k, v in headers:
+                self._headers.add_header(k, v)
+
     @property
     def body(self) -> bytes:
         """Get the response body.
 
         Returns: The response body as bytes.
         """
+        if self._body_loader is not None:
+            loader, self._body_loader = self._body_loader, None
+            self.body = loader()
         return self._body
 
     @body.setter
-    def body(self, b: bytes):
-        if b is None:
+    def body(self, b: Union[bytes, Callable[[], bytes]]):
+        self._body_loader = None
+
+        if callable(b):
+            self._body = b''
+            self._body_loader = b
+        elif b is None:
             self._body = b''
         elif isinstance(b, str):
             self._body = b.encode('utf-8')
@@ -194,10 +339,25 @@ class Response:
         else:
             self._body = b
 
+    def __getstate__(self):
+        # See Request.__getstate__()
+        state = dict(vars(self), _headers=self.headers, _body=self.body)
+        state.pop('_headers_loader', None)
+        state.pop('_body_loader', None)
+
+        return state
+
+    def __copy__(self):
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(vars(self))
+        return copied
+
     def __repr__(self):
-        return (
-            'Response(status_code={status_code!r}, reason={reason!r}, headers={headers!r}, '
-            'body={_body!r})'.format_map(vars(self))
+        return 'Response(status_code={!r}, reason={!r}, headers={}, body={})'.format(
+            self.status_code,
+            self.reason,
+            _lazy_repr(self._headers, self._headers_loader),
+            _lazy_repr(self._body, self._body_loader),
         )
 
     def __str__(self):
@@ -232,3 +392,8 @@ class WebSocketMessage:
         elif self is other:
             return True
         return self.from_client == other.from_client and self.content == other.content and self.date == other.date
+
+
+def _lazy_repr(value, loader) -> str:
+    # A value that is yet to be loaded isn't loaded just to be represented
+    return '<not loaded>' if loader is not None else repr(value)
@@ -0,0 +1,145 @@
+"""Matching of request URLs against the scopes set on the proxy.
+
+Scopes are regular expressions that are searched for in a request's URL. They are
+compiled once when they're set rather than each time a request is checked. Scopes
+that are plain hostnames, which is what they usually are, are looked up by the host
+of the URL instead. The remaining scopes are combined into a single regular
+expression so that a URL is searched once regardless of the number of scopes.
+"""
+import itertools
+import re
+from typing import Iterable, List, Optional, Pattern, Set, Union
+
+from wireproxy.utils import is_list_alike
+
+# Scopes that are nothing but a hostname, or the end of one.
+_HOST_SCOPE = re.compile(r"^[A-Za-z0-9-]+(\.[A-Za-z0-9-]+)*$")
+
+# Scopes that refer to groups by number or by name, which would refer to the
+# wrong groups were the scopes combined, or that set flags, which would apply to
+# all of the scopes.
+_UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)")
+
+# Versions of compiled scopes, unique across all matchers.
+_versions = itertools.count(1)
+
+
+class ScopeMatcher:
+    """Decides whether a URL is within a set of scopes.
+
+    A URL is in scope when there are no scopes, or when re.search() finds any
+    of the scopes in the URL.
+    """
+
+    def __init__(self, scopes: Union[str, Iterable[str], None] = None):
+        """Initialise a new ScopeMatcher.
+
+        Args:
+            scopes: A regular expression or a list of regular expressions.
+                The list is held as is, so that changes made to it later are
+                picked up.
+        Raises:
+            re.error: If a scope is not a valid regular expression.
+        """
+        self.scopes = [] if scopes is None else scopes
+        # A copy of the scopes as they were compiled.
+        self._compiled_scopes: List[str] = []
+        # Hostnames that, when found at the end of a URL's host, put the URL in scope.
+        self._hosts: Set[str] = set()
+        self._patterns: List[Pattern] = []
+        # Changes each time the scopes are compiled.
+        self.version = 0
+
+        self._compile()
+
+    def refresh(self) -> int:
+        """Recompile the scopes if the list of scopes has been changed in place.
+
+        Returns: The version of the compiled scopes, which is unique to the scopes
+            of this matcher as they were when they were compiled, so can be used to
+            tell whether a verdict made earlier still holds.
+        """
+        if self._changed():
+            self._compile()
+
+        return self.version
+
+    def matches(self, url: str) -> bool:
+        """Check whether a URL is in scope.
+
+        Args:
+            url: The URL.
+        Returns: True if the URL is in scope, False otherwise.
+        """
+        self.refresh()
+
+        if not self._compiled_scopes:
+            return True
+
+        if self._hosts:
+            host = _get_host(url)
+
+            while host:
+                if host in self._hosts:
+                    return True
+                host = host.partition(".")[2]
+
+        # Hostname scopes are also searched for in the rest of the URL
+        for pattern in self._patterns:
+            if pattern.search(url):
+                return True
+
+        return False
+
+    def _changed(self) -> bool:
+        if isinstance(self.scopes, list):
+            # Compared as it is rather than copied, as this is checked for every request
+            return self.scopes != self._compiled_scopes
+
+        return self._scope_list() != self._compiled_scopes
+
+    def _scope_list(self) -> List[str]:
+        if not self.scopes:
+            return []
+        elif not is_list_alike(self.scopes):
+            return [self.scopes]
+
+        return list(self.scopes)
+
+    def _compile(self) -> None:
+        scopes = self._scope_list()
+
+        self._hosts = {scope for scope in scopes if _HOST_SCOPE.match(scope)}
+        self._patterns = _compile_patterns(scopes)
+        self._compiled_scopes = scopes
+        self.version = next(_versions)
+
+
+def _compile_patterns(scopes: List[str]) -> List[Pattern]:
+    """Combine scopes into a single alternation, or compile them separately if they
+    can't be combined.
+    """
+    # Compile each scope first so that an invalid scope is reported as such
+    patterns = [re.compile(scope) for scope in scopes]
+
+    if len(patterns) > 1 and not any(_UNCOMBINABLE.search(scope) for scope in scopes):
+        try:
+            return [re.compile("|".join("(?:{})".format(scope) for scope in scopes))]
+        except re.error:
+            # E.g. a group name is used by more than one scope
+            pass
+
+    return patterns
+
+
+def _get_host(url: str) -> Optional[str]:
+    """Get the host of a URL as it appears in the URL, without changing its case
+    as urlsplit() would.
+    """
+    netloc = url.partition("://")[2].partition("/")[0]
+    netloc = netloc.partition("?")[0].partition("#")[0].rpartition("@")[2]
+
+    if netloc.startswith("["):
+        return None
+
+    return netloc.partition(":")[0]
@@ -0,0 +1,199 @@
+"""Append-only segment log used by the request storage backends.
+
+Records are written as length-prefixed blobs to a sequence of rolling
+segment files. Each append returns the location of the record which
+callers keep in their own index and later use to read the record back.
+"""
+import logging
+import os
+import re
+import struct
+import threading
+from typing import BinaryIO, Dict, List, NamedTuple
+
+log = logging.getLogger(__name__)
+
+# The size a segment file may grow to before a new one is started.
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+_LENGTH = struct.Struct(">I")
+
+
+class Location(NamedTuple):
+    """The position of a record within a segment log."""
+
+    segment: int
+    offset: int
+    length: int
+
+
+class SegmentLog:
+    """A sequence of append-only segment files held in a single directory.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        prefix: str = "segment",
+    ):
+        """Initialise a new SegmentLog.
+
+        Args:
+            directory: The directory that will hold the segment files.
+            segment_size: The size in bytes a segment may grow to before
+                a new segment is started.
+            prefix: The filename prefix used for the segment files.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.prefix = prefix
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Continue from any segments already in the directory, e.g. when a
+        # storage session is reopened.
+        segments = self.segments()
+        self._first_segment = segments[0] if segments else 0
+        self._segment = segments[-1] if segments else 0
+        self._writer: BinaryIO = open(self._get_segment_path(self._segment), "ab")
+        self._readers: Dict[int, BinaryIO] = {}
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+    def append(self, data: bytes) -> Location:
+        """Append a record to the log.
+
+        Args:
+            data: The record data.
+        Returns: The location of the record.
+        """
+        with self._write_lock:
+            if self._writer.tell() >= self.segment_size:
+                self._roll()
+
+            offset = self._writer.tell()
+            self._writer.write(_LENGTH.pack(len(data)))
+            self._writer.write(data)
+            # Flush so that the record is immediately visible to readers
+            self._writer.flush()
+
+            return Location(self._segment, offset, len(data))
+
+    def read(self, location: Location) -> bytes:
+        """Read the record at the specified location.
+
+        Args:
+            location: The location previously returned by append().
+        Returns: The record data.
+        Raises:
+            FileNotFoundError: If the segment holding the record no longer exists.
+            EOFError: If the record is incomplete.
+        """
+        segment, offset, length = location
+
+        with self._read_lock:
+            reader = self._readers.get(segment)
+
+            if reader is None:
+                reader = open(self._get_segment_path(segment), "rb")
+                self._readers[segment] = reader
+
+            reader.seek(offset)
+            header = reader.read(_LENGTH.size)
+            data = reader.read(length)
+
+        if len(header) < _LENGTH.size or _LENGTH.unpack(header)[0] != length:
+            raise EOFError("Incomplete record header at {}".format(location))
+
+        if len(data) < length:
+            raise EOFError("Incomplete record at {}".format(location))
+
+        return data
+
+    def segments(self) -> List[int]:
+        """Get the numbers of the segment files in the directory, in ascending order."""
+        pattern = re.compile(r"{}-(\d+)\.log$".format(re.escape(self.prefix)))
+        segments = []
+
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+
+        return sorted(segments)
+
+    @property
+    def current_segment(self) -> int:
+        """The number of the segment currently being written to."""
+        return self._segment
+
+    def remove_segment(self, segment: int) -> bool:
+        """Delete a segment file that is no longer needed.
+
+        The segment currently being written to is never deleted.
+
+        Args:
+            segment: The segment number.
+        Returns: True if the segment was deleted, False otherwise.
+        """
+        with self._write_lock:
+            if segment == self._segment:
+                return False
+
+            with self._read_lock:
+                reader = self._readers.pop(segment, None)
+                if reader is not None:
+                    reader.close()
+
+            try:
+                os.remove(self._get_segment_path(segment))
+            except FileNotFoundError:
+                pass
+
+            return True
+
+    def reset(self) -> None:
+        """Remove all segment files and start a new segment.
+
+        Segment numbers keep increasing across a reset so that any locations
+        handed out beforehand can never refer to records written afterwards.
+        """
+        with self._write_lock:
+            self._writer.close()
+
+            with self._read_lock:
+                for reader in self._readers.values():
+                    reader.close()
+                self._readers.clear()
+
+            for segment in range(self._first_segment, self._segment + 1):
+                try:
+                    os.remove(self._get_segment_path(segment))
+                except FileNotFoundError:
+                    pass
+
+            self._roll()
+            self._first_segment = self._segment
+
+    def close(self) -> None:
+        """Close all open segment files."""
+        with self._write_lock:
+            self._writer.close()
+
+        with self._read_lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+
+    def _roll(self) -> None:
+        if not self._writer.closed:
+            self._writer.close()
+        self._segment += 1
+        self._writer = open(self._get_segment_path(self._segment), "ab")
+        log.debug("Started new segment %s", self._get_segment_path(self._segment))
+
+    def _get_segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, "{}-{:06d}.log".format(self.prefix, segment))
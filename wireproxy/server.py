@@ -2,8 +2,12 @@ import asyncio
 import logging
 
 from wireproxy import storage
+from wireproxy.capture import CapturePolicy
 from wireproxy.handler import InterceptRequestHandler
+from wireproxy.interceptor import InterceptorRunner
 from wireproxy.modifier import RequestModifier
+from wireproxy.scope import ScopeMatcher
+from wireproxy.subscription import Publisher
 from wireproxy.thirdparty.mitmproxy import addons
 from wireproxy.thirdparty.mitmproxy.master import Master
 from wireproxy.thirdparty.mitmproxy.options import Options
@@ -31,16 +35,34 @@ class MitmProxy:
             key_path=options.get("ca_key"),
         )
 
+        # Used to push captured requests to subscribers as they are captured
+        self.subscriptions = Publisher()
+
         # Used to modify requests/responses passing through the server
         # DEPRECATED. Will be superceded by request/response interceptors.
         self.modifier = RequestModifier()
 
         # The scope of requests we're interested in capturing.
-        self.scopes = []
+        self.scope_matcher = ScopeMatcher()
+
+        # How much of the captured bodies to keep
+        self.capture_policy = CapturePolicy(
+            max_body_size=options.get("capture_max_body_size"),
+            hash_body_size=options.get("capture_hash_body_size"),
+            rules=options.get("capture_rules"),
+            mode=options.get("capture_mode", "full"),
+        )
 
         self.request_interceptor = None
         self.response_interceptor = None
 
+        # Calls the interceptors, optionally on worker threads
+        self.interceptors = InterceptorRunner(
+            workers=options.get("interceptor_workers"),
+            timeout=options.get("interceptor_timeout"),
+            failure=options.get("interceptor_failure", "open"),
+        )
+
         self._event_loop = asyncio.new_event_loop()
 
         mitmproxy_opts = Options()
@@ -80,16 +102,71 @@ class MitmProxy:
         """
         return self.master.server.address
 
+    @property
+    def scopes(self):
+        """The URL patterns used to scope request capture."""
+        return self.scope_matcher.scopes
+
+    @scopes.setter
+    def scopes(self, scopes):
+        # Compiled once here rather than each time a request is checked
+        self.scope_matcher = ScopeMatcher(scopes)
+
+    def subscribe(self, callback=None, **kwargs):
+        """Subscribe to captured requests, responses and websocket messages.
+
+        See Publisher.subscribe() for the arguments.
+
+        Returns: A Subscription.
+        """
+        return self.subscriptions.subscribe(callback, **kwargs)
+
+    def stats(self):
+        """Get statistics about what the request storage is holding.
+
+        Returns: A dictionary of statistics. See the stats() method of the storage.
+        """
+        return self.storage.stats()
+
+    def interceptor_stats(self):
+        """Get statistics about the calls made to the request and response interceptors.
+
+        Returns: A dictionary of statistics. See InterceptorRunner.stats().
+        """
+        return self.interceptors.stats()
+
     def shutdown(self):
         """Shutdown the server and perform any cleanup."""
         self.master.shutdown()
+        self.interceptors.shutdown()
+        self.subscriptions.close()
         self.storage.cleanup()
 
     def _get_storage_args(self):
         storage_args = {
             "memory_only": self.options.get("request_storage") == "memory",
+            "disabled": self.options.get("request_storage") == "none",
+            "segmented": self.options.get("request_storage") == "segment",
             "base_dir": self.options.get("request_storage_base_dir"),
             "maxsize": self.options.get("request_storage_max_size"),
+            "max_age": self.options.get("request_storage_max_age"),
+            "max_bytes": self.options.get("request_storage_max_bytes"),
+            "eviction": self.options.get("request_storage_eviction"),
+            "spill": self.options.get("request_storage_spill", False),
+            "segment_size": self.options.get("request_storage_segment_size"),
+            "lazy": self.options.get("request_storage_lazy", False),
+            "write_behind": self.options.get("request_storage_write_behind", False),
+            "write_queue_size": self.options.get("request_storage_write_queue_size"),
+            "writers": self.options.get("request_storage_writers"),
+            "dedup": self.options.get("request_storage_dedup", False),
+            "dedup_requests": self.options.get("request_storage_dedup_requests", False),
+            "ws_max_messages": self.options.get("request_storage_ws_max_messages"),
+            "ws_max_bytes": self.options.get("request_storage_ws_max_bytes"),
+            "compress": self.options.get("request_storage_compress", False),
+            "compress_level": self.options.get("request_storage_compress_level"),
+            "compress_dict_samples": self.options.get(
+                "request_storage_compress_dict_samples"
+            ),
         }
 
         return storage_args
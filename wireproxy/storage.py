@@ -1,394 +1,2762 @@
+import copy
+import functools
+import hashlib
+import itertools
 import logging
+import operator
 import os
-import pickle
+import queue
 import re
 import shutil
 import sys
 import tempfile
 import threading
+import time
 import uuid
 from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
-from typing import DefaultDict, Iterator, List, Optional, Union
-
-from wireproxy.request import Request, Response, WebSocketMessage
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlsplit
+
+import zstandard as zstd
+
+from wireproxy import journal, records
+from wireproxy.request import HTTPHeaders, Request, Response, WebSocketMessage
+from wireproxy.segment import DEFAULT_SEGMENT_SIZE, Location, SegmentLog
+from wireproxy.websocket import MessageLog, MessageRing, content_size
 
 log = logging.getLogger(__name__)
 
 # Storage folders older than this are cleaned up.
 REMOVE_DATA_OLDER_THAN_DAYS = 1
 
+# The prefix of directories that have been moved aside to be deleted.
+TRASH_DIR_PREFIX = "trash-"
+
+# The file in each storage directory in use that is touched periodically, so that
+# the directory isn't swept away by another process as if it had been left behind.
+HEARTBEAT_FILE = "heartbeat"
+
+# How often, in seconds, the heartbeat files are touched.
+HEARTBEAT_INTERVAL = 600
+
+# The number of seconds cleanup() waits for the storage directory to be deleted.
+CLEANUP_TIMEOUT = 10
+
+# The orders in which the in-memory storage can evict requests.
+EVICTION_POLICIES = ("fifo", "lru")
+
+# How often, in seconds, retention limits are checked in the background.
+RETENTION_INTERVAL = 5
+
+# The number of records that may be waiting to be written before saves block.
+DEFAULT_WRITE_QUEUE_SIZE = 1000
+
+# The events published to storage listeners.
+REQUEST_SAVED = "request_saved"
+RESPONSE_SAVED = "response_saved"
 
-def create(*, memory_only: bool = False, **kwargs):
+# Bodies smaller than this are not deduplicated, as the saving wouldn't outweigh
+# the cost of hashing them and storing them separately.
+DEDUP_MIN_BODY_SIZE = 1024
+
+# Bodies smaller than this are not compressed.
+COMPRESS_MIN_BODY_SIZE = 64
+
+# The default zstd compression level used for bodies.
+DEFAULT_COMPRESS_LEVEL = 3
+
+# The maximum size of a compression dictionary trained on the session's bodies.
+COMPRESS_DICT_SIZE = 112640
+
+# The files in a session directory holding the index journal and any trained
+# compression dictionary, which allow the session to be reopened.
+JOURNAL_FILE = "index.journal"
+COMPRESS_DICT_FILE = "compression.dict"
+
+# The version of the index journal format.
+JOURNAL_VERSION = 1
+
+
+def create(
+    *,
+    memory_only: bool = False,
+    segmented: bool = False,
+    disabled: bool = False,
+    **kwargs
+):
     """Create a new storage instance.
 
     Args:
         memory_only: When True, an in-memory implementation will be used which stores
             request data in memory only and nothing on disk. Default False.
+        segmented: When True, a disk implementation will be used which appends request
+            data to rolling segment files rather than creating a directory per request.
+            Default False.
+        disabled: When True, nothing is stored. Captured requests can still be
+            received through subscriptions. Default False.
         kwargs: Any arguments to initialise the storage with:
             - base_dir: The base directory under which requests are stored
             - maxsize: The maximum number of requests the storage can hold
-    Returns: A request storage implementation, currently either RequestStorage (default)
-        or InMemoryRequestStorage when memory_only is set to True.
+            - max_age: The maximum age in seconds of stored requests (disk only)
+            - write_behind: Whether records are written on background threads (disk only)
+            - write_queue_size: The number of records that may wait to be written
+            - writers: The number of background writer threads
+            - max_bytes: The maximum bytes the storage can hold, in memory for memory_only
+              or on disk otherwise
+            - eviction: The eviction policy, 'fifo' or 'lru' (memory_only only)
+            - spill: Whether evicted bodies are spilled to disk (memory_only only)
+            - segment_size: The size in bytes a segment file may grow to (segmented only)
+            - lazy: Whether requests are loaded lazily by default (disk storage only)
+            - dedup: Whether identical response bodies are stored only once
+            - dedup_requests: Whether identical request bodies are also stored only once
+            - ws_max_messages: The maximum number of websocket messages held per
+              connection (memory_only only)
+            - ws_max_bytes: The maximum bytes of websocket messages held per
+              connection (memory_only only)
+            - compress: Whether bodies are compressed with zstd (disk only)
+            - compress_level: The zstd compression level (disk only)
+            - compress_dict_samples: The number of bodies to train a compression
+              dictionary on (disk only)
+    Returns: A request storage implementation, currently either RequestStorage (default),
+        SegmentRequestStorage when segmented is set to True, InMemoryRequestStorage
+        when memory_only is set to True or NullRequestStorage when disabled is set
+        to True.
     """
+    if disabled:
+        log.info("Request storage is disabled")
+        return NullRequestStorage(base_dir=kwargs.get("base_dir"))
+
     if memory_only:
         log.info("Using in-memory request storage")
         return InMemoryRequestStorage(
-            base_dir=kwargs.get("base_dir"), maxsize=kwargs.get("maxsize")
+            base_dir=kwargs.get("base_dir"),
+            maxsize=kwargs.get("maxsize"),
+            max_bytes=kwargs.get("max_bytes"),
+            eviction=kwargs.get("eviction") or "fifo",
+            spill=bool(kwargs.get("spill")),
+            dedup=bool(kwargs.get("dedup")),
+            dedup_requests=bool(kwargs.get("dedup_requests")),
+            ws_max_messages=kwargs.get("ws_max_messages"),
+            ws_max_bytes=kwargs.get("ws_max_bytes"),
+        )
+
+    if segmented:
+        log.info("Using segmented request storage")
+        return SegmentRequestStorage(
+            base_dir=kwargs.get("base_dir"),
+            segment_size=kwargs.get("segment_size") or DEFAULT_SEGMENT_SIZE,
+            lazy=bool(kwargs.get("lazy")),
+            maxsize=kwargs.get("maxsize"),
+            max_bytes=kwargs.get("max_bytes"),
+            max_age=kwargs.get("max_age"),
+            write_behind=bool(kwargs.get("write_behind")),
+            write_queue_size=kwargs.get("write_queue_size") or DEFAULT_WRITE_QUEUE_SIZE,
+            writers=kwargs.get("writers") or 1,
+            dedup=bool(kwargs.get("dedup")),
+            dedup_requests=bool(kwargs.get("dedup_requests")),
+            compress=bool(kwargs.get("compress")),
+            compress_level=kwargs.get("compress_level") or DEFAULT_COMPRESS_LEVEL,
+            compress_dict_samples=kwargs.get("compress_dict_samples") or 0,
         )
 
     log.info("Using default request storage")
-    return RequestStorage(base_dir=kwargs.get("base_dir"))
+    return RequestStorage(
+        base_dir=kwargs.get("base_dir"),
+        lazy=bool(kwargs.get("lazy")),
+        maxsize=kwargs.get("maxsize"),
+        max_bytes=kwargs.get("max_bytes"),
+        max_age=kwargs.get("max_age"),
+        write_behind=bool(kwargs.get("write_behind")),
+        write_queue_size=kwargs.get("write_queue_size") or DEFAULT_WRITE_QUEUE_SIZE,
+        writers=kwargs.get("writers") or 1,
+        dedup=bool(kwargs.get("dedup")),
+        dedup_requests=bool(kwargs.get("dedup_requests")),
+        compress=bool(kwargs.get("compress")),
+        compress_level=kwargs.get("compress_level") or DEFAULT_COMPRESS_LEVEL,
+        compress_dict_samples=kwargs.get("compress_dict_samples") or 0,
+    )
 
 
 class _IndexedRequest:
-    def __init__(self, id: str, url: str, has_response: bool):
+    def __init__(self, id: str, url: str, method: str, has_response: bool = False):
         self.id = id
         self.url = url
+        self.method = method.upper()
+        self.host = (urlsplit(url).hostname or "").lower()
         self.has_response = has_response
+        self.status_code: Optional[int] = None
+        self.content_type: Optional[str] = None
+        # The order in which the request was added to the catalog.
+        self.position = 0
+        # Increases each time the request or its response is saved, see
+        # _RequestCatalog.touch().
+        self.seq = 0
+        # When the request was saved and the number of bytes written for it.
+        self.created = time.time()
+        self.size = 0
+        # Where the request, response and HAR entry were written to,
+        # keyed by record name.
+        self.locations: Dict[str, Any] = {}
+        # The content hashes of any deduplicated bodies, keyed by record name.
+        self.bodies: Dict[str, str] = {}
+        # The names of the records whose bodies were written compressed.
+        self.compressed: Set[str] = set()
+        # The names of the records restored from the journal of an earlier process,
+        # which are checked against their checksums the first time they are read.
+        self.unverified: Set[str] = set()
+        # Metadata used to create lazily loaded requests, populated by the disk backends.
+        self.headers: List[Tuple[str, str]] = []
+        self.date: Optional[datetime] = None
+        self.reason: str = ""
+        self.response_headers: List[Tuple[str, str]] = []
+        self.response_date: Optional[datetime] = None
+        self.cert: dict = {}
+
+
+def _media_type(content_type: Optional[str]) -> Optional[str]:
+    """Strip any parameters from a Content-Type header value."""
+    if not content_type:
+        return None
+    return content_type.split(";", 1)[0].strip().lower()
 
 
-class RequestStorage:
-    """Responsible for persistence of request and response data to disk.
+_get_id = operator.attrgetter("id")
 
-    This implementation writes the request and response data to disk, but keeps an in-memory
-    index for sequencing and fast retrieval.
+# Maps a key (e.g. a hostname) to the entries having that key, in insertion order.
+_SecondaryIndex = DefaultDict[Any, Dict[str, _IndexedRequest]]
+
+
+class _RequestCatalog:
+    """An index of stored requests keyed by request id.
+
+    Secondary indexes are maintained by host, method, status code and content type
+    so that filtered lookups don't need to examine every request.
+
+    Entries are also ordered by sequence number, which increases each time an entry
+    is saved or updated, so that the entries changed since a previous sequence number
+    can be found without examining every entry.
+
+    Readers polling the catalog shouldn't hold up requests being saved. Lookups by id
+    don't take the lock, relying on single dict operations being atomic as they are in
+    CPython. A snapshot of all entries is taken once after each change and shared by
+    readers until the next change, rather than each reader copying the entries.
 
     Instances are designed to be threadsafe.
     """
 
-    def __init__(self, base_dir: Optional[str] = None):
-        """Initialises a new RequestStorage using an optional base directory.
+    def __init__(self):
+        self._entries: Dict[str, _IndexedRequest] = {}
+        self._by_host: _SecondaryIndex = defaultdict(dict)
+        self._by_method: _SecondaryIndex = defaultdict(dict)
+        self._by_status: _SecondaryIndex = defaultdict(dict)
+        self._by_content_type: _SecondaryIndex = defaultdict(dict)
+        self._positions = itertools.count()
+        # Entries ordered by sequence number, which continues across clear().
+        self._by_seq = OrderedDict()  # type: ignore
+        self._seqs = itertools.count(1)
+        # Increases each time an entry is added or removed, which invalidates
+        # the snapshot of the entries.
+        self._version = 0
+        self._snapshot: Tuple[int, Tuple[_IndexedRequest, ...]] = (0, ())
+        # The number of entries that have a response.
+        self._responses = 0
+        self._lock = threading.Lock()
 
-        Args:
-            base_dir: The directory where request and response data is stored.
-                If not specified, the system temp folder is used.
+    def add(self, entry: _IndexedRequest) -> None:
+        with self._lock:
+            entry.position = next(self._positions)
+            self._entries[entry.id] = entry
+            self._by_host[entry.host][entry.id] = entry
+            self._by_method[entry.method][entry.id] = entry
+            self._version += 1
+
+    def get(self, request_id: str) -> Optional[_IndexedRequest]:
+        return self._entries.get(request_id)
+
+    def touch(self, entry: _IndexedRequest) -> None:
+        """Give an entry the next sequence number, once the entry or an update to it
+        has been saved and can be loaded.
         """
-        if base_dir is None:
-            base_dir = tempfile.gettempdir()
+        with self._lock:
+            if entry.id in self._entries:
+                entry.seq = next(self._seqs)
+                self._by_seq[entry.id] = entry
+                self._by_seq.move_to_end(entry.id)
 
-        self.home_dir: str = os.path.join(base_dir, ".wireproxy")
-        self.session_dir: str = os.path.join(
-            self.home_dir, "storage-{}".format(str(uuid.uuid4()))
-        )
-        os.makedirs(self.session_dir, exist_ok=True)
-        self._cleanup_old_dirs()
+    def since(self, cursor: int) -> Tuple[List[_IndexedRequest], int]:
+        """Get the entries added or updated since the specified sequence number.
 
-        # Index of requests received.
-        self._index: List[_IndexedRequest] = []
+        Returns: A tuple of the entries in sequence order and the sequence
+            number to pass to the next call.
+        """
+        entries = []
 
-        # Sequences of websocket messages held against the
-        # id of the originating websocket request.
-        self._ws_messages: DefaultDict[str, List] = defaultdict(list)
+        with self._lock:
+            for entry in reversed(self._by_seq.values()):
+                if entry.seq <= cursor:
+                    break
+                entries.append(entry)
 
-        self._lock = threading.Lock()
+        if not entries:
+            return entries, cursor
 
-    def save_request(self, request: Request) -> None:
-        """Save a request to storage.
+        entries.reverse()
 
-        Args:
-            request: The request to save.
+        return entries, entries[-1].seq
+
+    def set_response(self, entry: _IndexedRequest, response: Response) -> None:
+        """Record the details of a response against an entry."""
+        status_code = int(response.status_code)
+        content_type = _media_type(response.headers.get("Content-Type"))
+
+        with self._lock:
+            self._unlink(self._by_status, entry.status_code, entry.id)
+            self._unlink(self._by_content_type, entry.content_type, entry.id)
+
+            entry.status_code = status_code
+            entry.content_type = content_type
+
+            if entry.id in self._entries:
+                if not entry.has_response:
+                    self._responses += 1
+                self._by_status[status_code][entry.id] = entry
+                if content_type is not None:
+                    self._by_content_type[content_type][entry.id] = entry
+
+            entry.has_response = True
+
+    def remove(self, request_id: str) -> Optional[_IndexedRequest]:
+        with self._lock:
+            entry = self._entries.pop(request_id, None)
+
+            if entry is not None:
+                self._by_seq.pop(entry.id, None)
+                self._unlink(self._by_host, entry.host, entry.id)
+                self._unlink(self._by_method, entry.method, entry.id)
+                self._unlink(self._by_status, entry.status_code, entry.id)
+                self._unlink(self._by_content_type, entry.content_type, entry.id)
+                self._version += 1
+
+                if entry.has_response:
+                    self._responses -= 1
+
+            return entry
+
+    def _unlink(self, index: dict, key: Any, request_id: str) -> None:
+        if key is None:
+            return
+
+        ids = index.get(key)
+
+        if ids is not None:
+            ids.pop(request_id, None)
+            if not ids:
+                del index[key]
+
+    def clear(self) -> List[_IndexedRequest]:
+        """Remove all entries from the catalog and return them."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self._by_seq.clear()
+            self._by_host.clear()
+            self._by_method.clear()
+            self._by_status.clear()
+            self._by_content_type.clear()
+            self._version += 1
+            self._responses = 0
+
+        return entries
+
+    @property
+    def version(self) -> int:
+        """Increases each time an entry is added or removed."""
+        return self._version
+
+    @property
+    def responses(self) -> int:
+        """The number of entries that have a response."""
+        return self._responses
+
+    def entries(self) -> Tuple[_IndexedRequest, ...]:
+        """Get a snapshot of the entries in the order they were added. The snapshot
+        is shared with other callers, so is immutable.
         """
-        request_id = str(uuid.uuid4())
-        request_dir = self._get_request_dir(request_id)
-        os.mkdir(request_dir)
-        request.id = request_id
+        snapshot = self._snapshot
+
+        if snapshot[0] != self._version:
+            with self._lock:
+                snapshot = self._snapshot = (self._version, tuple(self._entries.values()))
+
+        return snapshot[1]
 
-        self._save(request, request_dir, "request")
+    def first(self) -> Optional[_IndexedRequest]:
+        with self._lock:
+            try:
+                return next(iter(self._entries.values()))
+            except StopIteration:
+                return None
 
+    def last(self) -> Optional[_IndexedRequest]:
         with self._lock:
-            self._index.append(
-                _IndexedRequest(id=request_id, url=request.url, has_response=False)
+            try:
+                return next(reversed(self._entries.values()))
+            except StopIteration:
+                return None
+
+    def select(
+        self,
+        pat: Optional[str] = None,
+        *,
+        has_response: Optional[bool] = None,
+        host: Optional[str] = None,
+        method: Optional[str] = None,
+        status_code: Optional[int] = None,
+        content_type: Optional[str] = None,
+    ) -> Iterator[_IndexedRequest]:
+        """Select the entries matching all of the supplied criteria.
+
+        The secondary indexes are used to narrow down the candidates before
+        any pattern is searched in the URLs of the remaining entries.
+
+        Returns: An iterator of entries in the order they were added.
+        """
+        filters = []
+
+        if host is not None:
+            filters.append((self._by_host, "host", host.lower()))
+        if method is not None:
+            filters.append((self._by_method, "method", method.upper()))
+        if status_code is not None:
+            filters.append((self._by_status, "status_code", int(status_code)))
+        if content_type is not None:
+            filters.append(
+                (self._by_content_type, "content_type", _media_type(content_type))
             )
 
-    def _save(
-        self, obj: Union[Request, Response, dict], dirname: str, filename: str
-    ) -> None:
-        with open(os.path.join(dirname, filename), "wb") as out:
-            pickle.dump(obj, out)
+        if filters:
+            with self._lock:
+                # Start with the smallest matching set and check the other criteria
+                # against the attributes of each entry.
+                candidates = list(
+                    min((index.get(key, {}) for index, _, key in filters), key=len).values()
+                )
+
+            candidates.sort(key=lambda e: e.position)
+        else:
+            candidates = self.entries()
+
+        search = re.compile(pat).search if pat is not None else None
+
+        for entry in candidates:
+            if has_response is not None and entry.has_response != has_response:
+                continue
+            if any(getattr(entry, attr) != key for _, attr, key in filters):
+                continue
+            if search is not None and not search(entry.url):
+                continue
+            yield entry
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Listeners:
+    """The listeners notified when requests and responses are saved.
+
+    Listeners are called on the thread that saved the request or response,
+    so they should return quickly.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self):
+        # Replaced rather than modified so that it can be iterated without a lock
+        self._listeners: Tuple[Callable[[str, str, str], None], ...] = ()
+        self._lock = threading.Lock()
+
+    def add(self, listener: Callable[[str, str, str], None]) -> None:
+        with self._lock:
+            self._listeners += (listener,)
+
+    def remove(self, listener: Callable[[str, str, str], None]) -> None:
+        with self._lock:
+            self._listeners = tuple(l for l in self._listeners if l != listener)
+
+    def notify(self, event: str, request_id: str, url: str) -> None:
+        for listener in self._listeners:
+            try:
+                listener(event, request_id, url)
+            except Exception:
+                log.exception("Error notifying storage listener of %s", event)
+
+
+class _Meter:
+    """Keeps the running totals reported by stats(), which are updated as requests
+    are saved and removed rather than computed by examining the requests held.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self):
+        self._bytes_by_host: DefaultDict[str, int] = defaultdict(int)
+        self._ws_messages = 0
+        self._ws_bytes = 0
+        self._saves = 0
+        self._save_time = 0.0
+        self._lock = threading.Lock()
+
+    def add_bytes(self, host: str, size: int) -> None:
+        """Add bytes held for a request to its host, or remove them if negative."""
+        with self._lock:
+            total = self._bytes_by_host[host] + size
+
+            if total:
+                self._bytes_by_host[host] = total
+            else:
+                del self._bytes_by_host[host]
+
+    def clear_bytes(self) -> None:
+        with self._lock:
+            self._bytes_by_host.clear()
+
+    def add_ws_message(self, size: int) -> None:
+        with self._lock:
+            self._ws_messages += 1
+            self._ws_bytes += size
+
+    def add_save(self, start: float) -> None:
+        """Record the time taken by a save that began at the specified
+        time.perf_counter() value.
+        """
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._saves += 1
+            self._save_time += elapsed
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "bytes_by_host": dict(self._bytes_by_host),
+                "ws_messages": self._ws_messages,
+                "ws_bytes": self._ws_bytes,
+                "save_latency_ms": (
+                    self._save_time / self._saves * 1000 if self._saves else 0.0
+                ),
+            }
 
-    def save_response(self, request_id: str, response: Response) -> None:
-        """Save a response to storage against a request with the specified id.
+
+class _Housekeeper:
+    """Runs a storage maintenance task periodically on a background thread.
+
+    The task can also be run early by calling wakeup().
+    """
+
+    def __init__(self, name: str, task: Callable[[], None], interval: float):
+        self._task = task
+        self._interval = interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+        t = threading.Thread(name=name, target=self._run)
+        t.daemon = True
+        t.start()
+
+    def wakeup(self) -> None:
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+            if self._stopped.is_set():
+                break
+
+            try:
+                self._task()
+            except Exception:
+                log.exception("Error running storage maintenance")
+
+
+class _Reaper:
+    """Deletes discarded directories on a background thread.
+
+    Directories are first renamed within their parent, which is atomic and takes
+    constant time however many files they contain, so that callers never wait
+    for a large directory tree to be deleted.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        # The home directories already swept for stale directories
+        self._swept: Set[str] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # The number of tasks queued or in progress, and notified when it reaches zero.
+        self._pending = 0
+        self._done = threading.Condition(self._lock)
+
+    def move_aside(self, path: str) -> str:
+        """Rename a directory so that it can be deleted later.
 
         Args:
-            request_id: The id of the original request.
-            response: The response to save.
+            path: The directory.
+        Returns: The path the directory was renamed to.
+        Raises:
+            OSError: If the directory couldn't be renamed, e.g. because files
+                in it are open on Windows.
         """
-        indexed_request = self._get_indexed_request(request_id)
+        trash = os.path.join(
+            os.path.dirname(path), "{}{}".format(TRASH_DIR_PREFIX, uuid.uuid4())
+        )
+        os.rename(path, trash)
 
-        if indexed_request is None:
-            log.debug(
-                "Cannot save response as request %s is no longer stored", request_id
-            )
-            return
+        return trash
 
-        request_dir = self._get_request_dir(request_id)
+    def discard(self, path: str) -> None:
+        """Delete a directory in the background, moving it aside first if possible."""
+        try:
+            path = self.move_aside(path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            log.debug("Unable to move %s aside: %s", path, e)
 
-        self._save(response, request_dir, "response")
+        self.reap(path)
 
-        indexed_request.has_response = True
+    def reap(self, path: str) -> None:
+        """Delete a directory that has been moved aside in the background."""
+        self._put(self._remove, path)
 
-    def _get_indexed_request(self, request_id: str) -> Optional[_IndexedRequest]:
+    def sweep(self, home_dir: str) -> None:
+        """Delete any trash and any storage directories not modified recently from
+        the specified home directory in the background. Each home directory is only
+        swept once.
+        """
         with self._lock:
-            index = self._index[:]
+            if home_dir in self._swept:
+                return
+            self._swept.add(home_dir)
 
-        for indexed_request in index:
-            if indexed_request.id == request_id:
-                return indexed_request
-
-        return None
+        self._put(self._sweep, home_dir)
 
-    def save_ws_message(self, request_id: str, message: WebSocketMessage) -> None:
-        """Save a websocket message against a request with the specified id.
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until all directories queued for deletion have been deleted.
 
         Args:
-            request_id: The id of the original handshake request.
-            message: The websocket message to save.
+            timeout: The maximum number of seconds to wait. Default no limit.
+        Returns: True if all directories were deleted, False if the timeout
+            expired first.
         """
+        with self._done:
+            return self._done.wait_for(lambda: not self._pending, timeout)
+
+    def _put(self, task: Callable[[str], None], path: str) -> None:
         with self._lock:
-            self._ws_messages[request_id].append(message)
+            if self._thread is None:
+                self._thread = threading.Thread(name="Wire Proxy Reaper", target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
 
-    def save_har_entry(self, request_id: str, entry: dict) -> None:
-        """Save a HAR entry to storage against a request with the specified id.
+            self._pending += 1
+
+        self._queue.put((task, path))
+
+    def _run(self) -> None:
+        while True:
+            task, path = self._queue.get()
+
+            try:
+                task(path)
+            except Exception:
+                log.exception("Error removing %s", path)
+            finally:
+                with self._done:
+                    self._pending -= 1
+
+                    if not self._pending:
+                        self._done.notify_all()
+
+    def _remove(self, path: str) -> None:
+        shutil.rmtree(path, ignore_errors=True)
+
+        try:
+            # Attempt to remove the parent folder if it is empty
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            # Parent folder not empty
+            pass
+
+    def _sweep(self, home_dir: str) -> None:
+        cutoff = (datetime.now() - timedelta(days=REMOVE_DATA_OLDER_THAN_DAYS)).timestamp()
+
+        try:
+            names = os.listdir(home_dir)
+        except FileNotFoundError:
+            return
+
+        for name in names:
+            path = os.path.join(home_dir, name)
+
+            try:
+                if not os.path.isdir(path):
+                    continue
+
+                # Trash may have been left behind by a process that exited
+                # before its reaper had finished.
+                if name.startswith(TRASH_DIR_PREFIX) or _last_alive(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                # Can happen if multiple instances are run concurrently
+                pass
+
+
+class _Heartbeat:
+    """Marks the storage directories in use as alive by periodically touching a
+    heartbeat file in each, which the reaper checks before sweeping a directory.
+
+    The modification time of a directory itself only changes when entries are added
+    to or removed from it, which for a segment log is only when it rolls over to a
+    new segment, so it says little about whether the directory is still in use.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self):
+        self._paths: Set[str] = set()
+        self._housekeeper: Optional[_Housekeeper] = None
+        self._lock = threading.Lock()
+
+    def add(self, path: str) -> None:
+        """Start marking a directory as alive, touching its heartbeat file straight away.
 
         Args:
-            request_id: The id of the original request.
-            entry: The HAR entry to save.
+            path: The directory, which must exist.
         """
-        indexed_request = self._get_indexed_request(request_id)
+        _touch(os.path.join(path, HEARTBEAT_FILE))
 
-        if indexed_request is None:
-            log.debug(
-                "Cannot save HAR entry as request %s is no longer stored", request_id
-            )
+        with self._lock:
+            self._paths.add(path)
+
+            if self._housekeeper is None:
+                self._housekeeper = _Housekeeper(
+                    "Wire Proxy Heartbeat", self._beat, HEARTBEAT_INTERVAL
+                )
+
+    def remove(self, path: str) -> None:
+        """Stop marking a directory as alive."""
+        with self._lock:
+            self._paths.discard(path)
+
+    def _beat(self) -> None:
+        with self._lock:
+            paths = list(self._paths)
+
+        for path in paths:
+            try:
+                _touch(os.path.join(path, HEARTBEAT_FILE))
+            except OSError as e:
+                # E.g. the directory is being moved aside to be cleared
+                log.debug("Unable to touch the heartbeat file in %s: %s", path, e)
+
+
+# Shared by all storage instances.
+_reaper = _Reaper()
+_heartbeat = _Heartbeat()
+
+
+def _touch(path: str) -> None:
+    with open(path, "a"):
+        pass
+
+    os.utime(path)
+
+
+def _last_alive(path: str) -> float:
+    """Get the time a storage directory was last known to be in use."""
+    try:
+        return os.path.getmtime(os.path.join(path, HEARTBEAT_FILE))
+    except FileNotFoundError:
+        # Not a storage directory, or left behind by a version without heartbeats
+        return os.path.getmtime(path)
+
+
+def _make_dirs(path: str) -> None:
+    """Create a directory and any missing parents, allowing for the reaper removing
+    an empty parent concurrently.
+    """
+    for _ in range(3):
+        try:
+            os.makedirs(path, exist_ok=True)
             return
+        except FileNotFoundError:
+            continue
 
-        request_dir = self._get_request_dir(request_id)
+    os.makedirs(path, exist_ok=True)
+
+
+class _WriteQueue:
+    """Writes records on background threads so that saving doesn't block the caller.
+
+    Records waiting to be written are held so that they can still be read. When the
+    queue is full, callers block until there is space (backpressure).
+    """
+
+    def __init__(
+        self,
+        write: Callable[[_IndexedRequest, str, Any], None],
+        maxsize: int,
+        workers: int,
+    ):
+        self._write = write
+        self._queue: queue.Queue = queue.Queue(maxsize)
+        self._pending: Dict[Tuple[str, str], Any] = {}
+        # The number of bytes of bodies waiting to be written.
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+        for i in range(workers):
+            t = threading.Thread(
+                name="Wire Proxy Storage Writer {}".format(i), target=self._run
+            )
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def put(self, indexed_request: _IndexedRequest, name: str, obj: Any) -> None:
+        with self._lock:
+            self._pending[(indexed_request.id, name)] = obj
+            self._bytes += len(getattr(obj, "body", b""))
+
+        self._queue.put((indexed_request, name, obj))
+
+    def get(self, request_id: str, name: str) -> Optional[Any]:
+        """Get a record that has not yet been written, or None if there is no such record."""
+        with self._lock:
+            return self._pending.get((request_id, name))
+
+    def clear(self) -> None:
+        """Forget the records waiting to be written. They will still be written."""
+        with self._lock:
+            self._pending.clear()
+
+    def flush(self) -> None:
+        """Block until all queued records have been written."""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Write any queued records and stop the writer threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+
+        for t in self._threads:
+            t.join()
+
+    @property
+    def bytes(self) -> int:
+        """The number of bytes of bodies waiting to be written."""
+        return self._bytes
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                self._queue.task_done()
+                break
+
+            indexed_request, name, obj = item
+
+            try:
+                self._write(indexed_request, name, obj)
+            except Exception:
+                log.exception(
+                    "Error writing %s for request %s", name, indexed_request.id
+                )
+            finally:
+                with self._lock:
+                    key = (indexed_request.id, name)
+                    if self._pending.get(key) is obj:
+                        del self._pending[key]
+                    self._bytes -= len(getattr(obj, "body", b""))
+
+                self._queue.task_done()
+
+
+class _BodyStore:
+    """Holds bodies by content hash so that identical bodies are only stored once.
+
+    Each body is reference counted and removed once the last reference to it
+    has been released. The store delegates the actual storage of a body to the
+    supplied callables, which allows the same bookkeeping to be used for bodies
+    held on disk and in memory.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[str, bytes], Tuple[Any, int]],
+        read: Callable[[Any], bytes],
+        remove: Callable[[Any], None],
+    ):
+        """Initialise a new _BodyStore.
+
+        Args:
+            write: Stores a body given its content hash and the body, and returns
+                its location and the number of bytes used to store it.
+            read: Reads a body given its location.
+            remove: Removes a body given its location.
+        """
+        self._write = write
+        self._read = read
+        self._remove = remove
+        # Maps a content hash to the location, reference count, stored size
+        # and size of the body.
+        self._bodies: Dict[str, list] = {}
+        # Set once a body currently being written, keyed by content hash, is held.
+        self._writing: Dict[str, threading.Event] = {}
+        # The number of bytes not stored because an identical body was already held.
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, body: bytes) -> Tuple[str, int]:
+        """Add a reference to a body, storing it if it isn't already held.
+
+        Args:
+            body: The body.
+        Returns: A tuple of the content hash of the body and the number of bytes
+            stored, which is zero if an identical body was already held.
+        """
+        digest = hashlib.sha256(body).hexdigest()
+
+        while True:
+            with self._lock:
+                held = self._bodies.get(digest)
+
+                if held is not None:
+                    held[1] += 1
+                    self.bytes_saved += held[3]
+                    return digest, 0
+
+                writing = self._writing.get(digest)
+
+                if writing is None:
+                    writing = self._writing[digest] = threading.Event()
+                    break
+
+            # An identical body is being written by another thread
+            writing.wait()
+
+        # Written without the lock, so that bodies with different content
+        # can be written (and compressed) concurrently.
+        try:
+            location, size = self._write(digest, body)
+
+            with self._lock:
+                self._bodies[digest] = [location, 1, size, len(body)]
+        finally:
+            with self._lock:
+                del self._writing[digest]
+            writing.set()
+
+        return digest, size
+
+    def read(self, digest: str) -> bytes:
+        """Read a body previously added with acquire()."""
+        with self._lock:
+            held = self._bodies.get(digest)
+
+        if held is None:
+            raise FileNotFoundError("Body {} is no longer stored".format(digest))
+
+        return self._read(held[0])
+
+    def release(self, digest: str) -> int:
+        """Remove a reference to a body, removing the body once it is unreferenced.
+
+        Args:
+            digest: The content hash returned by acquire().
+        Returns: The number of stored bytes removed.
+        """
+        with self._lock:
+            held = self._bodies.get(digest)
+
+            if held is None:
+                return 0
+
+            held[1] -= 1
+
+            if held[1] > 0:
+                self.bytes_saved -= held[3]
+                return 0
+
+            del self._bodies[digest]
+
+        self._remove(held[0])
+
+        return held[2]
+
+    def clear(self) -> None:
+        """Forget all bodies without removing them, e.g. when their backing
+        storage has already been discarded.
+        """
+        with self._lock:
+            self._bodies.clear()
+            self.bytes_saved = 0
+
+    def restore(self, digest: str, location: Any, refs: int, size: int, length: int) -> None:
+        """Hold a body that was stored previously, e.g. by a storage session
+        that is being reopened.
+
+        Args:
+            digest: The content hash of the body.
+            location: The location the body was stored at.
+            refs: The number of references to the body.
+            size: The number of bytes used to store the body.
+            length: The size of the body.
+        """
+        with self._lock:
+            self._bodies[digest] = [location, refs, size, length]
+            self.bytes_saved += (refs - 1) * length
+
+    def __len__(self):
+        return len(self._bodies)
+
+
+class _Compressor:
+    """Compresses bodies with zstd.
+
+    A dictionary can optionally be trained on the first bodies compressed, which
+    greatly improves the compression of small, repetitive bodies such as JSON API
+    responses. Bodies compressed before the dictionary is available are compressed
+    without it, and as each zstd frame records the id of the dictionary it was
+    compressed with, bodies can always be decompressed.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(
+        self,
+        level: int,
+        dict_samples: int,
+        dictionary: Optional[bytes] = None,
+        on_trained: Optional[Callable[[bytes], None]] = None,
+    ):
+        """Initialise a new _Compressor.
+
+        Args:
+            level: The zstd compression level.
+            dict_samples: The number of bodies to train a dictionary on, or zero
+                to compress without a dictionary.
+            dictionary: A previously trained dictionary to use rather than
+                training a new one.
+            on_trained: Called with the dictionary once it has been trained,
+                before any body is compressed with it.
+        """
+        self._level = level
+        self._dict_samples = dict_samples
+        self._samples: List[bytes] = []
+        self._dict: Optional[zstd.ZstdCompressionDict] = None
+        self._on_trained = on_trained
+
+        if dictionary is not None:
+            self._dict = zstd.ZstdCompressionDict(dictionary)
+            self._dict_samples = 0
+        # zstd compressors and decompressors can't be shared between threads
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def compress(self, body: bytes) -> bytes:
+        """Compress a body, training the dictionary first if enough samples have
+        been collected.
+        """
+        if self._dict is None and self._dict_samples > 0:
+            self._sample(body)
+
+        compressor = self._get("compressor", self._dict)
+
+        if compressor is None:
+            compressor = zstd.ZstdCompressor(level=self._level, dict_data=self._dict)
+            self._set("compressor", self._dict, compressor)
+
+        return compressor.compress(body)
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress a body previously compressed with compress()."""
+        dict_data = None
+
+        if zstd.get_frame_parameters(data).dict_id:
+            dict_data = self._dict
+
+        decompressor = self._get("decompressor", dict_data)
+
+        if decompressor is None:
+            decompressor = zstd.ZstdDecompressor(dict_data=dict_data)
+            self._set("decompressor", dict_data, decompressor)
+
+        return decompressor.decompress(data)
+
+    def _sample(self, body: bytes) -> None:
+        with self._lock:
+            if self._dict_samples <= 0:
+                return
+
+            self._samples.append(body)
+
+            if len(self._samples) < self._dict_samples:
+                return
+
+            samples, self._samples = self._samples, []
+            # Only train once, even if training fails
+            self._dict_samples = 0
+
+        try:
+            dict_data = zstd.train_dictionary(COMPRESS_DICT_SIZE, samples)
+            log.debug(
+                "Trained a %s byte compression dictionary on %s bodies",
+                len(dict_data.as_bytes()),
+                len(samples),
+            )
+        except zstd.ZstdError as e:
+            log.warning("Unable to train a compression dictionary: %s", e)
+            return
+
+        if self._on_trained is not None:
+            self._on_trained(dict_data.as_bytes())
+
+        self._dict = dict_data
+
+    @property
+    def dictionary(self) -> Optional[bytes]:
+        """The trained dictionary, or None if no dictionary has been trained."""
+        return self._dict.as_bytes() if self._dict is not None else None
+
+    def _get(self, kind: str, dict_data: Optional[zstd.ZstdCompressionDict]):
+        cached = getattr(self._local, kind, None)
+
+        if cached is not None and cached[0] is dict_data:
+            return cached[1]
+
+        return None
+
+    def _set(self, kind: str, dict_data: Optional[zstd.ZstdCompressionDict], obj):
+        setattr(self._local, kind, (dict_data, obj))
+
+
+class RequestStorage:
+    """Responsible for persistence of request and response data to disk.
+
+    This implementation writes the request and response data to disk, but keeps an in-memory
+    catalog of requests for sequencing and fast retrieval.
+
+    By default requests are kept for the lifetime of the storage. Retention can be limited
+    by number of requests, bytes on disk and age, in which case the oldest requests are
+    removed in the background once a limit is exceeded.
+
+    Records can optionally be written to disk by background writer threads (write-behind),
+    in which case saving a request or response only involves updating the in-memory index.
+
+    Bodies can optionally be deduplicated, in which case they are stored by content hash
+    and identical bodies are only written once. They can also be compressed, in which
+    case they are only decompressed when first accessed.
+
+    The index is also appended to a journal in the session directory as records are
+    written, so that the session can be reopened with open() should the process die
+    before cleanup() is called.
+
+    Websocket messages are appended to a file per connection, with only the most
+    recent messages held in memory. Older messages are read back a page at a time
+    when the ws_messages of a loaded request are accessed.
+
+    Instances are designed to be threadsafe.
+    """
+
+    # The name recorded in the journal to identify the backend.
+    _backend = "directory"
+
+    def __init__(
+        self,
+        base_dir: Optional[str] = None,
+        lazy: bool = False,
+        maxsize: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        write_behind: bool = False,
+        write_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE,
+        writers: int = 1,
+        dedup: bool = False,
+        dedup_requests: bool = False,
+        compress: bool = False,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+        compress_dict_samples: int = 0,
+        session_dir: Optional[str] = None,
+    ):
+        """Initialises a new RequestStorage using an optional base directory.
+
+        Args:
+            base_dir: The directory where request and response data is stored.
+                If not specified, the system temp folder is used.
+            lazy: Whether load_requests() and iter_requests() return lazily loaded
+                requests by default. See load_requests().
+            maxsize: The maximum number of requests to retain. Default no limit.
+            max_bytes: The maximum number of bytes of request, response and HAR data
+                to retain on disk. Default no limit.
+            max_age: The maximum time in seconds to retain a request for after it
+                was saved. Default no limit.
+            write_behind: When True, records are written to disk by background writer
+                threads rather than by the thread saving them. Default False.
+            write_queue_size: The number of records that may be waiting to be written
+                before saving blocks. Only applies when write_behind is True.
+            writers: The number of background writer threads. Only applies when
+                write_behind is True.
+            dedup: When True, response bodies are stored by content hash so that
+                identical bodies are only written once. Default False.
+            dedup_requests: When True, request bodies are also deduplicated.
+                Default False.
+            compress: When True, request and response bodies are compressed with
+                zstd. Default False.
+            compress_level: The zstd compression level. Only applies when compress
+                is True.
+            compress_dict_samples: The number of bodies to train a compression
+                dictionary on. Bodies saved after that are compressed using the
+                dictionary. Default 0, which means no dictionary is used. Only
+                applies when compress is True.
+            session_dir: An existing session directory to use rather than creating
+                a new one. Use open() to reopen the session of a previous storage.
+        """
+        if session_dir is None:
+            if base_dir is None:
+                base_dir = tempfile.gettempdir()
+
+            self.home_dir: str = os.path.join(base_dir, ".wireproxy")
+            self.session_dir: str = os.path.join(
+                self.home_dir, "storage-{}".format(str(uuid.uuid4()))
+            )
+        else:
+            self.home_dir = os.path.dirname(session_dir)
+            self.session_dir = session_dir
+
+        _make_dirs(self.session_dir)
+        _heartbeat.add(self.session_dir)
+        _reaper.sweep(self.home_dir)
+
+        self.lazy = lazy
+
+        # Index of requests received.
+        self._index = _RequestCatalog()
+
+        # Logs of websocket messages held against the
+        # id of the originating websocket request.
+        self._ws_messages: Dict[str, MessageLog] = {}
+
+        self._maxsize = sys.maxsize if maxsize is None else maxsize
+        self._max_bytes = sys.maxsize if max_bytes is None else max_bytes
+        self._max_age = max_age
+        # The number of bytes written for the requests currently retained.
+        self._bytes = 0
+        # The number of bytes saved by compressing bodies.
+        self._compression_saved = 0
+        # The number of bytes of websocket messages held in memory until written.
+        self._ws_tail_bytes = 0
+        # The number of requests removed due to retention limits.
+        self._evictions = 0
+        # Increases each time the storage is cleared.
+        self._generation = 0
+        self._meter = _Meter()
+
+        self._lock = threading.Lock()
+
+        self._housekeeper: Optional[_Housekeeper] = None
+
+        if maxsize is not None or max_bytes is not None or max_age is not None:
+            self._housekeeper = _Housekeeper(
+                "Wire Proxy Storage Retention",
+                self._enforce_retention,
+                RETENTION_INTERVAL,
+            )
+
+        self._write_queue: Optional[_WriteQueue] = None
+
+        if write_behind:
+            self._write_queue = _WriteQueue(
+                self._write_record, write_queue_size, writers
+            )
+
+        # The names of the records whose bodies are deduplicated.
+        self._dedup_names = set()
+
+        if dedup:
+            self._dedup_names.add("response")
+        if dedup_requests:
+            self._dedup_names.add("request")
+
+        self._compressor: Optional[_Compressor] = None
+
+        if compress:
+            self._compressor = _Compressor(
+                compress_level,
+                compress_dict_samples,
+                dictionary=self._read_dictionary(),
+                on_trained=self._write_dictionary,
+            )
+
+        self._body_store = _BodyStore(
+            self._store_body, self._read_stored_body, self._remove_body
+        )
+
+        self._listeners = _Listeners()
+
+        journal_path = os.path.join(self.session_dir, JOURNAL_FILE)
+        new_session = not os.path.exists(journal_path)
+        self._journal = journal.Journal(journal_path)
+        self._journal_header = {
+            "op": "session",
+            "version": JOURNAL_VERSION,
+            "backend": self._backend,
+            "compress": compress,
+            "compress_level": compress_level,
+        }
+
+        if new_session:
+            self._journal.append(self._journal_header)
+
+    @classmethod
+    def open(cls, session_dir: str, **kwargs) -> "RequestStorage":
+        """Reopen the session directory of a storage that was not cleaned up, e.g.
+        because the process died, so that the requests it held can be loaded.
+
+        The index is rebuilt from the session's journal without reading any request
+        or response data. Any requests saved afterwards are added to the same session,
+        which is only removed if cleanup() is called.
+
+        Certificate details are not journaled, so are only available on requests
+        that are not lazily loaded. Websocket messages still held in memory when the
+        process died are lost.
+
+        Args:
+            session_dir: The session directory of the original storage, available
+                as its session_dir attribute.
+            kwargs: Any other arguments to initialise the storage with, except
+                base_dir. Compression defaults to the settings of the original
+                storage.
+        Returns: A storage of the same type as the original storage.
+        Raises:
+            FileNotFoundError: If the session directory has no journal.
+            ValueError: If the journal was not written by a storage session.
+        """
+        entries = journal.read(os.path.join(session_dir, JOURNAL_FILE))
+
+        if not entries or entries[0].get("op") != "session":
+            raise ValueError("{} is not a storage session".format(session_dir))
+
+        header = entries[0]
+
+        if header["version"] > JOURNAL_VERSION:
+            raise ValueError(
+                "Unsupported journal version {} in {}".format(header["version"], session_dir)
+            )
+
+        storage_cls = _BACKENDS[header["backend"]]
+        kwargs.setdefault("compress", header["compress"])
+        kwargs.setdefault("compress_level", header["compress_level"])
+
+        # Prevent the session being removed as old by other storage instances
+        os.utime(session_dir)
+
+        storage = storage_cls(session_dir=session_dir, **kwargs)
+        storage._restore(entries[1:])
+
+        log.info("Reopened %s with %s requests", session_dir, len(storage._index))
+
+        return storage
+
+    def _restore(self, entries: List[dict]) -> None:
+        """Rebuild the index from the entries of the session's journal."""
+        restored: Dict[str, _IndexedRequest] = {}
+        # Maps a content hash to the location, reference count, stored size
+        # and size of the body, as held by the body store.
+        bodies: Dict[str, list] = {}
+
+        for entry in entries:
+            op = entry["op"]
+            # Like the live count, this includes bodies that are no longer retained
+            self._compression_saved += entry.get("saved", 0)
+
+            if op == "request":
+                indexed_request = _IndexedRequest(entry["id"], entry["url"], entry["method"])
+                indexed_request.created = entry["created"]
+                indexed_request.headers = [tuple(h) for h in entry["headers"]]
+                indexed_request.date = datetime.fromtimestamp(entry["date"])
+                restored[indexed_request.id] = indexed_request
+            elif op == "response" and entry["id"] in restored:
+                indexed_request = restored[entry["id"]]
+                indexed_request.status_code = entry["status_code"]
+                indexed_request.reason = entry["reason"]
+                indexed_request.response_headers = [tuple(h) for h in entry["headers"]]
+                indexed_request.response_date = datetime.fromtimestamp(entry["date"])
+            elif op == "body":
+                bodies[entry["digest"]] = [
+                    self._load_location(entry["location"]),
+                    0,
+                    entry["size"],
+                    entry["length"],
+                ]
+                continue
+            elif op == "remove":
+                restored.pop(entry["id"], None)
+                continue
+            elif op == "clear":
+                restored.clear()
+                bodies.clear()
+                continue
+
+            indexed_request = restored.get(entry["id"])
+
+            if indexed_request is None:
+                # Written after the request was removed
+                continue
+
+            indexed_request.locations[op] = self._load_location(entry["location"])
+            indexed_request.unverified.add(op)
+            indexed_request.size += entry["size"]
+
+            if "body" in entry:
+                indexed_request.bodies[op] = entry["body"]
+            if entry.get("compressed"):
+                indexed_request.compressed.add(op)
+
+        self._restore_ws_messages(restored)
+
+        for indexed_request in restored.values():
+            self._index.add(indexed_request)
+
+            if indexed_request.status_code is not None:
+                # Marks the request as having a response
+                self._index.set_response(
+                    indexed_request,
+                    Response(
+                        status_code=indexed_request.status_code,
+                        reason=indexed_request.reason,
+                        headers=indexed_request.response_headers,
+                    ),
+                )
+
+            self._index.touch(indexed_request)
+            self._bytes += indexed_request.size
+            self._meter.add_bytes(indexed_request.host, indexed_request.size)
+
+            for digest in indexed_request.bodies.values():
+                bodies[digest][1] += 1
+
+        self._retain(
+            [
+                location
+                for indexed_request in restored.values()
+                for location in indexed_request.locations.values()
+            ]
+            + [held[0] for held in bodies.values()]
+        )
+
+        for digest, (location, refs, size, length) in bodies.items():
+            if refs:
+                self._body_store.restore(digest, location, refs, size, length)
+                self._bytes += size
+            else:
+                # Its last reference was removed, but the process died before
+                # the body itself was
+                self._remove_body(location)
+
+    def _restore_ws_messages(self, restored: Dict[str, _IndexedRequest]) -> None:
+        """Reattach the websocket message logs of the restored requests."""
+        for name in os.listdir(self.session_dir):
+            match = re.match(r"websocket-(.+)\.log$", name)
+
+            if match is None:
+                continue
+
+            indexed_request = restored.get(match.group(1))
+            path = os.path.join(self.session_dir, name)
+
+            if indexed_request is None:
+                # The request was removed but the process died before its log was
+                os.remove(path)
+                continue
+
+            messages = MessageLog(path)
+            self._ws_messages[indexed_request.id] = messages
+            indexed_request.size += messages.size
+
+    def _retain(self, locations: List[Any]) -> None:
+        """Called with the locations of all records and bodies that are retained
+        when a session is reopened.
+        """
+        pass
+
+    def _dump_location(self, location: Any) -> Any:
+        """Convert a location into a form that can be written to the journal.
+
+        Locations are relative to the session directory so that it can be moved.
+        """
+        return os.path.relpath(location, self.session_dir)
+
+    def _load_location(self, value: Any) -> Any:
+        """Convert a location read from the journal back into a location."""
+        return os.path.join(self.session_dir, value)
+
+    def _read_dictionary(self) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.session_dir, COMPRESS_DICT_FILE), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_dictionary(self, dict_data: bytes) -> None:
+        with open(os.path.join(self.session_dir, COMPRESS_DICT_FILE), "wb") as out:
+            out.write(dict_data)
+
+    def save_request(self, request: Request) -> None:
+        """Save a request to storage.
+
+        Args:
+            request: The request to save.
+        """
+        request_id = str(uuid.uuid4())
+        request.id = request_id
+
+        indexed_request = _IndexedRequest(
+            id=request_id, url=request.url, method=request.method
+        )
+        indexed_request.headers = list(request.headers.items())
+        indexed_request.date = request.date
+
+        self._index.add(indexed_request)
+        self._save(request, indexed_request, "request")
+        self._index.touch(indexed_request)
+        self._check_retention()
+        self._listeners.notify(REQUEST_SAVED, request_id, request.url)
+
+    def _save(
+        self,
+        obj: Union[Request, Response, dict],
+        indexed_request: _IndexedRequest,
+        name: str,
+    ) -> None:
+        start = time.perf_counter()
+
+        if self._write_queue is not None:
+            self._write_queue.put(indexed_request, name, obj)
+        else:
+            self._write_record(indexed_request, name, obj)
+
+        self._meter.add_save(start)
+
+    def _write_record(
+        self,
+        indexed_request: _IndexedRequest,
+        name: str,
+        obj: Union[Request, Response, dict],
+    ) -> None:
+        if self._write_queue is not None and self._index.get(indexed_request.id) is None:
+            # The request was removed while the record was waiting to be written
+            return
+
+        generation = self._generation
+        digest = None
+        stored = 0
+        saved = 0
+
+        if name in self._dedup_names and len(obj.body) >= DEDUP_MIN_BODY_SIZE:
+            try:
+                digest, stored = self._body_store.acquire(obj.body)
+            except OSError:
+                if generation == self._generation:
+                    raise
+                # The session directory was swapped while the body was written
+                return
+
+            # The record is written without the body, which is held by the body store
+            obj = copy.copy(obj)
+            obj.body = b""
+        elif (
+            self._compressor is not None
+            and name in ("request", "response")
+            and len(obj.body) >= COMPRESS_MIN_BODY_SIZE
+        ):
+            compressed = self._compressor.compress(obj.body)
+
+            # Incompressible bodies (e.g. images) are kept as they are
+            if len(compressed) < len(obj.body):
+                saved = len(obj.body) - len(compressed)
+                indexed_request.compressed.add(name)
+                obj = copy.copy(obj)
+                obj.body = compressed
+
+        data = records.encode(obj)
+
+        try:
+            location = self._write(indexed_request.id, name, data)
+        except OSError:
+            if generation == self._generation:
+                raise
+            # The session directory was swapped while the record was written,
+            # which may have left the record in the new session
+            self._remove_record(indexed_request.id, None)
+            return
+
+        with self._lock:
+            # Checked under the lock that retention holds while deducting the size
+            # of a request it has removed, so the record is either counted and later
+            # deducted with the request, or not counted at all. Clearing holds it
+            # while swapping the session, so the record is journaled in the session
+            # of the request.
+            removed = self._index.get(indexed_request.id) is not indexed_request
+            cleared = generation != self._generation
+
+            if not removed:
+                if digest is not None:
+                    indexed_request.bodies[name] = digest
+                indexed_request.locations[name] = location
+                indexed_request.size += len(data)
+                self._bytes += len(data) + stored
+                self._compression_saved += saved
+                self._journal_record(indexed_request, name, obj, location, len(data), saved)
+
+        if removed:
+            # The request was removed while the record was being written
+            self._remove_record(indexed_request.id, location)
+
+            # A body stored before the storage was cleared went with it
+            if digest is not None and not cleared:
+                released = self._body_store.release(digest)
+
+                with self._lock:
+                    self._bytes += stored - released
+            return
+
+        self._meter.add_bytes(indexed_request.host, len(data))
+
+    def _journal_record(
+        self,
+        indexed_request: _IndexedRequest,
+        name: str,
+        obj: Union[Request, Response, dict],
+        location: Any,
+        size: int,
+        saved: int,
+    ) -> None:
+        """Append the details of a record that has been written to the journal."""
+        entry = {
+            "op": name,
+            "id": indexed_request.id,
+            "location": self._dump_location(location),
+            "size": size,
+        }
+
+        if name in indexed_request.bodies:
+            entry["body"] = indexed_request.bodies[name]
+        if name in indexed_request.compressed:
+            entry["compressed"] = True
+            entry["saved"] = saved
+
+        if name == "request":
+            entry.update(
+                url=obj.url,
+                method=obj.method,
+                headers=obj.headers.raw_items(),
+                date=obj.date.timestamp(),
+                created=indexed_request.created,
+            )
+        elif name == "response":
+            entry.update(
+                status_code=int(obj.status_code),
+                reason=obj.reason,
+                headers=obj.headers.raw_items(),
+                date=obj.date.timestamp(),
+            )
+
+        self._journal.append(entry)
+
+    def _write(self, request_id: str, name: str, data: bytes) -> Any:
+        """Write a record for a request and return its location."""
+        request_dir = self._get_request_dir(request_id)
+
+        # Records may be written out of order by background writers
+        os.makedirs(request_dir, exist_ok=True)
+
+        path = os.path.join(request_dir, name)
+
+        with open(path, "wb") as out:
+            out.write(data)
+
+        return path
+
+    def _read(self, location: Any) -> bytes:
+        """Read back a record previously written to the specified location."""
+        with open(location, "rb") as f:
+            return f.read()
+
+    def _store_body(self, digest: str, body: bytes) -> Tuple[Any, int]:
+        """Write a deduplicated body, compressing it if compression is enabled."""
+        length = len(body)
+
+        if self._compressor is not None:
+            compressed = self._compressor.compress(body)
+
+            with self._lock:
+                self._compression_saved += len(body) - len(compressed)
+
+            body = compressed
+
+        location = self._write_body(digest, body)
+        self._journal.append(
+            {
+                "op": "body",
+                "digest": digest,
+                "location": self._dump_location(location),
+                "size": len(body),
+                "length": length,
+                "saved": length - len(body),
+            }
+        )
+
+        return location, len(body)
+
+    def _read_stored_body(self, location: Any) -> bytes:
+        data = self._read(location)
+
+        if self._compressor is not None:
+            data = self._compressor.decompress(data)
+
+        return data
+
+    def _write_body(self, digest: str, data: bytes) -> Any:
+        """Write a deduplicated body and return its location."""
+        bodies_dir = os.path.join(self.session_dir, "bodies")
+        os.makedirs(bodies_dir, exist_ok=True)
+
+        path = os.path.join(bodies_dir, digest)
+
+        with open(path, "wb") as out:
+            out.write(data)
+
+        return path
+
+    def _remove_body(self, location: Any) -> None:
+        """Remove a deduplicated body that is no longer referenced."""
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+    def _remove_record(self, request_id: str, location: Any) -> None:
+        """Remove a record written for a request that has since been removed, or
+        anything left by a write that failed, when the location is None.
+        """
+        shutil.rmtree(self._get_request_dir(request_id), ignore_errors=True)
+
+    def _load(self, indexed_request: _IndexedRequest, name: str):
+        """Load a record for a request, or None if there is no such record."""
+        if self._write_queue is not None:
+            obj = self._write_queue.get(indexed_request.id, name)
+
+            if obj is not None:
+                # Copy so that the caller gets an object independent of the
+                # one waiting to be written, as it would when loading from disk.
+                return copy.deepcopy(obj)
+
+        location = indexed_request.locations.get(name)
+
+        if location is None:
+            return None
+
+        try:
+            # Records written by this process were written in full before being
+            # indexed, so only those of an earlier process may be incomplete
+            obj = records.decode(
+                self._read(location), verify=name in indexed_request.unverified
+            )
+            indexed_request.unverified.discard(name)
+
+            # Lazily loaded requests load the whole record only once the body
+            # is accessed, so bodies are read or decompressed straight away.
+            if name in indexed_request.bodies:
+                obj.body = self._load_body(indexed_request, name)
+            elif name in indexed_request.compressed:
+                obj.body = self._compressor.decompress(obj.body)
+
+            return obj
+        except FileNotFoundError:
+            # Removed by retention or by clearing the storage
+            return None
+        except (EOFError, records.CorruptRecordError) as e:
+            # The record was only partially written
+            log.warning(
+                "Skipping corrupt %s record for request %s: %s",
+                name,
+                indexed_request.id,
+                e,
+            )
+            return None
+
+    def _discard(self, index: List[_IndexedRequest]) -> None:
+        """Remove the records of the specified requests."""
+        for indexed_request in index:
+            shutil.rmtree(self._get_request_dir(indexed_request.id), ignore_errors=True)
+
+        self._release_bodies(index)
+
+    def _release_bodies(self, index: List[_IndexedRequest]) -> None:
+        """Release the deduplicated bodies referenced by the specified requests."""
+        removed = 0
+
+        for indexed_request in index:
+            for digest in indexed_request.bodies.values():
+                removed += self._body_store.release(digest)
+
+        if removed:
+            with self._lock:
+                self._bytes -= removed
+
+    def _swap_session_dir(self) -> bool:
+        """Replace the session directory with a fresh one, deleting the previous
+        one in the background.
+
+        Returns: True if the session directory was replaced, False if it couldn't
+            be moved aside, e.g. because files in it are open on Windows.
+        """
+        try:
+            trash = _reaper.move_aside(self.session_dir)
+        except OSError as e:
+            log.debug("Unable to move %s aside: %s", self.session_dir, e)
+            return False
+
+        _make_dirs(self.session_dir)
+        _heartbeat.add(self.session_dir)
+        self._journal.restart(self._journal_header)
+
+        if self._compressor is not None and self._compressor.dictionary is not None:
+            # Bodies will continue to be compressed with the dictionary
+            self._write_dictionary(self._compressor.dictionary)
+
+        self._reset_records()
+        self._body_store.clear()
+        _reaper.reap(trash)
+
+        return True
+
+    def _reset_records(self) -> None:
+        """Called once the session directory has been replaced, to start writing
+        records to the new one.
+        """
+        pass
+
+    def _discard_all(self, index: List[_IndexedRequest]) -> None:
+        """Remove the records of all requests, which are those specified."""
+        for indexed_request in index:
+            shutil.rmtree(self._get_request_dir(indexed_request.id), ignore_errors=True)
+
+        if len(self._body_store):
+            shutil.rmtree(os.path.join(self.session_dir, "bodies"), ignore_errors=True)
+            self._body_store.clear()
+
+    def save_response(self, request_id: str, response: Response) -> None:
+        """Save a response to storage against a request with the specified id.
+
+        Args:
+            request_id: The id of the original request.
+            response: The response to save.
+        """
+        indexed_request = self._index.get(request_id)
+
+        if indexed_request is None:
+            log.debug(
+                "Cannot save response as request %s is no longer stored", request_id
+            )
+            return
+
+        self._save(response, indexed_request, "response")
+
+        indexed_request.reason = response.reason
+        indexed_request.response_headers = list(response.headers.items())
+        indexed_request.response_date = response.date
+        indexed_request.cert = getattr(response, "cert", {})
+        self._index.set_response(indexed_request, response)
+        self._index.touch(indexed_request)
+        self._check_retention()
+        self._listeners.notify(RESPONSE_SAVED, request_id, indexed_request.url)
+
+    def _check_retention(self) -> None:
+        """Wake the background retention task if a count or size limit is exceeded."""
+        if self._housekeeper is not None and (
+            len(self._index) > self._maxsize or self._bytes > self._max_bytes
+        ):
+            self._housekeeper.wakeup()
+
+    def _enforce_retention(self) -> None:
+        """Remove the oldest requests until the storage is within its retention limits."""
+        if self._max_age is not None:
+            cutoff = time.time() - self._max_age
+        else:
+            cutoff = None
+
+        while True:
+            oldest = self._index.first()
+
+            if oldest is None:
+                break
+
+            if (
+                len(self._index) <= self._maxsize
+                and self._bytes <= self._max_bytes
+                and (cutoff is None or oldest.created >= cutoff)
+            ):
+                break
+
+            if self._index.remove(oldest.id) is None:
+                # Removed concurrently, e.g. by clear_requests()
+                continue
+
+            with self._lock:
+                ws_messages = self._ws_messages.pop(oldest.id, None)
+                self._bytes -= oldest.size
+                self._evictions += 1
+
+                if ws_messages is not None:
+                    self._ws_tail_bytes -= ws_messages.tail_bytes
+
+            self._meter.add_bytes(oldest.host, -oldest.size)
+            self._journal.append({"op": "remove", "id": oldest.id})
+            self._discard([oldest])
+
+            if ws_messages is not None:
+                ws_messages.remove()
+            log.debug("Removed request %s due to retention limits", oldest.id)
+
+    def save_ws_message(self, request_id: str, message: WebSocketMessage) -> None:
+        """Save a websocket message against a request with the specified id.
+
+        Args:
+            request_id: The id of the original handshake request.
+            message: The websocket message to save.
+        """
+        indexed_request = self._index.get(request_id)
+
+        if indexed_request is None:
+            log.debug(
+                "Cannot save websocket message as request %s is no longer stored",
+                request_id,
+            )
+            return
+
+        size = content_size(message)
+
+        with self._lock:
+            ws_messages = self._ws_messages.get(request_id)
+
+            if ws_messages is None:
+                ws_messages = self._ws_messages[request_id] = MessageLog(
+                    os.path.join(self.session_dir, "websocket-{}.log".format(request_id))
+                )
+
+            self._ws_tail_bytes += size
+
+        self._meter.add_ws_message(size)
+        self._account_ws_messages(indexed_request, *ws_messages.append(message))
+
+    def _account_ws_messages(
+        self, indexed_request: _IndexedRequest, written: int, released: int
+    ) -> None:
+        """Count websocket messages written to disk towards the size of a request."""
+        if written:
+            with self._lock:
+                indexed_request.size += written
+                self._bytes += written
+                self._ws_tail_bytes -= released
+
+            self._meter.add_bytes(indexed_request.host, written)
+            self._check_retention()
+
+    def _flush_ws_messages(self) -> None:
+        with self._lock:
+            ws_messages = list(self._ws_messages.items())
+
+        for request_id, messages in ws_messages:
+            written, released = messages.flush()
+            indexed_request = self._index.get(request_id)
+
+            if indexed_request is not None:
+                self._account_ws_messages(indexed_request, written, released)
+
+    def save_har_entry(self, request_id: str, entry: dict) -> None:
+        """Save a HAR entry to storage against a request with the specified id.
+
+        Args:
+            request_id: The id of the original request.
+            entry: The HAR entry to save.
+        """
+        indexed_request = self._index.get(request_id)
+
+        if indexed_request is None:
+            log.debug(
+                "Cannot save HAR entry as request %s is no longer stored", request_id
+            )
+            return
+
+        self._save(entry, indexed_request, "har_entry")
+
+    def load_requests(self, lazy: Optional[bool] = None) -> List[Request]:
+        """Load all previously saved requests known to the storage (known to its index).
+
+        The requests are returned as a list of request objects in the order in which they
+        were saved. Each request will have any associated response and websocket messages
+        attached if they exist.
+
+        Lazily loaded requests are created from the in-memory index without reading
+        anything from disk. Their method, URL, headers and any response status and
+        headers are available immediately, but the request and response bodies are only
+        read from disk when first accessed.
+
+        Args:
+            lazy: Whether to return lazily loaded requests. Defaults to the lazy
+                setting the storage was created with.
+        Returns: A list of request objects.
+        """
+        loaded = []
+
+        for indexed_request in self._index.entries():
+            request = self._load_request(indexed_request, lazy)
+
+            if request is not None:
+                loaded.append(request)
+
+        return loaded
+
+    def _load_request(
+        self, indexed_request: _IndexedRequest, lazy: Optional[bool] = False
+    ) -> Optional[Request]:
+        if lazy or (lazy is None and self.lazy):
+            return self._create_lazy_request(indexed_request)
+
+        request = self._load(indexed_request, "request")
+
+        if request is None:
+            return None
+
+        ws_messages = self._ws_messages.get(request.id)
+
+        if ws_messages:
+            # Attach any websocket messages for this request if we have them
+            request.ws_messages = ws_messages
+
+        # Attach the response if there is one.
+        response = self._load(indexed_request, "response")
+
+        if response is not None:
+            request.response = response
+
+            # The certificate data has been stored on the response but we make
+            # it available on the request which is a more logical location.
+            if hasattr(response, "cert"):
+                request.cert = response.cert
+                del response.cert
+
+        return request
+
+    def _create_lazy_request(self, indexed_request: _IndexedRequest) -> Request:
+        request = Request(
+            method=indexed_request.method,
+            url=indexed_request.url,
+            headers=(),
+            body=functools.partial(self._load_body, indexed_request, "request"),
+        )
+        # The headers were indexed as they were saved, so needn't be added one by one
+        request.headers = HTTPHeaders.from_items(indexed_request.headers)
+        request.id = indexed_request.id
+        request.date = indexed_request.date
+
+        ws_messages = self._ws_messages.get(request.id)
+
+        if ws_messages:
+            request.ws_messages = ws_messages
+
+        if indexed_request.has_response:
+            response = Response(
+                status_code=indexed_request.status_code,
+                reason=indexed_request.reason,
+                headers=(),
+                body=functools.partial(self._load_body, indexed_request, "response"),
+            )
+            response.headers = HTTPHeaders.from_items(indexed_request.response_headers)
+            response.date = indexed_request.response_date
+            request.response = response
+            request.cert = indexed_request.cert
+
+        return request
+
+    def _load_body(self, indexed_request: _IndexedRequest, name: str) -> bytes:
+        digest = indexed_request.bodies.get(name)
+
+        if digest is not None:
+            # No need to read the record itself
+            try:
+                return self._body_store.read(digest)
+            except FileNotFoundError:
+                return b""
+
+        obj = self._load(indexed_request, name)
+
+        if obj is None:
+            return b""
+
+        return obj.body
+
+    def load_request(self, request_id: str) -> Optional[Request]:
+        """Load the request with the specified id.
+
+        Args:
+            request_id: The id of the request.
+        Returns: The request or None if no such request is stored.
+        """
+        indexed_request = self._index.get(request_id)
+
+        if indexed_request is None:
+            return None
+
+        return self._load_request(indexed_request)
+
+    def load_last_request(self) -> Optional[Request]:
+        """Load the last saved request.
+
+        Returns: The last saved request or None if no requests have
+            yet been stored.
+        """
+        last_request = self._index.last()
+
+        if last_request is None:
+            return None
+
+        return self._load_request(last_request)
+
+    def load_har_entries(self) -> List[dict]:
+        """Load all HAR entries known to this storage.
+
+        Returns: A list of HAR entries.
+        """
+        entries = []
+
+        for indexed_request in self._index.entries():
+            # HAR entries aren't necessarily saved with each request.
+            entry = self._load(indexed_request, "har_entry")
+
+            if entry is not None:
+                entries.append(entry)
+
+        return entries
+
+    def iter_requests(
+        self, lazy: Optional[bool] = None, since: Optional[int] = None
+    ) -> Iterator[Request]:
+        """Return an iterator of requests known to the storage.
+
+        Args:
+            lazy: Whether to return lazily loaded requests. Defaults to the lazy
+                setting the storage was created with. See load_requests().
+            since: When specified, only the requests saved or updated since this
+                cursor are returned. See requests_since().
+        Returns: An iterator of request objects.
+        """
+        if since is None:
+            index = self._index.entries()
+        else:
+            index, _ = self._index.since(since)
+
+        for indexed_request in index:
+            yield self._load_request(indexed_request, lazy)
+
+    def requests_since(
+        self, cursor: int = 0, lazy: Optional[bool] = None
+    ) -> Tuple[List[Request], int]:
+        """Load the requests saved or updated since the specified cursor.
+
+        A request is updated when its response is saved, in which case it is
+        returned again with the response attached. Requests are returned in the
+        order in which they were saved or updated.
+
+        Args:
+            cursor: The cursor returned by a previous call. Default 0, which
+                returns all requests.
+            lazy: Whether to return lazily loaded requests. Defaults to the lazy
+                setting the storage was created with. See load_requests().
+        Returns: A tuple of the list of request objects and the cursor to pass
+            to the next call.
+        """
+        index, cursor = self._index.since(cursor)
+        loaded = []
+
+        for indexed_request in index:
+            request = self._load_request(indexed_request, lazy)
+
+            if request is not None:
+                loaded.append(request)
+
+        return loaded, cursor
+
+    def clear_requests(self) -> None:
+        """Clear all requests currently known to this storage.
+
+        The session directory is swapped for a fresh one, and the previous one
+        deleted in the background, so this doesn't depend on the number of
+        requests held.
+        """
+        # Records are only journaled under the lock once their request is known
+        # to be in the index, so holding it across clearing the index and swapping
+        # the session means that requests saved while clearing are journaled in
+        # the new session if they were saved after the clear, and not at all if
+        # before. Records of the latter written while clearing are rolled back.
+        with self._lock:
+            index = self._index.clear()
+            ws_messages, self._ws_messages = self._ws_messages, {}
+            self._bytes = 0
+            self._ws_tail_bytes = 0
+            self._generation += 1
+            swapped = self._swap_session_dir()
+
+            if not swapped:
+                self._journal.append({"op": "clear"})
+
+        self._meter.clear_bytes()
+
+        if self._write_queue is not None:
+            self._write_queue.clear()
+
+        if not swapped:
+            self._discard_all(index)
+
+            for messages in ws_messages.values():
+                messages.remove()
+
+    def find(
+        self, pat: str, check_response: bool = True, **filters
+    ) -> Optional[Request]:
+        """Find the first request that matches the specified pattern.
+
+        Requests are searched in chronological order.
+
+        Args:
+            pat: A pattern that will be searched in the request URL.
+            check_response: When a match is found, whether to check that the request has
+                a corresponding response. Where check_response=True and no response has
+                been received, this method will skip the request and continue searching.
+            filters: Optional host, method, status_code and content_type criteria
+                that narrow down the requests searched. See query().
+
+        Returns: The first request in the storage that matches the pattern,
+            or None if no requests match.
+        """
+        for indexed_request in self._index.select(
+            pat, has_response=True if check_response else None, **filters
+        ):
+            return self._load_request(indexed_request)
 
-        self._save(entry, request_dir, "har_entry")
+        return None
 
-    def load_requests(self) -> List[Request]:
-        """Load all previously saved requests known to the storage (known to its index).
+    def query(
+        self,
+        pat: Optional[str] = None,
+        *,
+        host: Optional[str] = None,
+        method: Optional[str] = None,
+        status_code: Optional[int] = None,
+        content_type: Optional[str] = None,
+        check_response: bool = False,
+    ) -> List[Request]:
+        """Load the requests that match all of the supplied criteria.
+
+        Criteria that are not supplied are not applied. Requests are returned
+        in chronological order.
 
-        The requests are returned as a list of request objects in the order in which they
-        were saved. Each request will have any associated response and websocket messages
-        attached if they exist.
+        Args:
+            pat: A pattern that will be searched in the request URL.
+            host: The request hostname, excluding any port.
+            method: The request method, e.g. GET.
+            status_code: The response status code.
+            content_type: The response content type, excluding any parameters.
+            check_response: Whether to only return requests that have a response.
 
-        Returns: A list of request objects.
+        Returns: A list of matching request objects.
         """
-        with self._lock:
-            index = self._index[:]
-
         loaded = []
 
-        for indexed_request in index:
-            request = self._load_request(indexed_request.id)
+        for indexed_request in self._index.select(
+            pat,
+            has_response=True if check_response else None,
+            host=host,
+            method=method,
+            status_code=status_code,
+            content_type=content_type,
+        ):
+            request = self._load_request(indexed_request)
 
             if request is not None:
                 loaded.append(request)
 
         return loaded
 
-    def _load_request(self, request_id: str) -> Optional[Request]:
-        request_dir = self._get_request_dir(request_id)
+    def add_listener(self, listener: Callable[[str, str, str], None]) -> None:
+        """Add a listener that is notified when a request or response is saved.
 
-        with open(os.path.join(request_dir, "request"), "rb") as req:
-            request = self._unpickle(req)
+        The listener is called with the event (REQUEST_SAVED or RESPONSE_SAVED),
+        the id of the request and the request URL. It is called on the thread that
+        saved the request or response, so it should return quickly.
 
-            if request is None:
-                return None
+        Args:
+            listener: The listener to add.
+        """
+        self._listeners.add(listener)
 
-            ws_messages = self._ws_messages.get(request.id)
+    def remove_listener(self, listener: Callable[[str, str, str], None]) -> None:
+        """Remove a listener previously added with add_listener().
 
-            if ws_messages:
-                # Attach any websocket messages for this request if we have them
-                request.ws_messages = ws_messages
+        Args:
+            listener: The listener to remove.
+        """
+        self._listeners.remove(listener)
 
-            try:
-                # Attach the response if there is one.
-                with open(os.path.join(request_dir, "response"), "rb") as res:
-                    response = self._unpickle(res)
-
-                    if response is not None:
-                        request.response = response
-
-                        # The certificate data has been stored on the response but we make
-                        # it available on the request which is a more logical location.
-                        if hasattr(response, "cert"):
-                            request.cert = response.cert
-                            del response.cert
-            except (FileNotFoundError, EOFError):
-                pass
+    def flush(self) -> None:
+        """Block until any records waiting to be written have been written to disk,
+        including the websocket messages held in memory.
+        """
+        if self._write_queue is not None:
+            self._write_queue.flush()
+
+        self._flush_ws_messages()
+
+    def stats(self) -> dict:
+        """Get statistics about the requests held by the storage.
+
+        The statistics are kept up to date as requests are saved and removed, so
+        are cheap to get regardless of the number of requests held.
+
+        Returns: A dictionary containing:
+            - requests: The number of requests held
+            - responses: The number of requests held that have a response
+            - bytes: The number of bytes of request, response, HAR and websocket
+              data on disk
+            - bytes_in_memory: The number of bytes of bodies waiting to be written
+              and websocket messages not yet written
+            - bytes_on_disk: The same as bytes
+            - bytes_by_host: The bytes on disk for each host, excluding
+              deduplicated bodies
+            - ws_messages: The number of websocket messages saved
+            - ws_bytes: The number of bytes of websocket messages saved
+            - ws_dropped_messages: Always 0, as websocket messages are not dropped
+            - ws_dropped_bytes: Always 0
+            - evictions: The number of requests removed due to retention limits
+            - write_queue_depth: The number of records waiting to be written
+            - save_latency_ms: The average time in milliseconds taken to save a
+              request, response or HAR entry
+            - dedup_bodies: The number of distinct deduplicated bodies held
+            - dedup_bytes_saved: The number of bytes not written because an identical
+              body was already held
+            - compression_bytes_saved: The number of bytes saved by compressing the
+              bodies written
+        """
+        write_queue = self._write_queue
+
+        return {
+            "requests": len(self._index),
+            "responses": self._index.responses,
+            "bytes": self._bytes,
+            "bytes_in_memory": (
+                self._ws_tail_bytes + (write_queue.bytes if write_queue else 0)
+            ),
+            "bytes_on_disk": self._bytes,
+            **self._meter.report(),
+            "ws_dropped_messages": 0,
+            "ws_dropped_bytes": 0,
+            "evictions": self._evictions,
+            "write_queue_depth": len(write_queue) if write_queue else 0,
+            "dedup_bodies": len(self._body_store),
+            "dedup_bytes_saved": self._body_store.bytes_saved,
+            "compression_bytes_saved": self._compression_saved,
+        }
 
-        return request
+    def _get_request_dir(self, request_id: str) -> str:
+        return os.path.join(self.session_dir, "request-{}".format(request_id))
 
-    def _unpickle(self, f):
-        """Unpickle the object specified by the file f.
+    def cleanup(self) -> None:
+        """Remove all stored requests, the storage directory containing those
+        requests, and if that is the only storage directory, also the top level
+        parent directory.
 
-        If unpickling fails return None.
+        The directories are deleted in the background, but this waits a bounded
+        time for them to go, as the background thread doesn't outlive the process.
         """
-        try:
-            return pickle.load(f)
-        except Exception:
-            # Errors may sometimes occur with unpickling - e.g.
-            # sometimes data hasn't been fully flushed to disk
-            # by the OS by the time we come to unpickle it.
-            if log.isEnabledFor(logging.DEBUG):
-                log.exception("Error unpickling object")
+        log.debug("Cleaning up %s", self.session_dir)
 
-            return None
+        if self._housekeeper is not None:
+            self._housekeeper.stop()
 
-    def load_last_request(self) -> Optional[Request]:
-        """Load the last saved request.
+        if self._write_queue is not None:
+            self._write_queue.close()
 
-        Returns: The last saved request or None if no requests have
-            yet been stored.
-        """
         with self._lock:
-            if self._index:
-                last_request = self._index[-1]
-            else:
-                return None
+            self._index.clear()
+            self._ws_messages.clear()
+            self._bytes = 0
+            self._ws_tail_bytes = 0
 
-        return self._load_request(last_request.id)
+        self._meter.clear_bytes()
+        self._body_store.clear()
+        self._close()
+        _reaper.discard(self.session_dir)
 
-    def load_har_entries(self) -> List[dict]:
-        """Load all HAR entries known to this storage.
+        if not _reaper.wait(CLEANUP_TIMEOUT):
+            log.debug("Gave up waiting for %s to be deleted", self.session_dir)
 
-        Returns: A list of HAR entries.
+    def close(self) -> None:
+        """Write any records waiting to be written and release the storage's threads
+        and open files without removing anything, so that the session can later be
+        reopened with open().
         """
-        with self._lock:
-            index = self._index[:]
+        if self._housekeeper is not None:
+            self._housekeeper.stop()
 
-        entries = []
+        if self._write_queue is not None:
+            self._write_queue.close()
 
-        for indexed_request in index:
-            request_dir = self._get_request_dir(indexed_request.id)
+        self._flush_ws_messages()
+        self._close()
 
-            try:
-                with open(os.path.join(request_dir, "har_entry"), "rb") as f:
-                    entry = self._unpickle(f)
+    def _close(self) -> None:
+        """Release any open files ahead of the session directory being removed."""
+        _heartbeat.remove(self.session_dir)
+        self._journal.close()
 
-                    if entry is not None:
-                        entries.append(entry)
-            except FileNotFoundError:
-                # HAR entries aren't necessarily saved with each request.
-                pass
 
-        return entries
+class SegmentRequestStorage(RequestStorage):
+    """Persists request and response data to disk using an append-only segment log.
 
-    def iter_requests(self) -> Iterator[Request]:
-        """Return an iterator of requests known to the storage.
+    Rather than creating a directory and a file per request, response and HAR entry,
+    records are appended to rolling segment files and their offsets held in the
+    in-memory index.
 
-        Returns: An iterator of request objects.
+    Instances are designed to be threadsafe.
+    """
+
+    _backend = "segment"
+
+    def __init__(
+        self,
+        base_dir: Optional[str] = None,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        lazy: bool = False,
+        maxsize: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        write_behind: bool = False,
+        write_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE,
+        writers: int = 1,
+        dedup: bool = False,
+        dedup_requests: bool = False,
+        compress: bool = False,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+        compress_dict_samples: int = 0,
+        session_dir: Optional[str] = None,
+    ):
+        """Initialises a new SegmentRequestStorage using an optional base directory.
+
+        Args:
+            base_dir: The directory where request and response data is stored.
+                If not specified, the system temp folder is used.
+            segment_size: The size in bytes a segment file may grow to before
+                a new segment file is started.
+            lazy: Whether load_requests() and iter_requests() return lazily loaded
+                requests by default. See RequestStorage.load_requests().
+            maxsize: The maximum number of requests to retain. Default no limit.
+            max_bytes: The maximum number of bytes of request, response and HAR data
+                to retain on disk. Default no limit.
+            max_age: The maximum time in seconds to retain a request for after it
+                was saved. Default no limit.
+            write_behind: When True, records are written to disk by background writer
+                threads rather than by the thread saving them. Default False.
+            write_queue_size: The number of records that may be waiting to be written
+                before saving blocks. Only applies when write_behind is True.
+            writers: The number of background writer threads. Only applies when
+                write_behind is True.
+            dedup: When True, response bodies are stored by content hash so that
+                identical bodies are only written once. Default False.
+            dedup_requests: When True, request bodies are also deduplicated.
+                Default False.
+            compress: When True, request and response bodies are compressed with
+                zstd. Default False.
+            compress_level: The zstd compression level. Only applies when compress
+                is True.
+            compress_dict_samples: The number of bodies to train a compression
+                dictionary on. See RequestStorage.
+            session_dir: An existing session directory to use rather than creating
+                a new one. Use open() to reopen the session of a previous storage.
         """
-        with self._lock:
-            index = self._index[:]
+        # The number of retained records held in each segment.
+        self._live_records: DefaultDict[int, int] = defaultdict(int)
+        self._current_segment = 0
+        self._segments_lock = threading.Lock()
+
+        super().__init__(
+            base_dir=base_dir,
+            lazy=lazy,
+            maxsize=maxsize,
+            max_bytes=max_bytes,
+            max_age=max_age,
+            write_behind=write_behind,
+            write_queue_size=write_queue_size,
+            writers=writers,
+            dedup=dedup,
+            dedup_requests=dedup_requests,
+            compress=compress,
+            compress_level=compress_level,
+            compress_dict_samples=compress_dict_samples,
+            session_dir=session_dir,
+        )
 
-        for indexed_request in index:
-            yield self._load_request(indexed_request.id)
+        self._log = SegmentLog(self.session_dir, segment_size=segment_size)
+        self._current_segment = self._log.current_segment
 
-    def clear_requests(self) -> None:
-        """Clear all requests currently known to this storage."""
-        with self._lock:
-            index = self._index[:]
-            self._index.clear()
-            self._ws_messages.clear()
+    def _write(self, request_id: str, name: str, data: bytes) -> Any:
+        location = self._log.append(data)
 
-        for indexed_request in index:
-            shutil.rmtree(self._get_request_dir(indexed_request.id), ignore_errors=True)
+        with self._segments_lock:
+            self._live_records[location.segment] += 1
 
-    def find(self, pat: str, check_response: bool = True) -> Optional[Request]:
-        """Find the first request that matches the specified pattern.
+            if location.segment != self._current_segment:
+                # The log has moved on to a new segment, so the previous
+                # one can go if none of its records were retained.
+                if self._live_records.get(self._current_segment) == 0:
+                    self._remove_segment(self._current_segment)
+                self._current_segment = location.segment
 
-        Requests are searched in chronological order.
+        return location
 
-        Args:
-            pat: A pattern that will be searched in the request URL.
-            check_response: When a match is found, whether to check that the request has
-                a corresponding response. Where check_response=True and no response has
-                been received, this method will skip the request and continue searching.
+    def _read(self, location: Any) -> bytes:
+        return self._log.read(location)
 
-        Returns: The first request in the storage that matches the pattern,
-            or None if no requests match.
-        """
-        with self._lock:
-            index = self._index[:]
+    def _write_body(self, digest: str, data: bytes) -> Any:
+        return self._write(digest, "body", data)
 
-        for indexed_request in index:
-            if re.search(pat, indexed_request.url):
-                if (
-                    check_response and indexed_request.has_response
-                ) or not check_response:
-                    return self._load_request(indexed_request.id)
+    def _remove_body(self, location: Any) -> None:
+        with self._segments_lock:
+            self._release_location(location)
 
-        return None
+    def _remove_record(self, request_id: str, location: Any) -> None:
+        if location is not None:
+            with self._segments_lock:
+                self._release_location(location)
 
-    def _get_request_dir(self, request_id: str) -> str:
-        return os.path.join(self.session_dir, "request-{}".format(request_id))
+    def _discard(self, index: List[_IndexedRequest]) -> None:
+        with self._segments_lock:
+            for indexed_request in index:
+                for location in indexed_request.locations.values():
+                    self._release_location(location)
 
-    def cleanup(self) -> None:
-        """Remove all stored requests, the storage directory containing those
-        requests, and if that is the only storage directory, also the top level
-        parent directory.
+        self._release_bodies(index)
+
+    def _release_location(self, location: Location) -> None:
+        """Release a record that is no longer retained. The segments lock must be
+        held by the caller.
         """
-        log.debug("Cleaning up %s", self.session_dir)
-        self.clear_requests()
-        shutil.rmtree(self.session_dir, ignore_errors=True)
-        try:
-            # Attempt to remove the parent folder if it is empty
-            os.rmdir(os.path.dirname(self.session_dir))
-        except OSError:
-            # Parent folder not empty
-            pass
+        # Records can't be removed from a segment, so a segment is only
+        # deleted once none of its records are retained.
+        self._live_records[location.segment] -= 1
+
+        if self._live_records[location.segment] <= 0:
+            self._remove_segment(location.segment)
 
-    def _cleanup_old_dirs(self) -> None:
-        """Clean up and remove any old storage directories that were not previously
-        cleaned up properly by cleanup().
+    def _remove_segment(self, segment: int) -> None:
+        """Delete a segment unless it's still being written to. The segments lock
+        must be held by the caller.
         """
-        parent_dir = os.path.dirname(self.session_dir)
-        for storage_dir in os.listdir(parent_dir):
-            storage_dir = os.path.join(parent_dir, storage_dir)
-            try:
-                if (
-                    os.path.getmtime(storage_dir)
-                    < (
-                        datetime.now() - timedelta(days=REMOVE_DATA_OLDER_THAN_DAYS)
-                    ).timestamp()
-                ):
-                    shutil.rmtree(storage_dir, ignore_errors=True)
-            except FileNotFoundError:
-                # Can happen if multiple instances are run concurrently
-                pass
+        if self._log.remove_segment(segment):
+            del self._live_records[segment]
+
+    def _reset_records(self) -> None:
+        with self._segments_lock:
+            self._live_records.clear()
+            # The segment files were moved aside with the session directory,
+            # so this just starts a new segment in the new one.
+            self._log.reset()
+            self._current_segment = self._log.current_segment
+
+    def _discard_all(self, index: List[_IndexedRequest]) -> None:
+        if index:
+            with self._segments_lock:
+                self._live_records.clear()
+                self._log.reset()
+                self._current_segment = -1
+
+            # Deduplicated bodies were held in the segments just removed
+            self._body_store.clear()
+
+    def _retain(self, locations: List[Any]) -> None:
+        with self._segments_lock:
+            for location in locations:
+                self._live_records[location.segment] += 1
+
+            # Segments whose records were all removed before the process died
+            for segment in self._log.segments():
+                if segment not in self._live_records:
+                    self._log.remove_segment(segment)
+
+    def _dump_location(self, location: Any) -> Any:
+        return list(location)
+
+    def _load_location(self, value: Any) -> Any:
+        return Location(*value)
+
+    def _close(self) -> None:
+        self._log.close()
+        super()._close()
+
+
+# The disk backends, keyed by the name they record in the journal.
+_BACKENDS = {
+    RequestStorage._backend: RequestStorage,
+    SegmentRequestStorage._backend: SegmentRequestStorage,
+}
 
 
 class InMemoryRequestStorage:
     """Keeps request and response data in memory only.
 
     By default there is no limit on the number of requests that will be stored. This can
-    be adjusted with the 'maxsize' attribute when creating a new instance.
+    be adjusted with the 'maxsize' attribute when creating a new instance. The memory
+    used by request bodies, response bodies and websocket messages can be bounded with
+    the 'max_bytes' attribute. Identical bodies can optionally be deduplicated so that
+    only a single copy is held in memory.
+
+    The websocket messages held for each connection can also be limited, in which case
+    only the most recent messages are kept, in a MessageRing.
 
     Instances are designed to be threadsafe.
     """
 
-    def __init__(self, base_dir: Optional[str] = None, maxsize: Optional[int] = None):
+    def __init__(
+        self,
+        base_dir: Optional[str] = None,
+        maxsize: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        eviction: str = "fifo",
+        spill: bool = False,
+        dedup: bool = False,
+        dedup_requests: bool = False,
+        ws_max_messages: Optional[int] = None,
+        ws_max_bytes: Optional[int] = None,
+    ):
         """Initialise a new InMemoryRequestStorage.
 
         Args:
-            base_dir: The directory where certificate data is stored.
-                If not specified, the system temp folder is used.
+            base_dir: The directory where certificate data, and any bodies spilled
+                to disk, are stored. If not specified, the system temp folder is used.
             maxsize: The maximum number of requests to store. Default no limit.
                 When this attribute is set and the storage reaches the specified maximum
                 size, old requests are discarded sequentially as new requests arrive.
+            max_bytes: The maximum number of bytes of request bodies, response bodies
+                and websocket messages to hold in memory. Default no limit.
+                When this is exceeded, requests are evicted according to the eviction
+                policy until the storage is back within budget.
+            eviction: The order in which requests are evicted: 'fifo' evicts the oldest
+                requests first, 'lru' evicts the least recently used requests first.
+                Default 'fifo'.
+            spill: When True, the bodies of evicted requests are written to an overflow
+                file on disk instead of the request being discarded. The bodies are read
+                back when next accessed. Default False.
+            dedup: When True, identical response bodies share a single copy in memory
+                and are only counted once against max_bytes. Default False.
+            dedup_requests: When True, request bodies are also deduplicated.
+                Default False.
+            ws_max_messages: The maximum number of websocket messages to hold for
+                each connection. When exceeded, the oldest messages are dropped.
+                Default no limit.
+            ws_max_bytes: The maximum number of bytes of websocket messages to hold
+                for each connection. When exceeded, the oldest messages are dropped.
+                Default no limit.
         """
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(
+                "Unknown eviction policy: {} (expected one of {})".format(
+                    eviction, ", ".join(EVICTION_POLICIES)
+                )
+            )
+
         if base_dir is None:
             base_dir = tempfile.gettempdir()
 
         self.home_dir: str = os.path.join(base_dir, ".wireproxy")
 
         self._maxsize = sys.maxsize if maxsize is None else maxsize
+        self._max_bytes = sys.maxsize if max_bytes is None else max_bytes
+        self._eviction = eviction
+        self._spill = spill
         # OrderedDict doesn't support type hints before 3.7.2
         self._requests = OrderedDict()  # type: ignore
+        # Index of requests held, used for filtered lookups.
+        self._index = _RequestCatalog()
+        # Ids of requests whose bodies are held in memory, in eviction order.
+        self._resident = OrderedDict()  # type: ignore
+        # The number of bytes currently held in memory.
+        self._bytes = 0
+        self._evictions = 0
+        self._spill_log: Optional[SegmentLog] = None
+        # The number of bytes of bodies spilled to disk.
+        self._spilled_bytes = 0
+        # The locations of the deduplicated bodies spilled, keyed by content hash.
+        self._spilled_bodies: Dict[str, Location] = {}
+        self._meter = _Meter()
+        self._ws_max_messages = ws_max_messages
+        self._ws_max_bytes = ws_max_bytes
+        # The number of websocket messages and bytes dropped to stay within the limits.
+        self._ws_dropped_messages = 0
+        self._ws_dropped_bytes = 0
+        # The names of the bodies that are deduplicated.
+        self._dedup_names = set()
+
+        if dedup:
+            self._dedup_names.add("response")
+        if dedup_requests:
+            self._dedup_names.add("request")
+
+        # Bodies are held as is, so the store just keeps a reference to them
+        self._body_store = _BodyStore(
+            lambda digest, body: (body, len(body)), lambda body: body, lambda body: None
+        )
+        self._listeners = _Listeners()
+        # The requests held, in the order they were saved, as of a version of the index
+        self._snapshot: Tuple[int, Tuple[Request, ...]] = (0, ())
         self._lock = threading.Lock()
 
     def save_request(self, request: Request) -> None:
@@ -399,14 +2767,144 @@ class InMemoryRequestStorage:
         """
         request.id = str(uuid.uuid4())
 
+        if self._maxsize <= 0:
+            return
+
+        start = time.perf_counter()
+        indexed_request = _IndexedRequest(id=request.id, url=request.url, method=request.method)
+        # Any deduplicated body is hashed before taking the lock
+        size, shared, digest = self._hold_body("request", request)
+
         with self._lock:
-            if self._maxsize > 0:
-                while len(self._requests) >= self._maxsize:
-                    self._requests.popitem(last=False)
+            while len(self._requests) >= self._maxsize:
+                self._evict()
+
+            v = self._requests[request.id] = {
+                "request": request,
+                "size": 0,
+                "host": indexed_request.host,
+            }
+
+            if digest is not None:
+                v["bodies"] = {"request": digest}
+
+            self._index.add(indexed_request)
+            self._index.touch(indexed_request)
+            self._account(request.id, size, shared)
+
+        self._meter.add_save(start)
+        self._listeners.notify(REQUEST_SAVED, request.id, request.url)
+
+    def _hold_body(
+        self, name: str, obj: Union[Request, Response]
+    ) -> Tuple[int, int, Optional[str]]:
+        """Share the body of a request or response with any identical body already
+        held, when the body is deduplicated.
+
+        Returns: A tuple of the number of bytes held against the request, the number
+            of bytes newly held in the shared body store, and the content hash of the
+            body if it is deduplicated.
+        """
+        if name not in self._dedup_names or len(obj.body) < DEDUP_MIN_BODY_SIZE:
+            return len(obj.body), 0, None
+
+        digest, stored = self._body_store.acquire(obj.body)
+        # Use the copy already held so that the duplicate can be freed
+        obj.body = self._body_store.read(digest)
+
+        return 0, stored, digest
+
+    def _account(self, request_id: str, size: int, shared: int = 0) -> None:
+        """Add bytes held in memory against a request, evicting requests if the byte
+        budget has been exceeded. The lock must be held by the caller.
+
+        Args:
+            request_id: The id of the request.
+            size: The number of bytes held by the request alone.
+            shared: The number of bytes newly held in the shared body store.
+        """
+        v = self._requests.get(request_id)
 
-                self._requests[request.id] = {
-                    "request": request,
-                }
+        if v is None:
+            return
+
+        v["size"] += size
+        self._bytes += size + shared
+        self._meter.add_bytes(v["host"], size)
+        self._resident[request_id] = True
+        self._resident.move_to_end(request_id)
+
+        if self._spill:
+            while self._bytes > self._max_bytes and self._resident:
+                spilled_id, _ = self._resident.popitem(last=False)
+                self._spill_bodies(self._requests[spilled_id])
+
+        # Spilling only moves bodies out of memory, so requests may still need
+        # to be discarded if websocket messages alone exceed the budget.
+        while self._bytes > self._max_bytes and self._requests:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Discard the next request due for eviction. The lock must be held by the caller."""
+        evicted_id, v = self._requests.popitem(last=False)
+        self._index.remove(evicted_id)
+        self._resident.pop(evicted_id, None)
+        self._bytes -= v["size"]
+        self._evictions += 1
+        self._meter.add_bytes(v["host"], -v["size"])
+
+        for digest in v.get("bodies", {}).values():
+            self._release(digest)
+
+    def _release(self, digest: Optional[str]) -> None:
+        """Release a deduplicated body. The lock must be held by the caller."""
+        if digest is not None:
+            self._bytes -= self._body_store.release(digest)
+
+    def _spill_bodies(self, v: dict) -> None:
+        """Move the request and response bodies of a stored request to the overflow file.
+        The lock must be held by the caller.
+        """
+        if self._spill_log is None:
+            self._spill_log = SegmentLog(
+                os.path.join(self.home_dir, "spill-{}".format(uuid.uuid4()))
+            )
+            _heartbeat.add(self._spill_log.directory)
+
+        request = v["request"]
+        bodies = v.get("bodies", {})
+
+        for name, obj in (("request", request), ("response", request.response)):
+            if obj is None or obj._body_loader is not None or not obj.body:
+                continue
+
+            body = obj.body
+            digest = bodies.get(name)
+            # A deduplicated body is spilled once, however many requests share it
+            location = self._spilled_bodies.get(digest)
+
+            if location is None:
+                location = self._spill_log.append(body)
+                self._spilled_bytes += len(body)
+
+                if digest is not None:
+                    self._spilled_bodies[digest] = location
+
+            obj.body = functools.partial(self._read_spilled, location)
+
+            if digest is not None:
+                self._bytes -= self._body_store.release(bodies.pop(name))
+            else:
+                v["size"] -= len(body)
+                self._bytes -= len(body)
+                self._meter.add_bytes(v["host"], -len(body))
+
+    def _read_spilled(self, location: Location) -> bytes:
+        try:
+            return self._spill_log.read(location)
+        except (FileNotFoundError, EOFError, AttributeError):
+            log.debug("Spilled body at %s is no longer available", location)
+            return b""
 
     def save_response(self, request_id: str, response: Response) -> None:
         """Save a response to storage against a request with the specified id.
@@ -418,6 +2916,7 @@ class InMemoryRequestStorage:
             request_id: The id of the original request.
             response: The response to save.
         """
+        start = time.perf_counter()
         request = self._get_request(request_id)
 
         if request is not None:
@@ -427,6 +2926,30 @@ class InMemoryRequestStorage:
             if hasattr(response, "cert"):
                 request.cert = response.cert
                 del response.cert
+
+            indexed_request = self._index.get(request_id)
+
+            if indexed_request is not None:
+                self._index.set_response(indexed_request, response)
+                self._index.touch(indexed_request)
+
+            # Any deduplicated body is hashed before taking the lock
+            size, shared, digest = self._hold_body("response", response)
+
+            with self._lock:
+                v = self._requests.get(request_id)
+
+                if v is not None:
+                    if digest is not None:
+                        v.setdefault("bodies", {})["response"] = digest
+                    self._account(request_id, size, shared)
+                elif digest is not None:
+                    # Evicted while the body was being held
+                    self._bytes += shared
+                    self._release(digest)
+
+            self._meter.add_save(start)
+            self._listeners.notify(RESPONSE_SAVED, request_id, request.url)
         else:
             log.debug(
                 "Cannot save response as request %s is no longer stored" % request_id
@@ -441,9 +2964,33 @@ class InMemoryRequestStorage:
         """
         request = self._get_request(request_id)
 
-        if request is not None:
+        if request is None:
+            return
+
+        size = content_size(message)
+        self._meter.add_ws_message(size)
+
+        if self._ws_max_messages is None and self._ws_max_bytes is None:
             request.ws_messages.append(message)
 
+            with self._lock:
+                self._account(request_id, size)
+
+            return
+
+        with self._lock:
+            ws_messages = request.ws_messages
+
+            if not isinstance(ws_messages, MessageRing):
+                ws_messages = request.ws_messages = MessageRing(
+                    self._ws_max_messages, self._ws_max_bytes
+                )
+
+            dropped = ws_messages.dropped_messages, ws_messages.dropped_bytes
+            self._account(request_id, ws_messages.append(message))
+            self._ws_dropped_messages += ws_messages.dropped_messages - dropped[0]
+            self._ws_dropped_bytes += ws_messages.dropped_bytes - dropped[1]
+
     def save_har_entry(self, request_id: str, entry: dict) -> None:
         """Save a HAR entry to storage against a request with the specified id.
 
@@ -463,13 +3010,44 @@ class InMemoryRequestStorage:
 
     def _get_request(self, request_id: str) -> Optional[Request]:
         """Get a request with the specified id or None if no request found."""
+        if self._eviction != "lru":
+            # Nothing to update, so no need for the lock
+            v = self._requests.get(request_id)
+            return v["request"] if v is not None else None
+
         with self._lock:
             try:
-                return self._requests[request_id]["request"]
+                request = self._requests[request_id]["request"]
             except KeyError:
                 return None
 
-    def load_requests(self) -> List[Request]:
+            self._requests.move_to_end(request_id)
+            if request_id in self._resident:
+                self._resident.move_to_end(request_id)
+
+            return request
+
+    def _held(self, index: Iterable[_IndexedRequest]) -> List[dict]:
+        """Get the stored values of the specified requests that are still held,
+        without taking the lock.
+        """
+        return [v for v in map(self._requests.get, map(_get_id, index)) if v is not None]
+
+    def _held_requests(self) -> Tuple[Request, ...]:
+        """Get a snapshot of the requests held, in the order they were saved, without
+        taking the lock. The snapshot is shared by callers until the next request is
+        saved or removed.
+        """
+        version, requests = self._snapshot
+
+        if version != self._index.version:
+            version = self._index.version
+            requests = tuple([v["request"] for v in self._held(self._index.entries())])
+            self._snapshot = (version, requests)
+
+        return requests
+
+    def load_requests(self, lazy: Optional[bool] = None) -> List[Request]:
         """Load all previously saved requests.
 
         The requests are returned as a list of request objects in the order in which they
@@ -478,10 +3056,21 @@ class InMemoryRequestStorage:
         Note that for efficiency request objects are not copied when returned, so any
         change made to a request will also affect the stored version.
 
+        Args:
+            lazy: Accepted for compatibility with the disk storage. Requests held in
+                memory are always returned as is.
         Returns: A list of request objects.
         """
-        with self._lock:
-            return [v["request"] for v in self._requests.values()]
+        return list(self._held_requests())
+
+    def load_request(self, request_id: str) -> Optional[Request]:
+        """Load the request with the specified id.
+
+        Args:
+            request_id: The id of the request.
+        Returns: The request or None if no such request is stored.
+        """
+        return self._get_request(request_id)
 
     def load_last_request(self) -> Optional[Request]:
         """Load the last saved request.
@@ -489,37 +3078,76 @@ class InMemoryRequestStorage:
         Returns: The last saved request or None if no requests have
             yet been stored.
         """
-        with self._lock:
-            try:
-                return next(reversed(self._requests.values()))["request"]
-            except (StopIteration, KeyError):
-                return None
+        last_request = self._index.last()
+
+        if last_request is None:
+            return None
+
+        return self._get_request(last_request.id)
 
     def load_har_entries(self) -> List[dict]:
         """Load all previously saved HAR entries.
 
         Returns: A list of HAR entries.
         """
-        with self._lock:
-            return [v["har_entry"] for v in self._requests.values() if "har_entry" in v]
+        return [v["har_entry"] for v in self._held(self._index.entries()) if "har_entry" in v]
 
-    def iter_requests(self) -> Iterator[Request]:
+    def iter_requests(
+        self, lazy: Optional[bool] = None, since: Optional[int] = None
+    ) -> Iterator[Request]:
         """Return an iterator over the saved requests.
 
+        Args:
+            lazy: Accepted for compatibility with the disk storage. Requests held in
+                memory are always returned as is.
+            since: When specified, only the requests saved or updated since this
+                cursor are returned. See requests_since().
         Returns: An iterator of request objects.
         """
-        with self._lock:
-            values = list(self._requests.values())
+        if since is not None:
+            yield from self.requests_since(since)[0]
+            return
+
+        yield from self._held_requests()
+
+    def requests_since(
+        self, cursor: int = 0, lazy: Optional[bool] = None
+    ) -> Tuple[List[Request], int]:
+        """Get the requests saved or updated since the specified cursor.
+
+        A request is updated when its response is saved, in which case it is
+        returned again. Requests are returned in the order in which they were
+        saved or updated.
 
-        for v in values:
-            yield v["request"]
+        Args:
+            cursor: The cursor returned by a previous call. Default 0, which
+                returns all requests.
+            lazy: Accepted for compatibility with the disk storage.
+        Returns: A tuple of the list of request objects and the cursor to pass
+            to the next call.
+        """
+        index, cursor = self._index.since(cursor)
+
+        return [v["request"] for v in self._held(index)], cursor
 
     def clear_requests(self) -> None:
         """Clear all previously saved requests."""
         with self._lock:
             self._requests.clear()
-
-    def find(self, pat: str, check_response: bool = True) -> Optional[Request]:
+            self._index.clear()
+            self._resident.clear()
+            self._body_store.clear()
+            self._bytes = 0
+            self._spilled_bytes = 0
+            self._spilled_bodies.clear()
+            self._meter.clear_bytes()
+
+            if self._spill_log is not None:
+                self._spill_log.reset()
+
+    def find(
+        self, pat: str, check_response: bool = True, **filters
+    ) -> Optional[Request]:
         """Find the first request that matches the specified pattern.
 
         Requests are searched in chronological order.
@@ -529,20 +3157,230 @@ class InMemoryRequestStorage:
             check_response: When a match is found, whether to check that the request has
                 a corresponding response. Where check_response=True and no response has
                 been received, this method will skip the request and continue searching.
+            filters: Optional host, method, status_code and content_type criteria
+                that narrow down the requests searched. See query().
 
         Returns: The first request in the storage that matches the pattern,
             or None if no requests match.
         """
-        with self._lock:
-            for v in self._requests.values():
-                request = v["request"]
+        for indexed_request in self._index.select(
+            pat, has_response=True if check_response else None, **filters
+        ):
+            request = self._get_request(indexed_request.id)
 
-                if re.search(pat, request.url):
-                    if (check_response and request.response) or not check_response:
-                        return request
+            if request is not None:
+                return request
 
         return None
 
+    def query(
+        self,
+        pat: Optional[str] = None,
+        *,
+        host: Optional[str] = None,
+        method: Optional[str] = None,
+        status_code: Optional[int] = None,
+        content_type: Optional[str] = None,
+        check_response: bool = False,
+    ) -> List[Request]:
+        """Get the requests that match all of the supplied criteria.
+
+        Criteria that are not supplied are not applied. Requests are returned
+        in chronological order.
+
+        Args:
+            pat: A pattern that will be searched in the request URL.
+            host: The request hostname, excluding any port.
+            method: The request method, e.g. GET.
+            status_code: The response status code.
+            content_type: The response content type, excluding any parameters.
+            check_response: Whether to only return requests that have a response.
+
+        Returns: A list of matching request objects.
+        """
+        requests = []
+
+        for indexed_request in self._index.select(
+            pat,
+            has_response=True if check_response else None,
+            host=host,
+            method=method,
+            status_code=status_code,
+            content_type=content_type,
+        ):
+            request = self._get_request(indexed_request.id)
+
+            if request is not None:
+                requests.append(request)
+
+        return requests
+
+    def add_listener(self, listener: Callable[[str, str, str], None]) -> None:
+        """Add a listener that is notified when a request or response is saved.
+
+        The listener is called with the event (REQUEST_SAVED or RESPONSE_SAVED),
+        the id of the request and the request URL. It is called on the thread that
+        saved the request or response, so it should return quickly.
+
+        Args:
+            listener: The listener to add.
+        """
+        self._listeners.add(listener)
+
+    def remove_listener(self, listener: Callable[[str, str, str], None]) -> None:
+        """Remove a listener previously added with add_listener().
+
+        Args:
+            listener: The listener to remove.
+        """
+        self._listeners.remove(listener)
+
+    def stats(self) -> dict:
+        """Get statistics about the requests held by the storage.
+
+        The statistics are kept up to date as requests are saved and evicted, so
+        are cheap to get regardless of the number of requests held.
+
+        Returns: A dictionary containing:
+            - requests: The number of requests held
+            - responses: The number of requests held that have a response
+            - bytes: The number of bytes of bodies and websocket messages held in memory
+            - bytes_in_memory: The same as bytes
+            - bytes_on_disk: The number of bytes of bodies spilled to disk
+            - bytes_by_host: The bytes held in memory for each host, excluding
+              deduplicated bodies
+            - ws_messages: The number of websocket messages saved
+            - ws_bytes: The number of bytes of websocket messages saved
+            - ws_dropped_messages: The number of websocket messages dropped to stay
+              within the per connection limits
+            - ws_dropped_bytes: The number of bytes of websocket messages dropped
+            - evictions: The number of requests evicted to stay within the limits
+            - write_queue_depth: Always 0, as nothing is written in the background
+            - save_latency_ms: The average time in milliseconds taken to save a
+              request or response
+            - dedup_bodies: The number of distinct deduplicated bodies held
+            - dedup_bytes_saved: The number of bytes not held because an identical
+              body was already held
+            - compression_bytes_saved: Always 0, as bodies held in memory aren't
+              compressed
+        """
+        with self._lock:
+            return {
+                "requests": len(self._requests),
+                "responses": self._index.responses,
+                "bytes": self._bytes,
+                "bytes_in_memory": self._bytes,
+                "bytes_on_disk": self._spilled_bytes,
+                **self._meter.report(),
+                "ws_dropped_messages": self._ws_dropped_messages,
+                "ws_dropped_bytes": self._ws_dropped_bytes,
+                "evictions": self._evictions,
+                "write_queue_depth": 0,
+                "dedup_bodies": len(self._body_store),
+                "dedup_bytes_saved": self._body_store.bytes_saved,
+                "compression_bytes_saved": 0,
+            }
+
     def cleanup(self) -> None:
-        """Clear all previously saved requests."""
+        """Clear all previously saved requests and remove any bodies spilled to disk."""
         self.clear_requests()
+
+        if self._spill_log is not None:
+            _heartbeat.remove(self._spill_log.directory)
+            self._spill_log.close()
+            shutil.rmtree(self._spill_log.directory, ignore_errors=True)
+
+
+class NullRequestStorage:
+    """Stores nothing.
+
+    Used when captured requests are only consumed through subscriptions, so
+    that nothing is held in memory or written to disk. Requests are still given
+    an id so that their responses can be matched up with them.
+    """
+
+    def __init__(self, base_dir: Optional[str] = None):
+        """Initialise a new NullRequestStorage.
+
+        Args:
+            base_dir: The directory where certificate data is stored. If not
+                specified, the system temp folder is used.
+        """
+        if base_dir is None:
+            base_dir = tempfile.gettempdir()
+
+        self.home_dir: str = os.path.join(base_dir, ".wireproxy")
+
+    def save_request(self, request: Request) -> None:
+        request.id = str(uuid.uuid4())
+
+    def save_response(self, request_id: str, response: Response) -> None:
+        pass
+
+    def save_ws_message(self, request_id: str, message: WebSocketMessage) -> None:
+        pass
+
+    def save_har_entry(self, request_id: str, entry: dict) -> None:
+        pass
+
+    def load_requests(self, lazy: Optional[bool] = None) -> List[Request]:
+        return []
+
+    def load_request(self, request_id: str) -> Optional[Request]:
+        return None
+
+    def load_last_request(self) -> Optional[Request]:
+        return None
+
+    def load_har_entries(self) -> List[dict]:
+        return []
+
+    def iter_requests(
+        self, lazy: Optional[bool] = None, since: Optional[int] = None
+    ) -> Iterator[Request]:
+        return iter(())
+
+    def requests_since(
+        self, cursor: int = 0, lazy: Optional[bool] = None
+    ) -> Tuple[List[Request], int]:
+        return [], cursor
+
+    def clear_requests(self) -> None:
+        pass
+
+    def find(
+        self, pat: str, check_response: bool = True, **filters
+    ) -> Optional[Request]:
+        return None
+
+    def query(self, pat: Optional[str] = None, **filters) -> List[Request]:
+        return []
+
+    def add_listener(self, listener: Callable[[str, str, str], None]) -> None:
+        pass
+
+    def remove_listener(self, listener: Callable[[str, str, str], None]) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "requests": 0,
+            "responses": 0,
+            "bytes": 0,
+            "bytes_in_memory": 0,
+            "bytes_on_disk": 0,
+            "bytes_by_host": {},
+            "ws_messages": 0,
+            "ws_bytes": 0,
+            "ws_dropped_messages": 0,
+            "ws_dropped_bytes": 0,
+            "evictions": 0,
+            "write_queue_depth": 0,
+            "save_latency_ms": 0.0,
+            "dedup_bodies": 0,
+            "dedup_bytes_saved": 0,
+            "compression_bytes_saved": 0,
+        }
+
+    def cleanup(self) -> None:
+        pass
@@ -0,0 +1,239 @@
+"""Push based delivery of captured requests, responses and websocket messages.
+
+Subscribers receive each captured item as soon as it is captured, rather than
+having to repeatedly load requests from storage. Each subscription has a bounded
+buffer of events and an overflow policy which determines what happens when a
+subscriber can't keep up: either new events are dropped, or capture blocks
+until there is space in the buffer.
+"""
+import logging
+import threading
+from collections import deque
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from wireproxy.request import Request, WebSocketMessage
+
+log = logging.getLogger(__name__)
+
+# The kinds of event published.
+REQUEST = "request"
+RESPONSE = "response"
+WS_MESSAGE = "ws_message"
+
+EVENT_KINDS = (REQUEST, RESPONSE, WS_MESSAGE)
+
+# What happens when a subscription's buffer is full.
+OVERFLOW_POLICIES = ("drop", "block")
+
+# The number of events a subscription buffers by default.
+DEFAULT_BUFFER_SIZE = 1000
+
+
+class CaptureEvent(NamedTuple):
+    """A captured request, response or websocket message."""
+
+    # One of REQUEST, RESPONSE or WS_MESSAGE.
+    kind: str
+    # The id of the captured request, or of the websocket handshake request.
+    request_id: str
+    # The captured request. For RESPONSE events, the response is attached to the
+    # request. None for WS_MESSAGE events.
+    request: Optional[Request] = None
+    # The websocket message for WS_MESSAGE events.
+    message: Optional[WebSocketMessage] = None
+
+
+class Subscription:
+    """A subscriber's buffer of captured events.
+
+    Events can be consumed by calling get(), or by iterating over the subscription,
+    which blocks waiting for each event until the subscription is closed. When the
+    subscription was created with a callback, events are instead passed to the
+    callback on a dedicated thread.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(
+        self,
+        callback: Optional[Callable[[CaptureEvent], None]] = None,
+        maxsize: int = DEFAULT_BUFFER_SIZE,
+        overflow: str = "drop",
+        kinds: Optional[Iterable[str]] = None,
+        on_close: Optional[Callable[["Subscription"], None]] = None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unknown overflow policy: {} (expected one of {})".format(
+                    overflow, ", ".join(OVERFLOW_POLICIES)
+                )
+            )
+
+        self.kinds = frozenset(kinds if kinds is not None else EVENT_KINDS)
+        # The number of events dropped because the buffer was full.
+        self.dropped = 0
+
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._on_close = on_close
+        self._events: deque = deque()
+        self._closed = False
+        self._condition = threading.Condition()
+
+        if callback is not None:
+            t = threading.Thread(
+                name="Wire Proxy Subscriber", target=self._dispatch, args=(callback,)
+            )
+            t.daemon = True
+            t.start()
+
+    def put(self, event: CaptureEvent) -> None:
+        """Add an event to the buffer, applying the overflow policy if it's full.
+
+        Args:
+            event: The event.
+        """
+        with self._condition:
+            if self._overflow == "block":
+                while len(self._events) >= self._maxsize and not self._closed:
+                    self._condition.wait()
+
+            if self._closed:
+                return
+
+            if len(self._events) >= self._maxsize:
+                self.dropped += 1
+                return
+
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[CaptureEvent]:
+        """Get the next event, waiting for one if necessary.
+
+        Args:
+            timeout: The maximum time in seconds to wait. Default no limit.
+        Returns: The next event, or None if the timeout expired or the
+            subscription was closed and there are no more events.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._events or self._closed, timeout)
+
+            if not self._events:
+                return None
+
+            event = self._events.popleft()
+            self._condition.notify_all()
+
+            return event
+
+    def close(self) -> None:
+        """Stop receiving events. Any events already buffered can still be consumed."""
+        with self._condition:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._condition.notify_all()
+
+        if self._on_close is not None:
+            self._on_close(self)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def __len__(self):
+        return len(self._events)
+
+    def __iter__(self) -> Iterator[CaptureEvent]:
+        while True:
+            event = self.get()
+
+            if event is None:
+                break
+
+            yield event
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _dispatch(self, callback: Callable[[CaptureEvent], None]) -> None:
+        for event in self:
+            try:
+                callback(event)
+            except Exception:
+                log.exception("Error calling subscriber with %s event", event.kind)
+
+
+class Publisher:
+    """Publishes captured events to the current subscriptions.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self):
+        # Replaced rather than modified so that it can be iterated without a lock
+        self._subscriptions: Tuple[Subscription, ...] = ()
+        self._lock = threading.Lock()
+
+    def subscribe(
+        self,
+        callback: Optional[Callable[[CaptureEvent], None]] = None,
+        *,
+        maxsize: int = DEFAULT_BUFFER_SIZE,
+        overflow: str = "drop",
+        kinds: Optional[Iterable[str]] = None,
+    ) -> Subscription:
+        """Subscribe to captured events.
+
+        Args:
+            callback: An optional callable that is passed each event on a dedicated
+                thread. When not supplied, events are consumed from the returned
+                subscription.
+            maxsize: The maximum number of events buffered for the subscriber.
+            overflow: What happens when the buffer is full: 'drop' discards new events
+                and counts them in Subscription.dropped, 'block' holds up capture until
+                there is space. Default 'drop'.
+            kinds: The kinds of event to receive. Default all kinds.
+        Returns: The subscription, which should be closed when no longer needed.
+        """
+        subscription = Subscription(
+            callback,
+            maxsize=maxsize,
+            overflow=overflow,
+            kinds=kinds,
+            on_close=self._remove,
+        )
+
+        with self._lock:
+            self._subscriptions += (subscription,)
+
+        return subscription
+
+    def publish(self, event: CaptureEvent) -> None:
+        """Publish an event to the subscriptions interested in it.
+
+        Args:
+            event: The event.
+        """
+        for subscription in self._subscriptions:
+            if event.kind in subscription.kinds:
+                subscription.put(event)
+
+    def close(self) -> None:
+        """Close all subscriptions."""
+        for subscription in self._subscriptions:
+            subscription.close()
+
+    def _remove(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscriptions = tuple(
+                s for s in self._subscriptions if s is not subscription
+            )
+
+    def __bool__(self):
+        return bool(self._subscriptions)
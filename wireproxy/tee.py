@@ -0,0 +1,97 @@
+"""Capture of response bodies as they are streamed to the client.
+
+Captured responses are normally read from the server in full before any of the
+body is sent on to the client, which delays the first byte of large downloads
+until the last has arrived. A ResponseTee is instead set as the stream of a
+mitmproxy response, so that each chunk of the body is passed on to the client
+as it arrives while a copy is written to a sink. Small bodies are held in
+memory, larger ones in a temporary file.
+
+Once the body has been streamed in full the tee hands back a callable that
+reads the copy from the sink, so that it is only loaded when it is used. The copy
+is read once and kept, so the callable can be shared by copies of a response.
+Should the copy not be needed after all, e.g. because it isn't stored, calling
+its close() method discards it.
+"""
+import logging
+import tempfile
+import threading
+from typing import Callable, Iterable, Iterator, Optional
+
+log = logging.getLogger(__name__)
+
+# The number of bytes of a body held in memory before the copy is moved to a
+# temporary file.
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+
+
+class ResponseTee:
+    """Passes on the chunks of a streamed body while keeping a copy of them.
+
+    An instance is set as the stream attribute of a mitmproxy response, which
+    calls it with the chunks read from the server.
+    """
+
+    def __init__(
+        self,
+        on_complete: Callable[[Callable[[], bytes]], None],
+        spool_size: int = DEFAULT_SPOOL_SIZE,
+    ):
+        """Initialise a new ResponseTee.
+
+        Args:
+            on_complete: Called once the body has been streamed in full, with a
+                callable that returns the copy of the body, and whose close() method
+                discards the copy. It is not called when streaming fails part way
+                through.
+            spool_size: The number of bytes held in memory before the copy is
+                moved to a temporary file.
+        """
+        self.on_complete = on_complete
+        self.spool_size = spool_size
+
+    def __call__(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        sink = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+
+        try:
+            for chunk in chunks:
+                sink.write(chunk)
+                yield chunk
+        except BaseException:
+            # E.g. the client or server went away
+            log.debug("Discarding the copy of a partially streamed body")
+            sink.close()
+            raise
+
+        self.on_complete(_SinkReader(sink))
+
+
+class _SinkReader:
+    """Reads the copy of a body back from its sink the first time it is called,
+    closing the sink.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self, sink):
+        self._sink = sink
+        self._body: Optional[bytes] = None
+        self._lock = threading.Lock()
+
+    def __call__(self) -> bytes:
+        with self._lock:
+            if self._body is None:
+                if self._sink.closed:
+                    log.debug("The copy of a streamed body was read after being discarded")
+                    return b""
+
+                with self._sink:
+                    self._sink.seek(0)
+                    self._body = self._sink.read()
+
+            return self._body
+
+    def close(self) -> None:
+        """Discard the copy of the body, unless it has already been read."""
+        with self._lock:
+            self._sink.close()
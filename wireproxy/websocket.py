@@ -0,0 +1,380 @@
+"""Storage of the websocket messages exchanged over a single connection.
+
+Long-lived websocket connections can exchange an unbounded number of messages,
+so rather than holding them all in memory the disk backends append them to a
+file per connection. Only the most recent messages, which haven't yet been
+written, are held in memory. Older messages are read back from the file a page
+at a time as they are accessed.
+
+The in-memory backend instead holds a bounded number of each connection's most
+recent messages, dropping older ones.
+"""
+import logging
+import os
+import sys
+import threading
+from collections import deque
+from collections.abc import Sequence
+from typing import Deque, List, Optional, Tuple
+
+from wireproxy import records
+from wireproxy.request import WebSocketMessage
+
+log = logging.getLogger(__name__)
+
+# The number of messages read from the file at a time. The messages held in
+# memory are written once there are this many of them.
+DEFAULT_PAGE_SIZE = 256
+
+# The number of bytes of messages held in memory before they're written,
+# regardless of the number of messages.
+DEFAULT_MAX_TAIL_BYTES = 1024 * 1024
+
+
+def content_size(message: WebSocketMessage) -> int:
+    """Get the number of bytes of a message's content, which for a text message is
+    the length of its UTF-8 encoding rather than its number of characters.
+    """
+    if isinstance(message.content, str):
+        return len(message.content.encode("utf-8"))
+
+    return len(message.content)
+
+
+class MessageLog(Sequence):
+    """The websocket messages of a connection, appended to a file as they are saved.
+
+    A MessageLog is a read-only sequence of messages, and is what's attached to
+    the ws_messages attribute of requests loaded from the disk backends. It
+    continues to grow as further messages are saved.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_tail_bytes: int = DEFAULT_MAX_TAIL_BYTES,
+    ):
+        """Initialise a new MessageLog, continuing from any messages already
+        written to the file.
+
+        Args:
+            path: The path to the file holding the messages.
+            page_size: The number of messages read from the file at a time.
+            max_tail_bytes: The number of bytes of messages that may be held in
+                memory before they are written to the file.
+        """
+        self.path = path
+        self.page_size = page_size
+        self.max_tail_bytes = max_tail_bytes
+
+        # The number of messages and bytes written to the file.
+        self._count = 0
+        self._size = 0
+        # The offsets of the first message of each page within the file.
+        self._pages: List[int] = []
+        # The messages not yet written to the file.
+        self._tail: List[WebSocketMessage] = []
+        self._tail_bytes = 0
+        # The most recently read page, as its number and messages.
+        self._page: Tuple[int, List[WebSocketMessage]] = (-1, [])
+        self._lock = threading.Lock()
+
+        self._scan()
+
+    def append(self, message: WebSocketMessage) -> Tuple[int, int]:
+        """Append a message to the log.
+
+        Args:
+            message: The websocket message.
+        Returns: A tuple of the number of bytes written to the file and the number
+            of bytes of message content no longer held in memory as a result. Both
+            are 0 unless the message caused the messages held in memory to be written.
+        """
+        with self._lock:
+            self._tail.append(message)
+            self._tail_bytes += content_size(message)
+
+            if len(self._tail) >= self.page_size or self._tail_bytes >= self.max_tail_bytes:
+                return self._write()
+
+        return 0, 0
+
+    def flush(self) -> Tuple[int, int]:
+        """Write any messages held in memory to the file.
+
+        Returns: A tuple of the number of bytes written and the number of bytes
+            of message content no longer held in memory.
+        """
+        with self._lock:
+            return self._write()
+
+    def remove(self) -> None:
+        """Delete the file and discard the messages held in memory."""
+        with self._lock:
+            self._count = self._size = self._tail_bytes = 0
+            self._pages = []
+            self._tail = []
+            self._page = (-1, [])
+
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def size(self) -> int:
+        """The number of bytes of messages written to the file."""
+        return self._size
+
+    @property
+    def tail_bytes(self) -> int:
+        """The number of bytes of message content held in memory."""
+        return self._tail_bytes
+
+    def __len__(self):
+        return self._count + len(self._tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        with self._lock:
+            count = self._count
+            length = count + len(self._tail)
+
+            if index < 0:
+                index += length
+
+            if not 0 <= index < length:
+                raise IndexError("message index out of range")
+
+            if index >= count:
+                return self._tail[index - count]
+
+        page, pos = divmod(index, self.page_size)
+        messages = self._read_page(page)
+
+        if pos >= len(messages):
+            # The file was removed, e.g. because the storage was cleared
+            raise IndexError("message index out of range")
+
+        return messages[pos]
+
+    def __iter__(self):
+        with self._lock:
+            pages = len(self._pages)
+            tail = list(self._tail)
+            written = self._count
+
+        for page in range(pages):
+            yield from self._read_page(page)[: written - page * self.page_size]
+
+        yield from tail
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "MessageLog({!r}, {} messages)".format(self.path, len(self))
+
+    def _write(self) -> Tuple[int, int]:
+        if not self._tail:
+            return 0, 0
+
+        data = []
+        offset = self._size
+
+        for message in self._tail:
+            record = records.encode(message)
+
+            if self._count % self.page_size == 0:
+                self._pages.append(offset)
+
+            data.append(record)
+            offset += len(record)
+            self._count += 1
+
+        with open(self.path, "ab") as f:
+            f.write(b"".join(data))
+
+        written, released = offset - self._size, self._tail_bytes
+        self._size = offset
+        self._tail = []
+        self._tail_bytes = 0
+
+        return written, released
+
+    def _read_page(self, page: int) -> List[WebSocketMessage]:
+        with self._lock:
+            cached_page, messages = self._page
+
+            if cached_page == page and (
+                len(messages) == self.page_size
+                or len(messages) == self._count - page * self.page_size
+            ):
+                return messages
+
+            if page >= len(self._pages):
+                return []
+
+            start = self._pages[page]
+            end = self._pages[page + 1] if page + 1 < len(self._pages) else self._size
+
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                data = f.read(end - start)
+        except FileNotFoundError:
+            return []
+
+        # Sliced without copying, and decoded without checking the messages, which
+        # were checked when the file was opened or written by this process.
+        view = memoryview(data)
+        messages = []
+        pos = 0
+
+        while pos < len(data):
+            length = records.record_length(view[pos : pos + records.HEADER_SIZE])
+            messages.append(records.decode(view[pos : pos + length], verify=False))
+            pos += length
+
+        with self._lock:
+            self._page = (page, messages)
+
+        return messages
+
+    def _scan(self) -> None:
+        """Count and check the messages already written to the file, truncating any
+        message that was only partially written.
+        """
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+
+        with f:
+            file_size = os.fstat(f.fileno()).st_size
+            offset = 0
+
+            while offset < file_size:
+                header = f.read(records.HEADER_SIZE)
+
+                try:
+                    length = records.record_length(header)
+
+                    if offset + length > file_size:
+                        break
+
+                    records.check(header + f.read(length - len(header)))
+                except records.CorruptRecordError:
+                    break
+
+                if self._count % self.page_size == 0:
+                    self._pages.append(offset)
+
+                self._count += 1
+                offset += length
+
+        self._size = offset
+
+        if offset < file_size:
+            log.warning(
+                "Discarding %s bytes of incomplete websocket messages from %s",
+                file_size - offset,
+                self.path,
+            )
+            os.truncate(self.path, offset)
+
+
+class MessageRing(Sequence):
+    """The most recent websocket messages of a connection, held in memory.
+
+    When holding another message would exceed the limit on the number of messages
+    or their bytes, the oldest messages are dropped. The number of messages and
+    bytes dropped are counted.
+
+    Instances are designed to be threadsafe.
+    """
+
+    def __init__(self, max_messages: Optional[int] = None, max_bytes: Optional[int] = None):
+        """Initialise a new MessageRing.
+
+        Args:
+            max_messages: The maximum number of messages to hold. Default no limit.
+            max_bytes: The maximum number of bytes of message content to hold.
+                Default no limit.
+        """
+        self.max_messages = sys.maxsize if max_messages is None else max_messages
+        self.max_bytes = sys.maxsize if max_bytes is None else max_bytes
+        # The number of messages and bytes dropped to stay within the limits.
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+
+        self._messages: Deque[WebSocketMessage] = deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def append(self, message: WebSocketMessage) -> int:
+        """Append a message, dropping the oldest messages if a limit is exceeded.
+
+        Args:
+            message: The websocket message.
+        Returns: The change in the number of bytes held, which is negative when
+            more bytes were dropped than added.
+        """
+        size = content_size(message)
+
+        with self._lock:
+            self._messages.append(message)
+            self._bytes += size
+            held = size
+
+            while self._messages and (
+                len(self._messages) > self.max_messages or self._bytes > self.max_bytes
+            ):
+                dropped = content_size(self._messages.popleft())
+                self._bytes -= dropped
+                held -= dropped
+                self.dropped_messages += 1
+                self.dropped_bytes += dropped
+
+        return held
+
+    @property
+    def size(self) -> int:
+        """The number of bytes of message content held."""
+        return self._bytes
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __getitem__(self, index):
+        with self._lock:
+            if isinstance(index, slice):
+                return list(self._messages)[index]
+
+            return self._messages[index]
+
+    def __iter__(self):
+        # Iterate a copy, as the deque can't be iterated while it's appended to
+        with self._lock:
+            messages = list(self._messages)
+
+        return iter(messages)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "MessageRing({} messages, {} dropped)".format(
+            len(self), self.dropped_messages
+        )